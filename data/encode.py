@@ -1,6 +1,12 @@
+import os
 import numpy as np
-from typing import Union, List, Tuple, Dict
+from functools import partial
+from multiprocessing import Pool
+from typing import Union, List, Tuple, Dict, Any
 from rdkit import Chem
+from rdkit.Chem.rdchem import Mol as Molecule
+
+from .feature_cache import CacheKey, FeatureCache, get_feature_cache
 
 
 def one_of_k_encoding(x, allowable_set):
@@ -116,38 +122,55 @@ def num_bond_features() -> int:
     return len(bond_features(simple_mol.GetBonds()[0]))
 
 
-def encode_smiles(smiles: np.ndarray, return_mask=False
+def encode_smiles(smiles: np.ndarray, return_mask=False, cache: FeatureCache = None
                   ) -> Union[List[Dict[str, np.ndarray]], Tuple[List[Dict[str, np.ndarray]], List[int]]]:
     mols = [Chem.MolFromSmiles(smile) for smile in smiles]
-    return encode_mols(mols, return_mask=return_mask)
+    return encode_mols(mols, return_mask=return_mask, cache=cache)
+
+
+def encode_mol(mol) -> Dict[str, np.ndarray]:
+    return {
+        'af': np.stack([atom_features(a) for i, a in enumerate(mol.GetAtoms())]),
+        'bf': np.stack([bond_features(b) for b in mol.GetBonds()]
+                       # + [bond_features(b) for b in mol.GetBonds()]
+                       ) if len(mol.GetBonds()) else np.zeros(shape=[0, 10], dtype=np.int32),
+        'us': np.array([b.GetBeginAtomIdx() for b in mol.GetBonds()]
+                       # + [b.GetEndAtomIdx() for b in mol.GetBonds()]
+                       , dtype=np.int32),
+        'vs': np.array([b.GetEndAtomIdx() for b in mol.GetBonds()]
+                       # + [b.GetBeginAtomIdx() for b in mol.GetBonds()]
+                       , dtype=np.int32)
+    }
+
+
+def encode_mol_cached(mol, cache: FeatureCache = None) -> Dict[str, np.ndarray]:
+    """
+    `encode_mol` through a `FeatureCache`, the one of the process (`get_feature_cache()`) if None
+    """
+    if cache is None:
+        cache = get_feature_cache()
+    key = cache.key(mol)
+    info = cache.get(key)
+    if info is None:
+        info = encode_mol(mol)
+        cache.put(key, info)
+    return info
 
 
-def encode_mols(mols: list, return_mask=False
+def encode_mols(mols: list, return_mask=False, cache: FeatureCache = None
                 ) -> Union[List[Dict[str, np.ndarray]], Tuple[List[Dict[str, np.ndarray]], List[int]]]:
     ret = []
     mask = []
     print('\tStart encoding...')
     cnt = 0
     for idx, mol in enumerate(mols):
-        info = {}
         if return_mask:
             if not mol:
                 cnt += 1
                 continue
             else:
                 mask.append(cnt)
-        info['af'] = np.stack([atom_features(a) for i, a in enumerate(mol.GetAtoms())])
-
-        info['bf'] = np.stack([bond_features(b) for b in mol.GetBonds()]
-                              # + [bond_features(b) for b in mol.GetBonds()]
-                              ) if len(mol.GetBonds()) else np.zeros(shape=[0, 10], dtype=np.int32)
-        info['us'] = np.array([b.GetBeginAtomIdx() for b in mol.GetBonds()]
-                              # + [b.GetEndAtomIdx() for b in mol.GetBonds()]
-                              , dtype=np.int32)
-        info['vs'] = np.array([b.GetEndAtomIdx() for b in mol.GetBonds()]
-                              # + [b.GetBeginAtomIdx() for b in mol.GetBonds()]
-                              , dtype=np.int32)
-        ret.append(info)
+        ret.append(encode_mol_cached(mol, cache))
         cnt += 1
         if cnt % 10000 == 0:
             print('\t', cnt, 'encoded.')
@@ -157,27 +180,83 @@ def encode_mols(mols: list, return_mask=False
     return ret
 
 
+def _encode_chunk(chunk: List[Any], cache: FeatureCache
+                  ) -> List[Tuple[Union[CacheKey, None], Union[Dict[str, np.ndarray], None]]]:
+    """
+    parse, key, look up and encode where the molecules are, in a worker process or in this one
+    :param cache: looked up but not filled, the keys of the molecules it misses being returned for that
+    :return: for each item, its key if it was encoded (None if found or invalid) and its features (None if invalid)
+    """
+    ret = []
+    for item in chunk:
+        if isinstance(item, str):
+            mol = Chem.MolFromSmiles(item)
+        elif isinstance(item, bytes):
+            mol = Chem.Mol(item)
+        else:
+            mol = item
+        if not mol:
+            ret.append((None, None))
+            continue
+        key = cache.key(mol)
+        info = cache.get(key)
+        ret.append((None, info) if info is not None else (key, encode_mol(mol)))
+    return ret
+
+
+def encode_mols_parallel(mols: list, n_workers: int = None, chunk_size=1000, return_mask=False,
+                         cache: FeatureCache = None
+                         ) -> Union[List[Dict[str, np.ndarray]], Tuple[List[Dict[str, np.ndarray]], List[int]]]:
+    """
+    `encode_mols` over a process pool, chunk by chunk, keeping the order of `mols`; the workers parse, key
+    and look up the molecules in the SQLite file of the `FeatureCache` themselves, this process only writing
+    the ones they encoded; no more than `chunk_size` molecules are encoded here, without any pool
+    :param mols: RDKit molecules or SMILES strings
+    :param n_workers: number of processes, `os.cpu_count()` if None
+    :param chunk_size: number of molecules sent to a process at a time
+    :param return_mask: also return the indices of the valid molecules, which are the only ones encoded
+    :param cache: the cache looked up and filled, `get_feature_cache()` if None
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if cache is None:
+        cache = get_feature_cache()
+    if n_workers <= 1 or len(mols) <= chunk_size:
+        results = _encode_chunk(mols, cache)
+    else:
+        # molecules travel as binaries with all their properties, computed CIP codes included
+        items = [m.ToBinary(Chem.PropertyPickleOptions.AllProps) if isinstance(m, Molecule) else m for m in mols]
+        chunks = [items[i: i + chunk_size] for i in range(0, len(items), chunk_size)]
+        # the workers share the file of the cache only, the molecules it keeps in memory staying here
+        disk_cache = FeatureCache(cache.path, max_size=0)
+        print(f'\tStart encoding with {n_workers} workers...')
+        results = []
+        with Pool(n_workers) as pool:
+            for chunk_ret in pool.imap(partial(_encode_chunk, cache=disk_cache), chunks):
+                results.extend(chunk_ret)
+                if len(results) // 10000 != (len(results) - len(chunk_ret)) // 10000:
+                    print('\t', len(results), 'encoded.')
+        cache.disk_hits += sum(key is None and info is not None for key, info in results)
+        cache.misses += sum(key is not None for key, _ in results)
+    encoded = [(key, info) for key, info in results if key is not None]
+    print(f'\tFound {sum(info is not None for _, info in results) - len(encoded)} in the feature cache')
+    cache.put_many(encoded)
+
+    mask = [i for i, (_, info) in enumerate(results) if info is not None]
+    if not return_mask:
+        assert len(mask) == len(results), 'Invalid molecules found, encode with `return_mask=True`'
+    ret = [results[i][1] for i in mask]
+    print('\tEncoded:', len(ret))
+    if return_mask:
+        return ret, mask
+    return ret
+
+
 def encode_mols_generator(mols: list) -> List[Dict[str, np.ndarray]]:
     for mol in mols:
-        yield {
-            'af': np.stack([atom_features(a) for i, a in enumerate(mol.GetAtoms())]),
-            'bf': np.stack([bond_features(b) for b in mol.GetBonds()]
-                           # + [bond_features(b) for b in mol.GetBonds()]
-                           ) if len(mol.GetBonds()) else np.zeros(shape=[0, 10], dtype=np.int32),
-            'us': np.array([b.GetBeginAtomIdx() for b in mol.GetBonds()]
-                           # + [b.GetEndAtomIdx() for b in mol.GetBonds()]
-                           , dtype=np.int32),
-            'vs': np.array([b.GetEndAtomIdx() for b in mol.GetBonds()]
-                           # + [b.GetBeginAtomIdx() for b in mol.GetBonds()]
-                           , dtype=np.int32)
-        }
-
-
-def get_features_from_smiles(smiles):
-    mol = Chem.MolFromSmiles(smiles)
-    af = np.stack([atom_features(a) for i, a in enumerate(mol.GetAtoms())])
-    bf = np.stack([bond_features(b) for b in mol.GetBonds()]) \
-        if len(mol.GetBonds()) else np.zeros(shape=[0, 10], dtype=np.int32)
-    us = np.array([b.GetBeginAtomIdx() for b in mol.GetBonds()], dtype=np.int32)
-    vs = np.array([b.GetEndAtomIdx() for b in mol.GetBonds()], dtype=np.int32)
-    return af, bf, us, vs
+        yield encode_mol(mol)
+
+
+def get_features_from_smiles(smiles, cache: FeatureCache = None):
+    info = encode_mol_cached(Chem.MolFromSmiles(smiles), cache)
+    return info['af'], info['bf'], info['us'], info['vs']
@@ -0,0 +1,151 @@
+import sqlite3
+import numpy as np
+import rdkit.Chem as Chem
+
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Union, Any
+
+from rdkit.Chem.rdchem import Mol as Molecule
+
+CacheKey = Tuple[str, np.ndarray, np.ndarray]
+
+
+def canonical_order(mol: Molecule) -> CacheKey:
+    """
+    :return: the canonical isomeric SMILES, the atom indices and the bond indices of `mol` in canonical order
+    """
+    smiles = Chem.MolToSmiles(mol)
+    props = mol.GetPropsAsDict(True, True)
+    atom_order = np.array(list(props['_smilesAtomOutputOrder']), dtype=np.int64)
+    bond_order = np.array(list(props['_smilesBondOutputOrder']), dtype=np.int64)
+    return smiles, atom_order, bond_order
+
+
+class FeatureCache:
+    def __init__(self, path: str = None, max_size=65536):
+        """
+        encoded molecules keyed by their canonical SMILES, so that a molecule met again, in another dataset or
+        written another way, is not featurized twice; the most recent `max_size` ones are kept in memory
+        and, with a `path`, all of them in an SQLite file shared by the runs (and processes) that open it.
+        The features are stored in canonical atom and bond order, and permuted back to the order of each molecule.
+        :param path: the SQLite file, memory only if None
+        :param max_size: number of molecules kept in memory
+        """
+        self.path = path
+        self.max_size = max_size
+        self.memory: 'OrderedDict[str, Dict[str, np.ndarray]]' = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+
+    @property
+    def db(self) -> Union[sqlite3.Connection, None]:
+        if self._db is None and self.path is not None:
+            self._db = sqlite3.connect(self.path, timeout=60)
+            self._db.execute('CREATE TABLE IF NOT EXISTS features (key TEXT PRIMARY KEY, '
+                             'n_atom INTEGER, bond_dim INTEGER, af BLOB, bf BLOB, us BLOB, vs BLOB)')
+        return self._db
+
+    @staticmethod
+    def key(mol: Molecule) -> CacheKey:
+        # molecules unpickled without their computed properties have no CIP labels, so they encode differently
+        perceived = mol.HasProp('_StereochemDone')
+        smiles, atom_order, bond_order = canonical_order(mol)
+        return (smiles if perceived else f'{smiles}|unperceived'), atom_order, bond_order
+
+    def get(self, key: CacheKey) -> Union[Dict[str, np.ndarray], None]:
+        smiles, atom_order, bond_order = key
+        info = self.memory.get(smiles)
+        if info is not None:
+            self.memory.move_to_end(smiles)
+            self.hits += 1
+        elif self.db is not None:
+            row = self.db.execute('SELECT n_atom, bond_dim, af, bf, us, vs FROM features WHERE key = ?',
+                                  (smiles,)).fetchone()
+            if row is not None:
+                n_atom, bond_dim, af, bf, us, vs = row
+                n_bond = len(us) // 4
+                info = {
+                    'af': np.frombuffer(af, dtype=np.int32).reshape([n_atom, -1]),
+                    'bf': np.frombuffer(bf, dtype=np.int32).reshape([n_bond, bond_dim]),
+                    'us': np.frombuffer(us, dtype=np.int32),
+                    'vs': np.frombuffer(vs, dtype=np.int32),
+                }
+                self._remember(smiles, info)
+                self.disk_hits += 1
+        if info is None:
+            self.misses += 1
+            return None
+
+        atom_rank = np.empty_like(atom_order)
+        atom_rank[atom_order] = np.arange(atom_order.shape[0])
+        bond_rank = np.empty_like(bond_order)
+        bond_rank[bond_order] = np.arange(bond_order.shape[0])
+        return {
+            'af': info['af'][atom_rank],
+            'bf': info['bf'][bond_rank],
+            'us': atom_order[info['us'][bond_rank]].astype(np.int32),
+            'vs': atom_order[info['vs'][bond_rank]].astype(np.int32),
+        }
+
+    def put(self, key: CacheKey, info: Dict[str, np.ndarray]):
+        self.put_many([(key, info)])
+
+    def put_many(self, items: List[Tuple[CacheKey, Dict[str, np.ndarray]]]):
+        """
+        :param items: keys and features in the order of each molecule, written in a single transaction
+        """
+        rows = []
+        for (smiles, atom_order, bond_order), info in items:
+            atom_rank = np.empty_like(atom_order)
+            atom_rank[atom_order] = np.arange(atom_order.shape[0])
+            info = {
+                'af': np.ascontiguousarray(info['af'][atom_order], dtype=np.int32),
+                'bf': np.ascontiguousarray(info['bf'][bond_order], dtype=np.int32),
+                'us': atom_rank[info['us'][bond_order]].astype(np.int32),
+                'vs': atom_rank[info['vs'][bond_order]].astype(np.int32),
+            }
+            self._remember(smiles, info)
+            rows.append((smiles, info['af'].shape[0], info['bf'].shape[1], info['af'].tobytes(),
+                         info['bf'].tobytes(), info['us'].tobytes(), info['vs'].tobytes()))
+        if self.db is not None and len(rows):
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO features VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def _remember(self, smiles: str, info: Dict[str, np.ndarray]):
+        self.memory[smiles] = info
+        self.memory.move_to_end(smiles)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        n = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / n if n else 0.,
+            'size': len(self.memory),
+        }
+
+    # the connection is opened again in each process, e.g. after a fork
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None
+        return state
+
+
+_feature_cache = FeatureCache()
+
+
+def get_feature_cache() -> FeatureCache:
+    """
+    the cache shared by the encoders of this process, in memory only unless replaced by `set_feature_cache`
+    """
+    return _feature_cache
+
+
+def set_feature_cache(cache: FeatureCache):
+    global _feature_cache
+    _feature_cache = cache
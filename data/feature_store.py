@@ -0,0 +1,83 @@
+import os
+import shutil
+import numpy as np
+from typing import List, Dict
+
+from .encode import num_atom_features, num_bond_features
+
+FEATURE_KEYS = ['af', 'bf', 'us', 'vs']
+
+
+class FeatureStore:
+    def __init__(self, path: str):
+        """
+        encoded molecules kept as contiguous arrays on disk and opened memory-mapped,
+        indexed like the list returned by `encode_mols`
+        :param path: directory written by `write_feature_store`
+        """
+        self.path = path
+        self._open()
+
+    def _open(self):
+        self.arrays: Dict[str, np.ndarray] = {k: np.load(f'{self.path}/{k}.npy', mmap_mode='r') for k in FEATURE_KEYS}
+        self.atom_offsets = np.load(f'{self.path}/atom_offsets.npy')
+        self.bond_offsets = np.load(f'{self.path}/bond_offsets.npy')
+        self.mask: List[int] = np.load(f'{self.path}/mask.npy').tolist()
+
+    def __len__(self) -> int:
+        return self.atom_offsets.shape[0] - 1
+
+    def __getitem__(self, i: int) -> Dict[str, np.ndarray]:
+        a0, a1 = self.atom_offsets[i], self.atom_offsets[i + 1]
+        b0, b1 = self.bond_offsets[i], self.bond_offsets[i + 1]
+        return {
+            'af': self.arrays['af'][a0: a1],
+            'bf': self.arrays['bf'][b0: b1],
+            'us': self.arrays['us'][b0: b1],
+            'vs': self.arrays['vs'][b0: b1],
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # only the path is pickled (e.g. along with a `BatchCache`), the arrays are mapped again when loaded
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._open()
+
+
+def write_feature_store(path: str, mols_info: List[Dict[str, np.ndarray]], mask: List[int] = None) -> FeatureStore:
+    """
+    :param path: directory to write to, only replaced once all the arrays are written next to it
+    :param mols_info: encoded molecules, as returned by `encode_mols`
+    :param mask: indices of the encoded molecules in the source, as returned by `encode_mols(return_mask=True)`
+    """
+    final_path, path = path, f'{path}.tmp'
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    n_atoms = [info['af'].shape[0] for info in mols_info]
+    n_bonds = [info['bf'].shape[0] for info in mols_info]
+    np.save(f'{path}/atom_offsets.npy', np.concatenate([[0], np.cumsum(n_atoms)]).astype(np.int64))
+    np.save(f'{path}/bond_offsets.npy', np.concatenate([[0], np.cumsum(n_bonds)]).astype(np.int64))
+    np.save(f'{path}/mask.npy', np.array(mask if mask is not None else range(len(mols_info)), dtype=np.int64))
+    if len(mols_info):
+        arrays = {k: np.concatenate([info[k] for info in mols_info]) for k in FEATURE_KEYS}
+    else:
+        # no molecule at all, e.g. none of them valid, whose arrays still have the dimensions of the features
+        arrays = {
+            'af': np.zeros([0, num_atom_features()], dtype=np.int32),
+            'bf': np.zeros([0, num_bond_features()], dtype=np.int32),
+            'us': np.zeros([0], dtype=np.int32),
+            'vs': np.zeros([0], dtype=np.int32),
+        }
+    for k in FEATURE_KEYS:
+        np.save(f'{path}/{k}.npy', arrays[k])
+    if os.path.exists(final_path):
+        shutil.rmtree(final_path)
+    os.replace(path, final_path)
+    return FeatureStore(final_path)
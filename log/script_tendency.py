@@ -9,28 +9,31 @@ def tendency_pc(log: dict, path: str, higher_is_better=False, show_conf=False):
     if 'ps-p11' in path:
         log = log[:200]
     epochs = [dic['epoch'] for dic in log]
+    # the train split may be evaluated only every few epochs, see `TRAIN_EVAL_EVERY`
+    train_log = [dic for dic in log if 'train_loss' in dic.keys()]
+    train_epochs = [dic['epoch'] for dic in train_log]
     fig, ax1 = plt.subplots()
     if 'CVGAE' in path or 'HamEng' in path:
         pass
     else:
-        train_p = [dic['train_p_metric'] for dic in log]
+        train_p = [dic['train_p_metric'] for dic in train_log]
         valid_p = [dic['validate_p_metric'] for dic in log]
         test_p = [dic['test_p_metric'] for dic in log]
         ps = zip(valid_p, test_p)
         ps = sorted(ps, key=lambda x: x[0], reverse=higher_is_better)
         print('{}: {:.4f}'.format(path, ps[0][1]))
 
-        ax1.plot(epochs, train_p, color='red', linestyle='--')
+        ax1.plot(train_epochs, train_p, color='red', linestyle='--')
         ax1.plot(epochs, test_p, color='red')
         # ax1.set_ylim(min(train_p) - 0.2, max(train_p) + 0.2)
 
     if show_conf:
         if ('TOX21' in path or 'sars' in path) and 'RGT' not in path:
-            train_c = [dic['train_loss'] for dic in log]
+            train_c = [dic['train_loss'] for dic in train_log]
             valid_c = [dic['validate_loss'] for dic in log]
             test_c = [dic['test_loss'] for dic in log]
         else:
-            train_c = [dic['train_c_metric'] for dic in log]
+            train_c = [dic['train_c_metric'] for dic in train_log]
             valid_c = [dic['validate_c_metric'] for dic in log]
             test_c = [dic['test_c_metric'] for dic in log]
         ps = zip(valid_c, test_c)
@@ -40,7 +43,7 @@ def tendency_pc(log: dict, path: str, higher_is_better=False, show_conf=False):
         else:
             print('{}: {:.4f} (conf)'.format(path, ps[0][1]))
         ax2 = ax1.twinx()
-        ax2.plot(epochs, train_c, color='green', linestyle='--')
+        ax2.plot(train_epochs, train_c, color='green', linestyle='--')
         ax2.plot(epochs, test_c, color='green')
         # ax2.set_ylim(min(train_c) - 0.1, max(train_c) + 0.1)
 
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
-from torch.nn.utils.rnn import pad_sequence
+
+from net.utils.model_utils import segment_positions, packed_segment_rnn
 
 
 class GraphConvolutionLayer(nn.Module):
@@ -56,11 +57,9 @@ class LstmPQEncoder(nn.Module):
             -> (torch.Tensor, torch.Tensor):
         if self.use_lstm:
             hidden_node_features = self.relu(self.gcl(node_features, e))
-            seqs = [hidden_node_features[n == 1, :] for n in mol_mode_matrix]
-            lengths = [s.shape[0] for s in seqs]
-            m = pad_sequence(seqs)
-            output, _ = self.rnn(m)
-            ret = torch.cat([output[:lengths[i], i, :] for i in range(len(lengths))])
+            mol_index = torch.argmax(mol_mode_matrix, dim=0)
+            position, size = segment_positions(mol_index, mol_mode_matrix.shape[0])
+            ret = packed_segment_rnn(self.rnn, hidden_node_features, mol_index, position, size.cpu())
         else:
             ret = self.gcl(node_features, e)
         if self.disturb:
@@ -1,11 +1,11 @@
 import numpy as np
 import torch
 import torch.nn as nn
-from typing import Tuple
-from torch.nn.utils.rnn import pad_sequence
+from typing import Tuple, Union
 
 from .utils.MaskMatrices import MaskMatrices
-from .utils.model_utils import activation_select
+from .utils.model_utils import activation_select, segment_sum, segment_mean, segment_max, segment_softmax, \
+    segment_to_dense, packed_segment_rnn, IndexAdjacency
 
 
 class MLP(nn.Module):
@@ -52,11 +52,11 @@ class GCN(nn.Module):
         self.layer_act = nn.LeakyReLU()
         self.activate = activation_select(activation)
 
-    def forward(self, x: torch.Tensor, a: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, a: Union[torch.Tensor, IndexAdjacency]) -> torch.Tensor:
         assert x.shape[0] == a.shape[0]
         xs = [x]
         for i, linear in enumerate(self.linears):
-            x2 = a @ linear(x)
+            x2 = a.matmul(linear(x))
             if i < len(self.linears) - 1:
                 x = self.layer_act(x2)
             else:
@@ -75,12 +75,8 @@ class LSTMEncoder(nn.Module):
         self.rnn = nn.LSTM(in_dim, out_dim, layers)
 
     def forward(self, hv_neighbor_ftr: torch.Tensor, mask_matrices: MaskMatrices) -> torch.Tensor:
-        seqs = [hv_neighbor_ftr[n == 1, :] for n in mask_matrices.mol_vertex_w]
-        lengths = [s.shape[0] for s in seqs]
-        m = pad_sequence(seqs)
-        output, _ = self.rnn(m)
-        pq_ftr = torch.cat([output[:lengths[i], i, :] for i in range(len(lengths))])
-        return pq_ftr
+        position, size = mask_matrices.mol_vertex_positions()
+        return packed_segment_rnn(self.rnn, hv_neighbor_ftr, mask_matrices.mol_vertex_index(), position, size)
 
 
 class NaiveDynMessage(nn.Module):
@@ -93,14 +89,13 @@ class NaiveDynMessage(nn.Module):
         self.attend = nn.Linear(hv_dim, mv_dim)
         self.at_act = nn.LeakyReLU()
         self.align = nn.Linear(p_dim + q_dim + he_dim, 1)
-        self.al_act = nn.Softmax(dim=-1)
         self.ag_act = nn.ELU()
         self.link = nn.Linear(hv_dim + p_dim + q_dim + hv_dim, me_dim)
         self.l_act = nn.LeakyReLU()
 
     def forward(self, hv_ftr: torch.Tensor, he_ftr: torch.Tensor, p_ftr: torch.Tensor, q_ftr: torch.Tensor,
                 mask_matrices: MaskMatrices,
-                return_alignment=False) -> Tuple[torch.Tensor, torch.Tensor, np.ndarray]:
+                return_alignment=False) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         naive message passing with dynamic properties
         :param hv_ftr: hidden vertex features with shape [n_vertex, hv_dim]
@@ -112,36 +107,70 @@ class NaiveDynMessage(nn.Module):
         :return: vertex message, edge message, node alignment
         """
         hv_ftr, he_ftr = self.dropout(hv_ftr), self.dropout(he_ftr)
-        n_edge = mask_matrices.vertex_edge_w1.shape[1]
-        vew1 = mask_matrices.vertex_edge_w1  # shape [n_vertex, n_edge]
-        vew2 = mask_matrices.vertex_edge_w2  # shape [n_vertex, n_edge]
-        veb1 = mask_matrices.vertex_edge_b1  # shape [n_vertex, n_edge]
-        veb2 = mask_matrices.vertex_edge_b2  # shape [n_vertex, n_edge]
-        vew_u = torch.cat([vew1, vew2], dim=1)  # shape [n_vertex, 2 * n_edge]
-        vew_v = torch.cat([vew2, vew1], dim=1)  # shape [n_vertex, 2 * n_edge]
-        veb_v = torch.cat([veb2, veb1], dim=1)  # shape [n_vertex, 2 * n_edge]
-        hv_u_ftr = vew_u.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
-        hv_v_ftr = vew_v.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
-        p_u_ftr = vew_u.t() @ p_ftr  # shape [2 * n_edge, p_dim]
-        p_v_ftr = vew_v.t() @ p_ftr  # shape [2 * n_edge, p_dim]
-        q_u_ftr = vew_u.t() @ q_ftr  # shape [2 * n_edge, q_dim]
-        q_v_ftr = vew_v.t() @ q_ftr  # shape [2 * n_edge, q_dim]
-        p_uv_ftr = p_v_ftr - p_u_ftr  # shape [2 * n_edge, p_dim]
-        q_uv_ftr = q_v_ftr - q_u_ftr  # shape [2 * n_edge, q_dim]
+        n_vertex = mask_matrices.n_vertex
+        n_edge = mask_matrices.n_edge
+        u2, v2 = mask_matrices.directed_edges()  # shape [2 * n_edge]
+        if mask_matrices.is_sparse:
+            hv_u_ftr = hv_ftr[u2]  # shape [2 * n_edge, hv_dim]
+            hv_v_ftr = hv_ftr[v2]  # shape [2 * n_edge, hv_dim]
+            p_uv_ftr = p_ftr[v2] - p_ftr[u2]  # shape [2 * n_edge, p_dim]
+            q_uv_ftr = q_ftr[v2] - q_ftr[u2]  # shape [2 * n_edge, q_dim]
+        else:
+            vew1 = mask_matrices.vertex_edge_w1  # shape [n_vertex, n_edge]
+            vew2 = mask_matrices.vertex_edge_w2  # shape [n_vertex, n_edge]
+            vew_u = torch.cat([vew1, vew2], dim=1)  # shape [n_vertex, 2 * n_edge]
+            vew_v = torch.cat([vew2, vew1], dim=1)  # shape [n_vertex, 2 * n_edge]
+            hv_u_ftr = vew_u.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
+            hv_v_ftr = vew_v.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
+            p_u_ftr = vew_u.t() @ p_ftr  # shape [2 * n_edge, p_dim]
+            p_v_ftr = vew_v.t() @ p_ftr  # shape [2 * n_edge, p_dim]
+            q_u_ftr = vew_u.t() @ q_ftr  # shape [2 * n_edge, q_dim]
+            q_v_ftr = vew_v.t() @ q_ftr  # shape [2 * n_edge, q_dim]
+            p_uv_ftr = p_v_ftr - p_u_ftr  # shape [2 * n_edge, p_dim]
+            q_uv_ftr = q_v_ftr - q_u_ftr  # shape [2 * n_edge, q_dim]
         he2_ftr = torch.cat([he_ftr, he_ftr])  # shape [2 * n_edge, he_dim]
 
         attend_ftr = self.attend(hv_v_ftr)  # shape [2 * n_edge, mv_dim]
         attend_ftr = self.at_act(attend_ftr)
         align_ftr = self.align(torch.cat([p_uv_ftr, q_uv_ftr, he2_ftr], dim=1))  # shape [2 * n_edge, 1]
-        align_ftr = vew_v @ torch.diag(torch.reshape(align_ftr, [-1])) + veb_v  # shape [n_vertex, 2 * n_edge]
-        align_ftr = self.al_act(align_ftr)
-        mv_ftr = self.ag_act(align_ftr @ attend_ftr)  # shape [n_vertex, mv_dim]
+        # a vertex without bonds gets no message (ELU(0) = 0), where the dense masked softmax averaged every edge
+        align_ftr = segment_softmax(align_ftr, v2, n_vertex)  # shape [2 * n_edge, 1]
+        mv_ftr = self.ag_act(segment_sum(align_ftr * attend_ftr, v2, n_vertex))  # shape [n_vertex, mv_dim]
+        if return_alignment:
+            align_ftr = segment_to_dense(align_ftr, v2, n_vertex)  # shape [n_vertex, 2 * n_edge]
 
         me2_ftr = self.link(torch.cat([hv_u_ftr, p_uv_ftr, q_uv_ftr, hv_v_ftr], dim=1))  # shape [2 * n_edge, me_dim]
         me_ftr = me2_ftr[:n_edge, :] + me2_ftr[n_edge:, :]  # shape [n_edge, me_dim]
         me_ftr = self.l_act(me_ftr)
 
-        return mv_ftr, me_ftr, align_ftr.cpu().detach().numpy() if return_alignment else None
+        return mv_ftr, me_ftr, align_ftr.detach() if return_alignment else None
+
+
+def triplet_attend(attend: nn.Linear, angle_encode: nn.Linear, at_act: nn.Module,
+                   vd_ftr: torch.Tensor, hv_u_ftr: torch.Tensor, norm_dis_uv: torch.Tensor, triplets: torch.Tensor
+                   ) -> torch.Tensor:
+    """
+    triplet attention evaluated only over bond angles, i.e. pairs of directed edges sharing a begin vertex
+    :param attend: bias-free linear over [vd_1, hv_u, vd_2, angle], split by column blocks so that
+        the per-edge parts are projected once and only the angle part is computed per pair
+    :param angle_encode: encoder of bond angle cosines
+    :param at_act: activation of the attention, must map 0 to the minimum of its range (e.g. ReLU)
+    :param vd_ftr: end vertex and bond features with shape [2 * n_edge, vd_dim]
+    :param hv_u_ftr: begin vertex features with shape [2 * n_edge, hv_dim]
+    :param norm_dis_uv: unit bond vectors with shape [2 * n_edge, q_dim]
+    :param triplets: edge pairs with shape [2, n_triplet]
+    :return: attended edge features with shape [2 * n_edge, mv_dim], max-pooled over the pairs of each edge
+    """
+    e1s, e2s = triplets[0], triplets[1]
+    vd_dim = vd_ftr.shape[1]
+    w1, w2, w3 = torch.split(attend.weight, [vd_dim + hv_u_ftr.shape[1], vd_dim, angle_encode.out_features], dim=1)
+    attend_1 = torch.cat([vd_ftr, hv_u_ftr], dim=1) @ w1.t()  # shape [2 * n_edge, mv_dim]
+    attend_2 = vd_ftr @ w2.t()  # shape [2 * n_edge, mv_dim]
+    angle = torch.sum(norm_dis_uv[e1s] * norm_dis_uv[e2s], dim=1, keepdim=True)  # shape [n_triplet, 1]
+    angle_ftr = torch.tanh(angle_encode(angle))  # shape [n_triplet, angle_dim]
+    attend_ftr = attend_1[e1s] + attend_2[e2s] + angle_ftr @ w3.t()  # shape [n_triplet, mv_dim]
+    attend_ftr = at_act(attend_ftr)
+    return segment_max(attend_ftr, e1s, vd_ftr.shape[0])
 
 
 class TripletAttnDynMessage(nn.Module):
@@ -162,57 +191,52 @@ class TripletAttnDynMessage(nn.Module):
         self.attend = nn.Linear(3 * hv_dim + 2 * self.DIS_DIM + self.ANGLE_DIM, mv_dim, bias=False)
         self.at_act = nn.ReLU()
         self.align = nn.Linear(he_dim, 1)
-        self.al_act = nn.Softmax(dim=-1)
         self.ag_act = nn.ELU()
         self.link = nn.Linear(hv_dim + self.DIS_DIM + hv_dim, me_dim)
         self.l_act = nn.LeakyReLU()
 
     def forward(self, hv_ftr: torch.Tensor, he_ftr: torch.Tensor, p_ftr: torch.Tensor, q_ftr: torch.Tensor,
                 mask_matrices: MaskMatrices,
-                return_alignment=False) -> Tuple[torch.Tensor, torch.Tensor, np.ndarray]:
+                return_alignment=False) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         hv_ftr, he_ftr = self.dropout(hv_ftr), self.dropout(he_ftr)
-        n_edge = mask_matrices.vertex_edge_w1.shape[1]
-        vew1 = mask_matrices.vertex_edge_w1  # shape [n_vertex, n_edge]
-        vew2 = mask_matrices.vertex_edge_w2  # shape [n_vertex, n_edge]
-        veb1 = mask_matrices.vertex_edge_b1  # shape [n_vertex, n_edge]
-        veb2 = mask_matrices.vertex_edge_b2  # shape [n_vertex, n_edge]
-        vew_u = torch.cat([vew1, vew2], dim=1)  # shape [n_vertex, 2 * n_edge]
-        vew_v = torch.cat([vew2, vew1], dim=1)  # shape [n_vertex, 2 * n_edge]
-        veb_v = torch.cat([veb2, veb1], dim=1)  # shape [n_vertex, 2 * n_edge]
+        n_vertex = mask_matrices.n_vertex
+        n_edge = mask_matrices.n_edge
         he2_ftr = torch.cat([he_ftr, he_ftr])  # shape [2 * n_edge, he_dim]
-        ee = vew_u.t() @ vew_u  # shape [2 * n_edge, 2 * n_edge]
-        ee1 = ee.unsqueeze(-1)  # shape [2 * n_edge, 2 * n_edge, 1]
-        hv_v_ftr = vew_v.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
-        hv_u_ftr = vew_u.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
-        q_u_ftr = vew_u.t() @ q_ftr  # shape [2 * n_edge, q_dim]
-        q_v_ftr = vew_v.t() @ q_ftr  # shape [2 * n_edge, q_dim]
-        q_uv_ftr = q_v_ftr - q_u_ftr  # shape [2 * n_edge, q_dim]
+        triplets = mask_matrices.triplet_edges()  # shape [2, n_triplet]
+        u2, v2 = mask_matrices.directed_edges()  # shape [2 * n_edge]
+        if mask_matrices.is_sparse:
+            hv_v_ftr = hv_ftr[v2]  # shape [2 * n_edge, hv_dim]
+            hv_u_ftr = hv_ftr[u2]  # shape [2 * n_edge, hv_dim]
+            q_uv_ftr = q_ftr[v2] - q_ftr[u2]  # shape [2 * n_edge, q_dim]
+        else:
+            vew1 = mask_matrices.vertex_edge_w1  # shape [n_vertex, n_edge]
+            vew2 = mask_matrices.vertex_edge_w2  # shape [n_vertex, n_edge]
+            vew_u = torch.cat([vew1, vew2], dim=1)  # shape [n_vertex, 2 * n_edge]
+            vew_v = torch.cat([vew2, vew1], dim=1)  # shape [n_vertex, 2 * n_edge]
+            hv_v_ftr = vew_v.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
+            hv_u_ftr = vew_u.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
+            q_u_ftr = vew_u.t() @ q_ftr  # shape [2 * n_edge, q_dim]
+            q_v_ftr = vew_v.t() @ q_ftr  # shape [2 * n_edge, q_dim]
+            q_uv_ftr = q_v_ftr - q_u_ftr  # shape [2 * n_edge, q_dim]
         dis_uv = torch.norm(q_uv_ftr, dim=1, keepdim=True) + self.ESP  # shape [2 * n_edge, 1]
         norm_dis_uv = q_uv_ftr / dis_uv  # shape [2 * n_edge, q_dim]
-        angle_ee = norm_dis_uv @ norm_dis_uv.t()  # shape [2 * n_edge, 2 * n_edge]
 
         dis_ftr = torch.tanh(self.dis_encode(self.dis_act(dis_uv)))  # shape [2 * n_edge, dis_dim]
-        angle_ftr = torch.tanh(self.angle_encode(angle_ee.unsqueeze(dim=-1)))  # shape [2 * n_edge, 2 * n_edge, angle_dim]
         vd_ftr = torch.cat([hv_v_ftr, dis_ftr], dim=1)  # shape [2 * n_edge, hv_dim + dis_dim]
-        v1e1ue2v2 = ee1 * torch.cat([
-            torch.cat([vd_ftr, hv_u_ftr], dim=1).repeat([n_edge * 2, 1, 1]).transpose(0, 1),
-            vd_ftr.repeat([n_edge * 2, 1, 1]),
-            angle_ftr
-        ], dim=2)  # shape [2 * n_edge, 2 * n_edge, 3 * hv_dim + 2 * dis_dim + angle_dim]
-
-        attend_ftr = self.attend(v1e1ue2v2)  # shape [2 * n_edge, 2 * n_edge, mv_dim]
-        attend_ftr = self.at_act(attend_ftr)
-        attend_ftr = torch.max(attend_ftr, dim=1)[0]  # shape [2 * n_edge, mv_dim]
+        attend_ftr = triplet_attend(self.attend, self.angle_encode, self.at_act,
+                                    vd_ftr, hv_u_ftr, norm_dis_uv, triplets)  # shape [2 * n_edge, mv_dim]
         align_ftr = self.align(he2_ftr)  # shape [2 * n_edge, 1]
-        align_ftr = vew_v @ torch.diag(torch.reshape(align_ftr, [-1])) + veb_v  # shape [n_vertex, 2 * n_edge]
-        align_ftr = self.al_act(align_ftr)
-        mv_ftr = self.ag_act(align_ftr @ attend_ftr)  # shape [n_vertex, mv_dim]
+        # a vertex without bonds gets no message (ELU(0) = 0), where the dense masked softmax averaged every edge
+        align_ftr = segment_softmax(align_ftr, v2, n_vertex)  # shape [2 * n_edge, 1]
+        mv_ftr = self.ag_act(segment_sum(align_ftr * attend_ftr, v2, n_vertex))  # shape [n_vertex, mv_dim]
+        if return_alignment:
+            align_ftr = segment_to_dense(align_ftr, v2, n_vertex)  # shape [n_vertex, 2 * n_edge]
 
         me2_ftr = self.link(torch.cat([hv_u_ftr, dis_ftr, hv_v_ftr], dim=1))  # shape [2 * n_edge, me_dim]
         me_ftr = me2_ftr[:n_edge, :] + me2_ftr[n_edge:, :]  # shape [n_edge, me_dim]
         me_ftr = self.l_act(me_ftr)
 
-        return mv_ftr, me_ftr, align_ftr.cpu().detach().numpy() if return_alignment else None
+        return mv_ftr, me_ftr, align_ftr.detach() if return_alignment else None
 
 
 class TripletDynMessage(nn.Module):
@@ -238,48 +262,44 @@ class TripletDynMessage(nn.Module):
 
     def forward(self, hv_ftr: torch.Tensor, he_ftr: torch.Tensor, p_ftr: torch.Tensor, q_ftr: torch.Tensor,
                 mask_matrices: MaskMatrices,
-                return_alignment=False) -> Tuple[torch.Tensor, torch.Tensor, np.ndarray]:
+                return_alignment=False) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         hv_ftr, he_ftr = self.dropout(hv_ftr), self.dropout(he_ftr)
-        n_edge = mask_matrices.vertex_edge_w1.shape[1]
-        vew1 = mask_matrices.vertex_edge_w1  # shape [n_vertex, n_edge]
-        vew2 = mask_matrices.vertex_edge_w2  # shape [n_vertex, n_edge]
-        veb1 = mask_matrices.vertex_edge_b1  # shape [n_vertex, n_edge]
-        veb2 = mask_matrices.vertex_edge_b2  # shape [n_vertex, n_edge]
-        vew_u = torch.cat([vew1, vew2], dim=1)  # shape [n_vertex, 2 * n_edge]
-        vew_v = torch.cat([vew2, vew1], dim=1)  # shape [n_vertex, 2 * n_edge]
-        veb_v = torch.cat([veb2, veb1], dim=1)  # shape [n_vertex, 2 * n_edge]
+        n_vertex = mask_matrices.n_vertex
+        n_edge = mask_matrices.n_edge
         he2_ftr = torch.cat([he_ftr, he_ftr])  # shape [2 * n_edge, he_dim]
-        ee = vew_u.t() @ vew_u  # shape [2 * n_edge, 2 * n_edge]
-        ee1 = ee.unsqueeze(-1)  # shape [2 * n_edge, 2 * n_edge, 1]
-        hv_v_ftr = vew_v.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
-        hv_u_ftr = vew_u.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
-        q_u_ftr = vew_u.t() @ q_ftr  # shape [2 * n_edge, q_dim]
-        q_v_ftr = vew_v.t() @ q_ftr  # shape [2 * n_edge, q_dim]
-        q_uv_ftr = q_v_ftr - q_u_ftr  # shape [2 * n_edge, q_dim]
+        triplets = mask_matrices.triplet_edges()  # shape [2, n_triplet]
+        u2, v2 = mask_matrices.directed_edges()  # shape [2 * n_edge]
+        if mask_matrices.is_sparse:
+            hv_v_ftr = hv_ftr[v2]  # shape [2 * n_edge, hv_dim]
+            hv_u_ftr = hv_ftr[u2]  # shape [2 * n_edge, hv_dim]
+            q_uv_ftr = q_ftr[v2] - q_ftr[u2]  # shape [2 * n_edge, q_dim]
+        else:
+            vew1 = mask_matrices.vertex_edge_w1  # shape [n_vertex, n_edge]
+            vew2 = mask_matrices.vertex_edge_w2  # shape [n_vertex, n_edge]
+            vew_u = torch.cat([vew1, vew2], dim=1)  # shape [n_vertex, 2 * n_edge]
+            vew_v = torch.cat([vew2, vew1], dim=1)  # shape [n_vertex, 2 * n_edge]
+            hv_v_ftr = vew_v.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
+            hv_u_ftr = vew_u.t() @ hv_ftr  # shape [2 * n_edge, hv_dim]
+            q_u_ftr = vew_u.t() @ q_ftr  # shape [2 * n_edge, q_dim]
+            q_v_ftr = vew_v.t() @ q_ftr  # shape [2 * n_edge, q_dim]
+            q_uv_ftr = q_v_ftr - q_u_ftr  # shape [2 * n_edge, q_dim]
         dis_uv = torch.norm(q_uv_ftr, dim=1, keepdim=True) + self.ESP  # shape [2 * n_edge, 1]
         norm_dis_uv = q_uv_ftr / dis_uv  # shape [2 * n_edge, q_dim]
-        angle_ee = norm_dis_uv @ norm_dis_uv.t()  # shape [2 * n_edge, 2 * n_edge]
 
         dis_ftr = torch.tanh(self.dis_encode(self.dis_act(dis_uv)))  # shape [2 * n_edge, dis_dim]
-        angle_ftr = torch.tanh(self.angle_encode(angle_ee.unsqueeze(dim=-1)))  # shape [2 * n_edge, 2 * n_edge, angle_dim]
         vd_ftr = torch.cat([hv_v_ftr, he2_ftr, dis_ftr], dim=1)  # shape [2 * n_edge, hv_dim + he_dim + dis_dim]
-        v1e1ue2v2 = ee1 * torch.cat([
-            torch.cat([vd_ftr, hv_u_ftr], dim=1).repeat([n_edge * 2, 1, 1]).transpose(0, 1),
-            vd_ftr.repeat([n_edge * 2, 1, 1]),
-            angle_ftr
-        ], dim=2)  # shape [2 * n_edge, 2 * n_edge, 3 * hv_dim + 2 * he_dim + 2 * dis_dim + angle_dim]
-
-        attend_ftr = self.attend(v1e1ue2v2)  # shape [2 * n_edge, 2 * n_edge, mv_dim]
-        attend_ftr = self.at_act(attend_ftr)
-        attend_ftr = torch.max(attend_ftr, dim=1)[0]  # shape [2 * n_edge, mv_dim]
-        align_ftr = vew_v / (vew_v.sum(dim=1, keepdim=True) + self.ESP)  # shape [n_vertex, 2 * n_edge]
-        mv_ftr = self.ag_act(align_ftr @ attend_ftr)  # shape [n_vertex, mv_dim]
+        attend_ftr = triplet_attend(self.attend, self.angle_encode, self.at_act,
+                                    vd_ftr, hv_u_ftr, norm_dis_uv, triplets)  # shape [2 * n_edge, mv_dim]
+        mv_ftr = self.ag_act(segment_mean(attend_ftr, v2, n_vertex, self.ESP))  # shape [n_vertex, mv_dim]
+        if return_alignment:
+            align_ftr = segment_to_dense(torch.ones_like(v2, dtype=attend_ftr.dtype), v2, n_vertex)
+            align_ftr = align_ftr / (align_ftr.sum(dim=1, keepdim=True) + self.ESP)  # shape [n_vertex, 2 * n_edge]
 
         me2_ftr = self.link(torch.cat([hv_u_ftr, he2_ftr, dis_ftr, hv_v_ftr], dim=1))  # shape [2 * n_edge, me_dim]
         me_ftr = me2_ftr[:n_edge, :] + me2_ftr[n_edge:, :]  # shape [n_edge, me_dim]
         me_ftr = self.l_act(me_ftr)
 
-        return mv_ftr, me_ftr, align_ftr.cpu().detach().numpy() if return_alignment else None
+        return mv_ftr, me_ftr, align_ftr.detach() if return_alignment else None
 
 
 class NaiveUnion(nn.Module):
@@ -318,12 +338,11 @@ class GlobalReadout(nn.Module):
         self.attend = nn.Linear(hv_dim, mm_dim)
         self.at_act = nn.LeakyReLU()
         self.align = nn.Linear(hm_dim + hv_dim, 1)
-        self.al_act = nn.Softmax(dim=-1)
         self.ag_act = nn.ELU()
 
     def forward(self, hm_ftr: torch.Tensor, hv_ftr: torch.Tensor,
                 mask_matrices: MaskMatrices,
-                return_alignment=False) -> Tuple[torch.Tensor, np.ndarray]:
+                return_alignment=False) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         molecule message readout with global attention and dynamic properties
         :param hm_ftr: molecule features with shape [n_mol, hm_dim]
@@ -332,18 +351,18 @@ class GlobalReadout(nn.Module):
         :param return_alignment: if returns node alignment
         :return: molecule message
         """
-        mvw = mask_matrices.mol_vertex_w  # shape [n_mol, n_vertex]
-        mvb = mask_matrices.mol_vertex_b  # shape [n_mol, n_vertex]
-        hm_v_ftr = mvw.t() @ hm_ftr  # shape [n_vertex, hm_dim]
+        mol_index, n_mol = mask_matrices.mol_vertex_index(), mask_matrices.n_mol
+        hm_v_ftr = hm_ftr[mol_index]  # shape [n_vertex, hm_dim]
 
         attend_ftr = self.attend(self.dropout(hv_ftr))  # shape [n_vertex, mm_dim]
         attend_ftr = self.at_act(attend_ftr)
         align_ftr = self.align(self.dropout(torch.cat([hm_v_ftr, hv_ftr], dim=1)))  # shape [n_vertex, 1]
-        align_ftr = mvw @ torch.diag(torch.reshape(align_ftr, [-1])) + mvb  # shape [n_mol, n_vertex]
-        align_ftr = self.al_act(align_ftr)
-        mm_ftr = self.ag_act(align_ftr @ attend_ftr)  # shape [n_mol, mm_dim]
+        align_ftr = segment_softmax(align_ftr, mol_index, n_mol)  # shape [n_vertex, 1]
+        mm_ftr = self.ag_act(segment_sum(align_ftr * attend_ftr, mol_index, n_mol))  # shape [n_mol, mm_dim]
+        if return_alignment:
+            align_ftr = segment_to_dense(align_ftr, mol_index, n_mol)  # shape [n_mol, n_vertex]
 
-        return mm_ftr, align_ftr.cpu().detach().numpy() if return_alignment else None
+        return mm_ftr, align_ftr.detach() if return_alignment else None
 
 
 class GlobalDynReadout(nn.Module):
@@ -356,7 +375,6 @@ class GlobalDynReadout(nn.Module):
         self.attend = nn.Linear(p_dim + q_dim + hv_dim, mm_dim)
         self.at_act = nn.LeakyReLU()
         self.align = nn.Linear(hm_dim + hv_dim, 1)
-        self.al_act = nn.Softmax(dim=-1)
         self.ag_act = nn.ELU()
 
     def forward(self, hm_ftr: torch.Tensor, hv_ftr: torch.Tensor, p_ftr: torch.Tensor, q_ftr: torch.Tensor,
@@ -372,15 +390,13 @@ class GlobalDynReadout(nn.Module):
         :return: molecule message
         """
         hm_ftr, hv_ftr = self.dropout(hm_ftr), self.dropout(hv_ftr)
-        mvw = mask_matrices.mol_vertex_w  # shape [n_mol, n_vertex]
-        mvb = mask_matrices.mol_vertex_b  # shape [n_mol, n_vertex]
-        hm_v_ftr = mvw.t() @ hm_ftr  # shape [n_vertex, hm_dim]
+        mol_index, n_mol = mask_matrices.mol_vertex_index(), mask_matrices.n_mol
+        hm_v_ftr = hm_ftr[mol_index]  # shape [n_vertex, hm_dim]
 
         attend_ftr = self.attend(torch.cat([p_ftr, q_ftr, hv_ftr], dim=1))  # shape [n_vertex, mm_dim]
         attend_ftr = self.at_act(attend_ftr)
         align_ftr = self.align(torch.cat([hm_v_ftr, hv_ftr], dim=1))  # shape [n_vertex, 1]
-        align_ftr = mvw @ torch.diag(torch.reshape(align_ftr, [-1])) + mvb  # shape [n_mol, n_vertex]
-        align_ftr = self.al_act(align_ftr)
-        mm_ftr = self.ag_act(align_ftr @ attend_ftr)  # shape [n_mol, mm_dim]
+        align_ftr = segment_softmax(align_ftr, mol_index, n_mol)  # shape [n_vertex, 1]
+        mm_ftr = self.ag_act(segment_sum(align_ftr * attend_ftr, mol_index, n_mol))  # shape [n_mol, mm_dim]
 
         return mm_ftr
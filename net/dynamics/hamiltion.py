@@ -4,6 +4,7 @@ import torch.autograd as autograd
 from typing import Union, Tuple
 
 from net.utils.MaskMatrices import MaskMatrices
+from net.utils.model_utils import segment_sum
 
 
 class KineticEnergy(nn.Module):
@@ -19,8 +20,7 @@ class KineticEnergy(nn.Module):
         pw = self.W(vp)
         pw = self.dropout(self.softplus(pw))
         apwwp = alpha * (pw ** 2)
-        if torch.isnan(apwwp.sum()):
-            apwwp[torch.isnan(apwwp)] = 0
+        apwwp = torch.where(torch.isnan(apwwp), torch.zeros_like(apwwp), apwwp)
         t = torch.sum(apwwp, dim=1, keepdim=True)
         return t
 
@@ -33,22 +33,21 @@ class PotentialEnergy(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.softplus = nn.Softplus()
 
-    def forward(self, v, q, m, vvm):
-        norm_m = m
-        mm = norm_m * norm_m.reshape([1, -1])
-        eye = torch.eye(vvm.shape[1], dtype=torch.float32)
-        if self.use_cuda:
-            eye = eye.cuda()
-        mask = vvm * mm
+    def forward(self, v, q, m, pairs):
+        """
+        :param pairs: pairs of distinct vertices in the same molecule with shape [2, n_pair],
+            pairs across molecules and on the diagonal carry no energy
+        """
+        vs1, vs2 = pairs[0], pairs[1]
+        mask = m[vs1] * m[vs2]  # shape [n_pair, 1]
         vq = torch.cat([v, q], dim=1)
-        delta_vq = torch.unsqueeze(vq, dim=0) - torch.unsqueeze(vq, dim=1)
+        delta_vq = vq[vs2] - vq[vs1]  # shape [n_pair, v_dim + q_dim]
         root = self.linear1(delta_vq)
         root = self.dropout(root)
-        distance = (self.softplus(torch.sum(root ** 2, dim=2))) * (-eye + 1) + eye
+        distance = self.softplus(torch.sum(root ** 2, dim=1, keepdim=True))
         energy = mask * (distance ** -2 - distance ** -1)
-        if torch.isnan(energy.sum()):
-            energy[torch.isnan(energy)] = 0
-        p = torch.sum(energy, dim=1, keepdim=True)
+        energy = torch.where(torch.isnan(energy), torch.zeros_like(energy), energy)
+        p = segment_sum(energy, vs1, vq.shape[0])
         return p
 
 
@@ -64,8 +63,7 @@ class DissipatedEnergy(nn.Module):
         pw = self.W(p)
         pw = self.dropout(self.softplus(pw))
         a2pwwp = alpha2 * (pw ** 2)
-        if torch.isnan(a2pwwp.sum()):
-            a2pwwp[torch.isnan(a2pwwp)] = 0
+        a2pwwp = torch.where(torch.isnan(a2pwwp), torch.zeros_like(a2pwwp), a2pwwp)
         f = torch.sum(a2pwwp, dim=1, keepdim=True)
         return f
 
@@ -83,10 +81,9 @@ class DissipativeHamiltonianDerivation(nn.Module):
                 return_energy=False, dissipate=True
                 ) -> Union[Tuple[torch.Tensor, torch.Tensor],
                            Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]]:
-        mvw = mask_matrices.mol_vertex_w
-        vvm = mvw.t() @ mvw
+        pairs = mask_matrices.mol_vertex_pairs()
         v, e = torch.sigmoid(v), torch.sigmoid(e)
-        hamiltonians = self.T(v, p, m) + self.U(v, q, m, vvm)
+        hamiltonians = self.T(v, p, m) + self.U(v, q, m, pairs)
         dissipations = self.F(p, m)
         hamilton = hamiltonians.sum()
         dissipated = dissipations.sum()
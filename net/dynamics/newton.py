@@ -3,6 +3,7 @@ import torch.nn as nn
 from typing import Tuple
 
 from net.utils.MaskMatrices import MaskMatrices
+from net.utils.model_utils import segment_sum
 
 
 class Force(nn.Module):
@@ -23,32 +24,41 @@ class Force(nn.Module):
     def forward(self, v: torch.Tensor, e: torch.Tensor, m: torch.Tensor, q: torch.Tensor,
                 mask_matrices: MaskMatrices) -> torch.Tensor:
         # bond force
-        vew1 = mask_matrices.vertex_edge_w1  # shape [n_vertex, n_edge]
-        vew2 = mask_matrices.vertex_edge_w2  # shape [n_vertex, n_edge]
-        vew_u = torch.cat([vew1, vew2], dim=1)  # shape [n_vertex, 2 * n_edge]
-        vew_v = torch.cat([vew2, vew1], dim=1)  # shape [n_vertex, 2 * n_edge]
         e2 = torch.cat([e, e])  # shape [2 * n_edge, e_dim]
-        uv_e = torch.cat([(vew_u + vew_v).t() @ v, e2], dim=1)
-        delta_q = vew_u.t() @ q - vew_v.t() @ q
+        if mask_matrices.is_sparse:
+            u2, v2 = mask_matrices.directed_edges()  # shape [2 * n_edge]
+            uv_e = torch.cat([v[u2] + v[v2], e2], dim=1)
+            delta_q = q[u2] - q[v2]
+        else:
+            vew1 = mask_matrices.vertex_edge_w1  # shape [n_vertex, n_edge]
+            vew2 = mask_matrices.vertex_edge_w2  # shape [n_vertex, n_edge]
+            vew_u = torch.cat([vew1, vew2], dim=1)  # shape [n_vertex, 2 * n_edge]
+            vew_v = torch.cat([vew2, vew1], dim=1)  # shape [n_vertex, 2 * n_edge]
+            uv_e = torch.cat([(vew_u + vew_v).t() @ v, e2], dim=1)
+            delta_q = vew_u.t() @ q - vew_v.t() @ q
         unit_f_bond = delta_q / (torch.norm(delta_q, dim=1, keepdim=True) + self.ESP)
         value_f_bond = self.fb_tanh(self.fb_linear2(self.fb_relu(self.fb_linear1(uv_e))))
-        f_bond = vew_u @ (unit_f_bond * value_f_bond)
+        if mask_matrices.is_sparse:
+            f_bond = segment_sum(unit_f_bond * value_f_bond, u2, mask_matrices.n_vertex)
+        else:
+            f_bond = vew_u @ (unit_f_bond * value_f_bond)
 
-        # relative force
-        mvw = mask_matrices.mol_vertex_w
-        vvm = mvw.t() @ mvw
-        mm = m * m.reshape([1, -1])
-        vv_massive_mask = vvm * mm
-        delta_q = torch.unsqueeze(q, dim=1) - torch.unsqueeze(q, dim=0)
-        delta_d = self.fr_relu(self.fr_linear(delta_q)).norm(dim=2)
-        unit_f_rela = delta_q / (torch.norm(delta_q, dim=2, keepdim=True) + self.ESP)
-        value_f_rela = self.fr_tanh((delta_d ** -2 - delta_d ** -1) * vv_massive_mask).unsqueeze(2)
-        f_rela = (unit_f_rela * value_f_rela).sum(dim=1)
+        # relative force, only between distinct atoms of the same molecule
+        pairs = mask_matrices.mol_vertex_pairs()  # shape [2, n_pair]
+        vs1, vs2 = pairs[0], pairs[1]
+        massive_mask = m[vs1] * m[vs2]  # shape [n_pair, 1]
+        delta_q = q[vs1] - q[vs2]  # shape [n_pair, q_dim]
+        delta_d = self.fr_relu(self.fr_linear(delta_q)).norm(dim=1, keepdim=True)
+        unit_f_rela = delta_q / (torch.norm(delta_q, dim=1, keepdim=True) + self.ESP)
+        value_f_rela = self.fr_tanh((delta_d ** -2 - delta_d ** -1) * massive_mask)
+        f_rela = segment_sum(unit_f_rela * value_f_rela, vs1, q.shape[0])
 
         f = f_bond + f_rela
-        single_mask = vew_u.sum(dim=1) == 0
-        f[single_mask] = f[single_mask].detach()
-        return f
+        if mask_matrices.is_sparse:
+            single_mask = segment_sum(torch.ones_like(u2), u2, mask_matrices.n_vertex) == 0
+        else:
+            single_mask = vew_u.sum(dim=1) == 0
+        return torch.where(single_mask.unsqueeze(-1), f.detach(), f)
 
 
 class NewtonianDerivation(nn.Module):
@@ -1,7 +1,7 @@
 from .components import *
 from .dynamics.newton import NewtonianDerivation
 from .dynamics.hamiltion import DissipativeHamiltonianDerivation
-from .utils.model_utils import normalize_adj_r
+from .utils.model_utils import normalize_adj_r, index_adjacency
 from typing import Union, List
 
 
@@ -35,18 +35,21 @@ class Initializer(nn.Module):
         Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
         Tuple[torch.Tensor, torch.Tensor, None, None]
     ]:
-        vew1 = mask_matrices.vertex_edge_w1
-        vew2 = mask_matrices.vertex_edge_w2
-
         hv_ftr = self.v_act(self.v_linear(atom_ftr))
         he_ftr = self.e_act(self.e_linear(bond_ftr))
         if pq_none:
             return hv_ftr, he_ftr, None, None
 
         a = self.a_act(self.a_linear(he_ftr))
-        adj_d = vew1 @ torch.diag(torch.reshape(a, [-1])) @ vew2.t()
-        adj = adj_d + adj_d.t()
-        norm_adj = normalize_adj_r(adj)
+        if mask_matrices.is_sparse:
+            norm_adj = index_adjacency(mask_matrices.us, mask_matrices.vs, torch.reshape(a, [-1]),
+                                       mask_matrices.n_vertex)
+        else:
+            vew1 = mask_matrices.vertex_edge_w1
+            vew2 = mask_matrices.vertex_edge_w2
+            adj_d = (vew1 * torch.reshape(a, [1, -1])) @ vew2.t()
+            adj = adj_d + adj_d.t()
+            norm_adj = normalize_adj_r(adj)
         hv_neighbor_ftr = self.gcn(hv_ftr, norm_adj)
         if self.remap:
             pq_ftr = self.lstm_remap(self.lstm_act(self.lstm_encoder(hv_neighbor_ftr, mask_matrices)))
@@ -96,7 +99,7 @@ class ConfAwareMPNNKernel(nn.Module):
 
     def forward(self, hv_ftr: torch.Tensor, he_ftr: torch.Tensor, p_ftr: torch.Tensor, q_ftr: torch.Tensor,
                 mask_matrices: MaskMatrices,
-                return_alignment=False) -> Tuple[torch.Tensor, torch.Tensor, List[np.ndarray]]:
+                return_alignment=False) -> Tuple[torch.Tensor, torch.Tensor, List[torch.Tensor]]:
         alignments = []
         for i in range(self.hops):
             mv_ftr, me_ftr, alignment = self.messages[i].forward(hv_ftr, he_ftr, p_ftr, q_ftr,
@@ -127,7 +130,10 @@ class InformedDerivationKernel(nn.Module):
     def forward(self, hv_ftr: torch.Tensor, he_ftr: torch.Tensor,
                 massive: torch.Tensor, p_ftr: torch.Tensor, q_ftr: torch.Tensor, mask_matrices: MaskMatrices
                 ) -> Tuple[torch.Tensor, torch.Tensor]:
-        dp, dq = self.derivation(hv_ftr, he_ftr, massive, p_ftr, q_ftr, mask_matrices)
+        # the dynamics are numerically sensitive, so they stay in float32 under mixed precision
+        with torch.autocast(device_type=p_ftr.device.type, enabled=False):
+            dp, dq = self.derivation(hv_ftr.float(), he_ftr.float(), massive, p_ftr.float(), q_ftr.float(),
+                                     mask_matrices)
         p_ftr = p_ftr + dp * self.tau
         q_ftr = q_ftr + dq * self.tau
         return p_ftr, q_ftr
@@ -151,11 +157,10 @@ class FingerprintGenerator(nn.Module):
 
     def forward(self, hv_ftr: torch.Tensor,
                 mask_matrices: MaskMatrices,
-                return_alignment=False) -> Tuple[torch.Tensor, List[np.ndarray]]:
+                return_alignment=False) -> Tuple[torch.Tensor, List[torch.Tensor]]:
         # initialize molecule features with mean of vertex features
-        mvw = mask_matrices.mol_vertex_w
-        norm_mvw = mvw / torch.sum(mvw, dim=-1, keepdim=True)
-        hm_ftr = norm_mvw @ self.vm_act(self.vertex2mol(hv_ftr))
+        hm_ftr = segment_mean(self.vm_act(self.vertex2mol(hv_ftr)), mask_matrices.mol_vertex_index(),
+                              mask_matrices.n_mol)
 
         # iterate
         alignments = []
@@ -181,11 +186,10 @@ class RecFingerprintGenerator(nn.Module):
 
     def forward(self, hv_ftr: torch.Tensor,
                 mask_matrices: MaskMatrices,
-                return_alignment=False) -> Tuple[torch.Tensor, List[np.ndarray]]:
+                return_alignment=False) -> Tuple[torch.Tensor, List[torch.Tensor]]:
         # initialize molecule features with mean of vertex features
-        mvw = mask_matrices.mol_vertex_w
-        norm_mvw = mvw / torch.sum(mvw, dim=-1, keepdim=True)
-        hm_ftr = norm_mvw @ self.vm_act(self.vertex2mol(hv_ftr))
+        hm_ftr = segment_mean(self.vm_act(self.vertex2mol(hv_ftr)), mask_matrices.mol_vertex_index(),
+                              mask_matrices.n_mol)
 
         # iterate
         alignments = []
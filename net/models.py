@@ -1,5 +1,7 @@
 from .layers import *
 from net.config import ConfType
+from net.utils.MaskMatrices import sparse_copy
+from net.utils.model_utils import to_numpy
 
 
 class GeomNN(nn.Module):
@@ -24,6 +26,8 @@ class GeomNN(nn.Module):
         tau = config['TAU']
         self.dissa = config['DISSA']
         dropout = config['DROPOUT']
+        self.sparse = config['SPARSE']
+        self.need_triplets = message_type != 'naive'
         self.use_cuda = use_cuda
 
         self.conf_type = config['CONF_TYPE']
@@ -91,25 +95,27 @@ class GeomNN(nn.Module):
         if q_dim != 3:
             self.conformation_gen = MLP(q_dim, 3, use_cuda=use_cuda)
         else:
-            self.conformation_gen = lambda x: x
+            self.conformation_gen = nn.Identity()
 
     def forward(self, atom_ftr: torch.Tensor, bond_ftr: torch.Tensor, massive: torch.Tensor,
                 mask_matrices: MaskMatrices,
                 given_q_ftr: torch.Tensor = None,
-                return_local_alignment=False, return_global_alignment=False, return_derive=False
+                return_local_alignment=False, return_global_alignment=False, return_derive=False,
+                return_he_ftr=False
                 ) -> Tuple[torch.Tensor, List[torch.Tensor],
                            List[List[np.ndarray]], List[np.ndarray], List[np.ndarray],
                            List[np.ndarray], List[np.ndarray]]:
+        """
+        the diagnostics asked for by `return_*` are captured as device tensors during the pass
+        and copied to the host only once it is over; nothing is captured by default
+        """
+        mask_matrices = self.prepare_mask_matrices(mask_matrices)
         hv_ftr, he_ftr, p_ftr, q_ftr = self.initializer.forward(atom_ftr, bond_ftr, mask_matrices, not self.need_derive)
 
         if self.conf_type in [ConfType.NONE, ConfType.SINGLE_CHANNEL]:
-            p_ftr = q_ftr = torch.zeros(size=[atom_ftr.shape[0], 3], dtype=torch.float32)
-            if self.use_cuda:
-                p_ftr, q_ftr = p_ftr.cuda(), q_ftr.cuda()
+            p_ftr = q_ftr = atom_ftr.new_zeros([atom_ftr.shape[0], 3])
         elif self.conf_type in [ConfType.RDKIT, ConfType.REAL]:
-            p_ftr, q_ftr = torch.zeros(size=[atom_ftr.shape[0], 3], dtype=torch.float32), given_q_ftr
-            if self.use_cuda:
-                p_ftr = p_ftr.cuda()
+            p_ftr, q_ftr = given_q_ftr.new_zeros([given_q_ftr.shape[0], 3]), given_q_ftr
 
         conformations = [self.conformation_gen(q_ftr)]
         list_alignments = []
@@ -117,35 +123,63 @@ class GeomNN(nn.Module):
         list_p_ftr = []
         list_q_ftr = []
         if return_derive:
-            list_p_ftr.append(self.decentralized_p_ftr(p_ftr, massive, mask_matrices).cpu().detach().numpy())
-            list_q_ftr.append(q_ftr.cpu().detach().numpy())
+            list_p_ftr.append(self.decentralized_p_ftr(p_ftr, massive, mask_matrices).detach())
+            list_q_ftr.append(q_ftr.detach())
         for i in range(self.n_layer):
             t_p_ftr, t_q_ftr = p_ftr, q_ftr
             if self.need_derive:
                 for j in range(self.n_iteration):
                     p_ftr, q_ftr = self.drv_kernel.forward(hv_ftr, he_ftr, massive, p_ftr, q_ftr, mask_matrices)
                     if self.dissa < 1.0 - 1e-5:
-                        p_ftr *= self.dissa
+                        p_ftr = p_ftr * self.dissa
                     conformations.append(self.conformation_gen(q_ftr))
                     if return_derive:
-                        list_p_ftr.append(
-                            self.decentralized_p_ftr(p_ftr, massive, mask_matrices).cpu().detach().numpy())
-                        list_q_ftr.append(q_ftr.cpu().detach().numpy())
+                        list_p_ftr.append(self.decentralized_p_ftr(p_ftr, massive, mask_matrices).detach())
+                        list_q_ftr.append(q_ftr.detach())
 
             if self.need_mp:
                 hv_ftr, he_ftr, alignments = self.mp_kernel.forward(hv_ftr, he_ftr, t_p_ftr, t_q_ftr,
                                                                     mask_matrices, return_local_alignment)
                 list_alignments.append(alignments)
-            list_he_ftr.append(he_ftr.cpu().detach().numpy())
+            if return_he_ftr:
+                list_he_ftr.append(he_ftr.detach())
 
         fingerprint, global_alignments = self.fingerprint_gen.forward(hv_ftr, mask_matrices, return_global_alignment)
         if self.conf_type == ConfType.SINGLE_CHANNEL:
             q_ftr = self.conformation_encode(hv_ftr)
         conformations.append(self.conformation_gen(q_ftr))
+
+        list_alignments = [[to_numpy(a) for a in alignments] for alignments in list_alignments]
+        global_alignments = [to_numpy(a) for a in global_alignments]
+        list_he_ftr = [to_numpy(he) for he in list_he_ftr]
+        list_p_ftr = [to_numpy(p) for p in list_p_ftr]
+        list_q_ftr = [to_numpy(q) for q in list_q_ftr]
         return fingerprint, conformations, list_alignments, global_alignments, list_he_ftr, list_p_ftr, list_q_ftr
 
+    @torch.compiler.disable
+    def prepare_mask_matrices(self, mask_matrices: MaskMatrices) -> MaskMatrices:
+        """
+        derive the index vectors and enumerate the vertex pairs, positions and edge triplets this configuration
+        needs before switching to the index representation, so that they stay cached on the batch;
+        their number depends on the batch data, so this runs outside of any compiled graph
+        """
+        mask_matrices.mol_vertex_index()
+        mask_matrices.directed_edges()
+        if self.need_derive:
+            mask_matrices.mol_vertex_pairs()
+            mask_matrices.mol_vertex_positions()
+        if self.need_mp and self.need_triplets:
+            mask_matrices.triplet_edges()
+        if self.sparse:
+            mask_matrices = sparse_copy(mask_matrices)
+        return mask_matrices
+
     @staticmethod
     def decentralized_p_ftr(p_ftr: torch.Tensor, massive: torch.Tensor, mask_matrices: MaskMatrices) -> torch.Tensor:
+        if mask_matrices.is_sparse:
+            mol_index, n_mol = mask_matrices.mol_index, mask_matrices.n_mol
+            mv = segment_sum(p_ftr, mol_index, n_mol) / segment_sum(massive, mol_index, n_mol)
+            return p_ftr - mv[mol_index] * massive
         mvw = mask_matrices.mol_vertex_w
         mp = mvw @ p_ftr
         mm = mvw @ massive
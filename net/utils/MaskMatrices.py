@@ -1,10 +1,48 @@
 import torch
+from typing import Tuple, Dict
+
+from .model_utils import segment_positions
 
 
 class MaskMatrices:
-    def __init__(self, mol_vertex_w: torch.Tensor, mol_vertex_b: torch.Tensor,
-                 vertex_edge_w1: torch.Tensor, vertex_edge_w2: torch.Tensor,
-                 vertex_edge_b1: torch.Tensor, vertex_edge_b2: torch.Tensor):
+    # class-level defaults keep batches pickled before the index vectors existed loadable
+    mol_index = None
+    us = None
+    vs = None
+    triplets = None
+    mol_pairs = None
+    adj_pairs = None
+    positions = None
+    _n_mol = None
+
+    def __init__(self, mol_vertex_w: torch.Tensor = None, mol_vertex_b: torch.Tensor = None,
+                 vertex_edge_w1: torch.Tensor = None, vertex_edge_w2: torch.Tensor = None,
+                 vertex_edge_b1: torch.Tensor = None, vertex_edge_b2: torch.Tensor = None,
+                 mol_index: torch.Tensor = None, us: torch.Tensor = None, vs: torch.Tensor = None,
+                 n_mol: int = None, triplets: torch.Tensor = None, mol_pairs: torch.Tensor = None,
+                 adj_pairs: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = None,
+                 positions: Tuple[torch.Tensor, torch.Tensor] = None):
+        """
+        masks of a batch of molecules, either as dense matrices or as index vectors (or both)
+        :param mol_vertex_w: dense molecule-vertex mask with shape [n_mol, n_vertex]
+        :param mol_vertex_b: dense molecule-vertex bias (0 / -1e6) with shape [n_mol, n_vertex]
+        :param vertex_edge_w1: dense vertex-edge mask of bond begin atoms with shape [n_vertex, n_edge]
+        :param vertex_edge_w2: dense vertex-edge mask of bond end atoms with shape [n_vertex, n_edge]
+        :param vertex_edge_b1: dense vertex-edge bias of bond begin atoms with shape [n_vertex, n_edge]
+        :param vertex_edge_b2: dense vertex-edge bias of bond end atoms with shape [n_vertex, n_edge]
+        :param mol_index: molecule index of each vertex with shape [n_vertex]
+        :param us: begin vertex index of each edge with shape [n_edge]
+        :param vs: end vertex index of each edge with shape [n_edge]
+        :param n_mol: number of molecules
+        :param triplets: pairs of directed edges sharing a begin vertex with shape [2, n_triplet],
+            see `produce_triplets`
+        :param mol_pairs: pairs of distinct vertices in the same molecule with shape [2, n_pair],
+            see `produce_mol_pairs`
+        :param adj_pairs: structural hop-masks keyed by mode, each as vertex pairs with shape [2, n_pair]
+            and their weights with shape [n_pair], see `train.utils.loss_functions.generate_adj_pairs`
+        :param positions: position of each vertex in its molecule with shape [n_vertex],
+            and the number of vertices of each molecule with shape [n_mol] on the host
+        """
         self.mol_vertex_w = mol_vertex_w
         self.mol_vertex_b = mol_vertex_b
         self.vertex_edge_w1 = vertex_edge_w1
@@ -12,13 +50,153 @@ class MaskMatrices:
         self.vertex_edge_b1 = vertex_edge_b1
         self.vertex_edge_b2 = vertex_edge_b2
 
+        self.mol_index = mol_index
+        self.us = us
+        self.vs = vs
+        self._n_mol = n_mol
+        self.triplets = triplets
+        self.mol_pairs = mol_pairs
+        self.adj_pairs = adj_pairs
+        self.positions = positions
+
+    @property
+    def n_mol(self) -> int:
+        if self._n_mol is not None:
+            return self._n_mol
+        if self.mol_vertex_w is not None:
+            return self.mol_vertex_w.shape[0]
+        return int(self.mol_index.max()) + 1
+
+    @property
+    def is_sparse(self) -> bool:
+        return self.vertex_edge_w1 is None
+
+    @property
+    def n_vertex(self) -> int:
+        return self.mol_index.shape[0] if self.mol_index is not None else self.mol_vertex_w.shape[1]
+
+    @property
+    def n_edge(self) -> int:
+        return self.us.shape[0] if self.us is not None else self.vertex_edge_w1.shape[1]
+
+    def directed_edges(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        both directions of every edge, ordered as the columns of `cat([vertex_edge_w1, vertex_edge_w2], dim=1)`;
+        the edge index vectors are derived from the dense masks once if absent
+        :return: begin vertices and end vertices, each with shape [2 * n_edge]
+        """
+        if self.us is None:
+            self.us = torch.argmax(self.vertex_edge_w1, dim=0)
+            self.vs = torch.argmax(self.vertex_edge_w2, dim=0)
+        return torch.cat([self.us, self.vs]), torch.cat([self.vs, self.us])
+
+    def triplet_edges(self) -> torch.Tensor:
+        """
+        :return: pairs of directed edges sharing a begin vertex with shape [2, n_triplet], enumerated once per batch
+        """
+        if self.triplets is None:
+            self.triplets = produce_triplets(self.directed_edges()[0], self.n_vertex)
+        return self.triplets
+
+    def mol_vertex_pairs(self) -> torch.Tensor:
+        """
+        :return: pairs of distinct vertices in the same molecule with shape [2, n_pair], enumerated once per batch
+        """
+        if self.mol_pairs is None:
+            self.mol_pairs = produce_mol_pairs(self.mol_vertex_index(), self.n_mol)
+        return self.mol_pairs
+
+    def mol_vertex_positions(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :return: position of each vertex in its molecule with shape [n_vertex],
+            and the number of vertices of each molecule with shape [n_mol] on the host, enumerated once per batch
+        """
+        if self.positions is None:
+            position, size = segment_positions(self.mol_vertex_index(), self.n_mol)
+            self.positions = position, size.cpu()
+        return self.positions
+
+    def mol_vertex_index(self) -> torch.Tensor:
+        """
+        :return: molecule index of each vertex with shape [n_vertex], derived from `mol_vertex_w` once if absent
+        """
+        if self.mol_index is None:
+            self.mol_index = torch.argmax(self.mol_vertex_w, dim=0)
+        return self.mol_index
+
+
+def produce_pairs(index: torch.Tensor, n_segment: int) -> torch.Tensor:
+    """
+    enumerate every ordered pair (i, j) of positions with the same `index`, including i == j
+    :param index: segment index of each position with shape [n]
+    :param n_segment: number of segments
+    :return: position pairs with shape [2, n_pair], n_pair = sum of squared segment sizes
+    """
+    device = index.device
+    order = torch.argsort(index, stable=True)  # positions grouped by segment
+    size = torch.bincount(index, minlength=n_segment)
+    start = torch.cumsum(size, dim=0) - size  # first position of each segment in `order`
+    n_partner = size[index]
+    i_s = torch.repeat_interleave(torch.arange(index.shape[0], device=device), n_partner)
+    partner_start = torch.cumsum(n_partner, dim=0) - n_partner
+    offset = torch.arange(i_s.shape[0], device=device) - partner_start[i_s]
+    j_s = order[start[index[i_s]] + offset]
+    return torch.stack([i_s, j_s])
+
+
+def produce_triplets(u2: torch.Tensor, n_vertex: int) -> torch.Tensor:
+    """
+    enumerate every ordered pair (e1, e2) of directed edges with the same begin vertex, including e1 == e2;
+    these are exactly the non-zero entries of `vew_u.t() @ vew_u`, i.e. the bond angles of the batch
+    :param u2: begin vertex of each directed edge with shape [2 * n_edge]
+    :param n_vertex: number of vertices
+    :return: edge pairs with shape [2, n_triplet], n_triplet = sum of squared vertex degrees
+    """
+    return produce_pairs(u2, n_vertex)
+
+
+def produce_mol_pairs(mol_index: torch.Tensor, n_mol: int) -> torch.Tensor:
+    """
+    enumerate every ordered pair (i, j), i != j, of vertices in the same molecule;
+    these are the off-diagonal non-zero entries of `mvw.t() @ mvw`
+    :param mol_index: molecule index of each vertex with shape [n_vertex]
+    :param n_mol: number of molecules
+    :return: vertex pairs with shape [2, n_pair]
+    """
+    pairs = produce_pairs(mol_index, n_mol)
+    return pairs[:, pairs[0] != pairs[1]]
+
 
 def cuda_copy(mm: MaskMatrices) -> MaskMatrices:
+    def copy(t: torch.Tensor) -> torch.Tensor:
+        return t.cuda() if t is not None else None
+
     return MaskMatrices(
-        mol_vertex_w=mm.mol_vertex_w.cuda(),
-        mol_vertex_b=mm.mol_vertex_b.cuda(),
-        vertex_edge_w1=mm.vertex_edge_w1.cuda(),
-        vertex_edge_w2=mm.vertex_edge_w2.cuda(),
-        vertex_edge_b1=mm.vertex_edge_b1.cuda(),
-        vertex_edge_b2=mm.vertex_edge_b2.cuda()
+        mol_vertex_w=copy(mm.mol_vertex_w),
+        mol_vertex_b=copy(mm.mol_vertex_b),
+        vertex_edge_w1=copy(mm.vertex_edge_w1),
+        vertex_edge_w2=copy(mm.vertex_edge_w2),
+        vertex_edge_b1=copy(mm.vertex_edge_b1),
+        vertex_edge_b2=copy(mm.vertex_edge_b2),
+        mol_index=copy(mm.mol_index),
+        us=copy(mm.us),
+        vs=copy(mm.vs),
+        n_mol=mm.n_mol,
+        triplets=copy(mm.triplets),
+        mol_pairs=copy(mm.mol_pairs),
+        adj_pairs={k: (copy(p), copy(w)) for k, (p, w) in mm.adj_pairs.items()} if mm.adj_pairs is not None else None,
+        positions=(copy(mm.positions[0]), mm.positions[1]) if mm.positions is not None else None
     )
+
+
+def sparse_copy(mm: MaskMatrices) -> MaskMatrices:
+    """
+    drop the dense matrices and keep only the index vectors, deriving them from the dense ones if absent
+    """
+    if mm.is_sparse:
+        return mm
+    mol_index = mm.mol_vertex_index()
+    us = mm.us if mm.us is not None else torch.argmax(mm.vertex_edge_w1, dim=0)
+    vs = mm.vs if mm.vs is not None else torch.argmax(mm.vertex_edge_w2, dim=0)
+    return MaskMatrices(mol_index=mol_index, us=us, vs=vs, n_mol=mm.n_mol, triplets=mm.triplets,
+                        mol_pairs=mm.mol_pairs, adj_pairs=mm.adj_pairs, positions=mm.positions)
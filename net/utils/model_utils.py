@@ -1,11 +1,13 @@
+import numpy as np
 import torch
 import torch.nn as nn
-from typing import Callable
+from typing import Tuple
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
-def activation_select(act: str) -> Callable:
+def activation_select(act: str) -> nn.Module:
     if act == 'no':
-        activate = lambda x: x
+        activate = nn.Identity()
     elif act == 'sigmoid':
         activate = nn.Sigmoid()
     elif act == 'tanh':
@@ -19,16 +21,154 @@ def activation_select(act: str) -> Callable:
 
 
 def normalize_adj_r(adj: torch.Tensor) -> torch.Tensor:
-    d_1 = torch.diag(torch.pow(torch.sum(adj, dim=1) + 1e-5, -1))
-    norm_adj = d_1 @ adj
+    d_1 = torch.pow(torch.sum(adj, dim=1, keepdim=True) + 1e-5, -1)
+    norm_adj = d_1 * adj
     return norm_adj
 
 
 def normalize_adj_rc(adj: torch.Tensor) -> torch.Tensor:
-    d_12 = torch.diag(torch.pow(torch.sum(adj, dim=1) + 1e-5, -1 / 2))
-    norm_adj = d_12 @ adj @ d_12
+    d_12 = torch.pow(torch.sum(adj, dim=1) + 1e-5, -1 / 2)
+    norm_adj = d_12.unsqueeze(-1) * adj * d_12.unsqueeze(0)
     return norm_adj
 
 
 def nonzero(adj: torch.Tensor) -> torch.Tensor:
     return (adj != 0).type(torch.float32)
+
+
+def to_numpy(x: torch.Tensor) -> np.ndarray:
+    return x.cpu().numpy() if x is not None else None
+
+
+def segment_sum(x: torch.Tensor, index: torch.Tensor, n_segment: int) -> torch.Tensor:
+    """
+    sum rows of `x` sharing the same `index`
+    :param x: features with shape [n, ...]
+    :param index: segment index of each row with shape [n]
+    :param n_segment: number of segments
+    :return: segment sums with shape [n_segment, ...]
+    """
+    out = torch.zeros([n_segment] + list(x.shape[1:]), dtype=x.dtype, device=x.device)
+    return out.index_add(0, index, x)
+
+
+def segment_mean(x: torch.Tensor, index: torch.Tensor, n_segment: int, esp=0.0) -> torch.Tensor:
+    count = segment_sum(torch.ones_like(index, dtype=x.dtype), index, n_segment)
+    count = count.reshape([-1] + [1] * (x.dim() - 1))
+    return segment_sum(x, index, n_segment) / (count + esp)
+
+
+def segment_max(x: torch.Tensor, index: torch.Tensor, n_segment: int) -> torch.Tensor:
+    """
+    max over rows of `x` sharing the same `index`, empty segments are filled with 0
+    :param x: features with shape [n, dim]
+    :param index: segment index of each row with shape [n]
+    :param n_segment: number of segments
+    :return: segment maxima with shape [n_segment, dim]
+    """
+    out = torch.zeros([n_segment] + list(x.shape[1:]), dtype=x.dtype, device=x.device)
+    index = index.reshape([-1] + [1] * (x.dim() - 1)).expand_as(x)
+    return out.scatter_reduce(0, index, x, reduce='amax', include_self=False)
+
+
+def segment_softmax(x: torch.Tensor, index: torch.Tensor, n_segment: int) -> torch.Tensor:
+    """
+    softmax over rows of `x` sharing the same `index`
+    :param x: scores with shape [n] or [n, 1]
+    :param index: segment index of each row with shape [n]
+    :param n_segment: number of segments
+    :return: normalized scores with the shape of `x`
+    """
+    shape = x.shape
+    x = x.reshape([-1])
+    x_max = torch.full([n_segment], -float('inf'), dtype=x.dtype, device=x.device)
+    x_max = x_max.scatter_reduce(0, index, x.detach(), reduce='amax', include_self=True)
+    e = torch.exp(x - x_max[index])
+    e_sum = segment_sum(e, index, n_segment)
+    return (e / e_sum[index]).reshape(shape)
+
+
+class IndexAdjacency:
+    def __init__(self, rows: torch.Tensor, cols: torch.Tensor, values: torch.Tensor, n_vertex: int):
+        """
+        adjacency kept as coordinates, `adj.matmul(x)` gathers and segment-sums like a sparse matmul would,
+        but with index ops only, which graph capture can follow
+        """
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+        self.n_vertex = n_vertex
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size([self.n_vertex, self.n_vertex])
+
+    def matmul(self, x: torch.Tensor) -> torch.Tensor:
+        return segment_sum(self.values.unsqueeze(-1) * x[self.cols], self.rows, self.n_vertex)
+
+    __matmul__ = matmul
+
+    def to_dense(self) -> torch.Tensor:
+        dense = torch.zeros([self.n_vertex, self.n_vertex], dtype=self.values.dtype, device=self.values.device)
+        return dense.index_put((self.rows, self.cols), self.values, accumulate=True)
+
+
+def index_adjacency(us: torch.Tensor, vs: torch.Tensor, weight: torch.Tensor, n_vertex: int) -> IndexAdjacency:
+    """
+    symmetric row-normalized adjacency, same as `normalize_adj_r` on the dense one
+    :param us: begin vertex index of each edge with shape [n_edge]
+    :param vs: end vertex index of each edge with shape [n_edge]
+    :param weight: edge weights with shape [n_edge]
+    :param n_vertex: number of vertices
+    :return: adjacency with shape [n_vertex, n_vertex]
+    """
+    rows = torch.cat([us, vs])
+    cols = torch.cat([vs, us])
+    values = torch.cat([weight, weight])
+    degree = segment_sum(values, rows, n_vertex) + 1e-5
+    values = values / degree[rows]
+    return IndexAdjacency(rows, cols, values, n_vertex)
+
+
+def segment_positions(index: torch.Tensor, n_segment: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    rank of each row among the rows sharing its `index`, in row order
+    :param index: segment index of each row with shape [n]
+    :param n_segment: number of segments
+    :return: positions with shape [n], and segment sizes with shape [n_segment]
+    """
+    order = torch.argsort(index, stable=True)
+    size = segment_sum(torch.ones_like(index), index, n_segment)
+    start = torch.cumsum(size, dim=0) - size
+    position = torch.empty_like(index)
+    position[order] = torch.arange(index.shape[0], device=index.device) - start[index[order]]
+    return position, size
+
+
+@torch.compiler.disable
+def packed_segment_rnn(rnn: nn.RNNBase, x: torch.Tensor, index: torch.Tensor, position: torch.Tensor,
+                       size: torch.Tensor) -> torch.Tensor:
+    """
+    run `rnn` over the rows of each segment as one sequence, all the segments in a single packed call;
+    recurrent modules cannot be captured, so this is left out of compiled graphs
+    :param rnn: a sequence-first recurrent module
+    :param x: features with shape [n, dim]
+    :param index: segment index of each row with shape [n]
+    :param position: position of each row in its sequence with shape [n], see `segment_positions`
+    :param size: length of each sequence with shape [n_segment], on the host
+    :return: outputs of each row with shape [n, out_dim]
+    """
+    padded = x.new_zeros([int(size.max()), size.shape[0], x.shape[1]])
+    padded = padded.index_put((position, index), x)
+    output, _ = rnn(pack_padded_sequence(padded, size, enforce_sorted=False))
+    output, _ = pad_packed_sequence(output)
+    return output[position, index]
+
+
+def segment_to_dense(x: torch.Tensor, index: torch.Tensor, n_segment: int) -> torch.Tensor:
+    """
+    scatter per-row scalars back into a dense [n_segment, n] mask-shaped matrix, e.g. for returning alignments
+    """
+    dense = torch.zeros([n_segment, index.shape[0]], dtype=x.dtype, device=x.device)
+    dense[index, torch.arange(index.shape[0], device=index.device)] = x.reshape([-1])
+    return dense
@@ -0,0 +1,78 @@
+import csv
+import sys
+import argparse
+import numpy as np
+import rdkit.Chem as Chem
+
+from rdkit.Geometry import Point3D
+from typing import Iterator
+
+from train.predict import Predictor, parse_mol
+
+
+def read_smiles(path: str, column: str) -> Iterator[str]:
+    """
+    lazily read the `column` of a csv, or its first column if there is no such header
+    """
+    with open(path) as fp:
+        reader = csv.reader(fp)
+        header = next(reader, None)
+        if header is None:
+            return
+        names = [name.strip().lower() for name in header]
+        if column.lower() in names:
+            index = names.index(column.lower())
+        else:
+            index = 0
+            if parse_mol(header[0]) is not None:
+                yield header[0]
+        for row in reader:
+            if len(row) > index:
+                yield row[index]
+
+
+def read_mols(path: str, column: str) -> Iterator:
+    if path.endswith('.sdf'):
+        yield from Chem.ForwardSDMolSupplier(path)
+    else:
+        yield from read_smiles(path, column)
+
+
+parser = argparse.ArgumentParser(description='predict properties and conformations with a trained GeomNN')
+parser.add_argument('--tag', type=str, default='QM9', help='tag of the trained model in train/models')
+parser.add_argument('--input', type=str, required=True, help='csv of SMILES, or sdf of molecules')
+parser.add_argument('--column', type=str, default='smiles', help='column of the SMILES in the csv')
+parser.add_argument('--output', type=str, default=None, help='csv of the properties, stdout if absent')
+parser.add_argument('--sdf', type=str, default=None, help='sdf of the predicted conformations, if any')
+parser.add_argument('--max-atoms', type=int, default=2048, help='maximum number of atoms of a micro-batch')
+parser.add_argument('--cuda', action='store_true')
+arg = parser.parse_args()
+
+predictor = Predictor(arg.tag, use_cuda=arg.cuda, max_atoms=arg.max_atoms)
+out_fp = open(arg.output, 'w+', newline='') if arg.output else sys.stdout
+writer = csv.writer(out_fp)
+writer.writerow(['smiles'] + [f'p{i}' for i in range(predictor.out_dim)])
+sdf_writer = Chem.SDWriter(arg.sdf) if arg.sdf else None
+n_mol, n_fail = 0, 0
+for item, mol, properties, positions in predictor.predict(read_mols(arg.input, arg.column)):
+    n_mol += 1
+    if properties is None:
+        n_fail += 1
+        writer.writerow([item if isinstance(item, str) else ''] + [''] * predictor.out_dim)
+        continue
+    writer.writerow([Chem.MolToSmiles(mol)] + [f'{p:.6g}' for p in properties])
+    if sdf_writer is not None and positions is not None:
+        conf = Chem.Conformer(mol.GetNumAtoms())
+        for i, (x, y, z) in enumerate(positions.astype(np.float64)):
+            conf.SetAtomPosition(i, Point3D(x, y, z))
+        mol = Chem.Mol(mol)
+        mol.RemoveAllConformers()
+        mol.AddConformer(conf, assignId=True)
+        for i, p in enumerate(properties):
+            mol.SetDoubleProp(f'p{i}', float(p))
+        sdf_writer.write(mol)
+if sdf_writer is not None:
+    sdf_writer.close()
+if out_fp is not sys.stdout:
+    out_fp.close()
+print(f'Predicted {n_mol - n_fail} of {n_mol} molecules', file=sys.stderr)
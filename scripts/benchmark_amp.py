@@ -0,0 +1,94 @@
+import time
+import torch
+import torch.optim as optim
+import numpy as np
+import argparse
+
+from itertools import chain
+
+from data.qm9.load_qm9 import load_qm9
+from net.models import GeomNN, MLP
+from train.config import QM9_CONFIG
+from train.utils.cache_batch import load_batch_cache, load_encode_mols, batch_cuda_copy
+from train.utils.seed import set_seed
+from train.utils.amp import amp_autocast, amp_grad_scaler, set_tf32
+from train.utils.loss_functions import multi_mse_loss, hierarchical_adj3_loss
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--max-num', type=int, default=20000)
+parser.add_argument('--batches', type=int, default=50)
+parser.add_argument('--warmup', type=int, default=5)
+parser.add_argument('--cpu', action='store_true')
+arg = parser.parse_args()
+use_cuda = not arg.cpu and torch.cuda.is_available()
+
+MODES = [
+    ('fp32', {'AMP': False, 'TF32': False}),
+    ('tf32', {'AMP': False, 'TF32': True}),
+    ('bf16', {'AMP': True, 'AMP_DTYPE': 'bf16', 'TF32': True}),
+    ('fp16', {'AMP': True, 'AMP_DTYPE': 'fp16', 'TF32': True}),
+]
+
+mols, mol_properties = load_qm9(arg.max_num)
+mols_info = load_encode_mols(mols, name=f'QM9-bench{arg.max_num}')
+norm_p = (mol_properties - np.mean(mol_properties, axis=0)) / np.std(mol_properties, axis=0)
+batch_cache = load_batch_cache(f'QM9-bench{arg.max_num}', mols, mols_info, norm_p, batch_size=QM9_CONFIG['BATCH'],
+                               contains_ground_truth_conf=True, use_cuda=use_cuda)
+batches = batch_cache.train_batches[:arg.warmup + arg.batches]
+if use_cuda:
+    batches = [batch_cuda_copy(batch) for batch in batches]
+
+
+def benchmark(special_config: dict) -> float:
+    """
+    :return: molecules per second over `arg.batches` training steps, after `arg.warmup` untimed ones
+    """
+    config = QM9_CONFIG.copy()
+    config.update(special_config)
+    set_seed(0, use_cuda=use_cuda)
+    set_tf32(config['TF32'])
+    model = GeomNN(batch_cache.atom_dim, batch_cache.bond_dim, config=config, use_cuda=use_cuda)
+    classifier = MLP(config['HM_DIM'], mol_properties.shape[1], config['CLASSIFIER_HIDDENS'],
+                     use_cuda=use_cuda, bias=True)
+    if use_cuda:
+        model.cuda()
+        classifier.cuda()
+    optimizer = optim.Adam(params=chain(model.parameters(), classifier.parameters()), lr=config['LR'])
+    scaler = amp_grad_scaler(config, use_cuda)
+
+    n_mol = 0
+    t0 = time.time()
+    optimizer.zero_grad()
+    for i, batch in enumerate(batches):
+        if i == arg.warmup:
+            if use_cuda:
+                torch.cuda.synchronize()
+            n_mol = 0
+            t0 = time.time()
+        with amp_autocast(config, use_cuda):
+            fp, pred_cs, *_ = model.forward(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
+                                            batch.rdkit_conf)
+        fp, pred_cs = fp.float(), [c.float() for c in pred_cs]
+        pred_p = classifier.forward(fp)
+        loss = multi_mse_loss(pred_p, batch.properties) + \
+            config['LAMBDA'] * hierarchical_adj3_loss(pred_cs, batch.conformation, batch.mask_matrices)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        # as in the trainers, which only zero the gradients once per epoch unless the loss is scaled
+        if scaler.is_enabled():
+            optimizer.zero_grad()
+        n_mol += batch.mask_matrices.n_mol
+    if use_cuda:
+        torch.cuda.synchronize()
+    return n_mol / (time.time() - t0)
+
+
+print(f'{"mode":>6} {"mol/s":>10} {"speedup":>8}')
+base = None
+for name, special_config in MODES:
+    if special_config['AMP'] and special_config['AMP_DTYPE'] == 'fp16' and not use_cuda:
+        continue
+    throughput = benchmark(special_config)
+    base = base or throughput
+    print(f'{name:>6} {throughput:>10.1f} {throughput / base:>7.2f}x')
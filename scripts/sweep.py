@@ -0,0 +1,62 @@
+import json
+
+from net.config import ConfType
+from train.sweep import run_sweep, summarize_sweep
+from train.train_qm9 import train_qm9, QMDataset
+from train.train_single_regression import train_single_regression, SingleRegressionDataset
+from train.train_multi_classification import train_multi_classification, MultiClassificationDataset
+from train.utils.seed import DEFAULT_SEEDS
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--task', type=str, default='qm9',
+                    choices=['qm7', 'qm8', 'qm9', 'lipop', 'esol', 'freesolv', 'tox21', 'sars'])
+parser.add_argument('--grid', type=str, default='{"LAMBDA": [1., 100.], "TAU": [0.25, 0.5]}',
+                    help='candidate values of config keys, in JSON')
+parser.add_argument('--config', type=str, default='{}', help='config shared by all the runs, in JSON')
+parser.add_argument('--seeds', type=int, default=len(DEFAULT_SEEDS), help='number of `DEFAULT_SEEDS` to run')
+parser.add_argument('--workers', type=int, default=None)
+parser.add_argument('--threads', type=int, default=1, help='torch threads per run')
+parser.add_argument('--max-num', type=int, default=-1)
+parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--tag', type=str, default='sweep')
+arg = parser.parse_args()
+
+
+def parse_config(config: dict) -> dict:
+    # enums are given by name, e.g. "CONF_TYPE": "NEWTON_RGT"
+    return {k: ConfType[v] if k == 'CONF_TYPE' else v for k, v in config.items()}
+
+
+grid = {k: [parse_config({k: v})[k] for v in vs] for k, vs in json.loads(arg.grid).items()}
+base_config = parse_config(json.loads(arg.config))
+name = f'{arg.task.upper()}-{arg.tag}'
+if arg.task in ['qm7', 'qm8', 'qm9']:
+    train_fn = train_qm9
+    kwargs = {'dataset': QMDataset[arg.task.upper()]}
+elif arg.task in ['lipop', 'esol', 'freesolv']:
+    train_fn = train_single_regression
+    kwargs = {'dataset': SingleRegressionDataset[arg.task.upper()]}
+else:
+    train_fn = train_multi_classification
+    kwargs = {'dataset': MultiClassificationDataset.TOX21 if arg.task == 'tox21'
+              else MultiClassificationDataset.SARS_COV_2}
+
+table = run_sweep(
+    train_fn, grid,
+    data_name=name,
+    seeds=DEFAULT_SEEDS[:arg.seeds],
+    base_config=base_config,
+    tag=name,
+    n_workers=arg.workers,
+    threads_per_run=arg.threads,
+    # the RMSE of the regressions, their `p_metric` being the MAE
+    metric='b_metric' if train_fn == train_single_regression else 'p_metric',
+    maximize=train_fn == train_multi_classification,
+    use_cuda=arg.cuda,
+    max_num=arg.max_num,
+    use_tqdm=False,
+    **kwargs
+)
+print(table.to_string())
+print(summarize_sweep(table, grid).to_string())
@@ -0,0 +1,22 @@
+import asyncio
+import argparse
+
+from train.predict import Predictor
+from train.serve import PredictionServer
+
+parser = argparse.ArgumentParser(description='serve a trained GeomNN over local HTTP, coalescing concurrent requests')
+parser.add_argument('--tag', type=str, default='QM9', help='tag of the trained model in train/models')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--max-wait-ms', type=float, default=10., help='latency window to coalesce requests in')
+parser.add_argument('--max-batch', type=int, default=256, help='maximum number of molecules of a batch')
+parser.add_argument('--max-atoms', type=int, default=2048, help='maximum number of atoms of a micro-batch')
+parser.add_argument('--cuda', action='store_true')
+arg = parser.parse_args()
+
+predictor = Predictor(arg.tag, use_cuda=arg.cuda, max_atoms=arg.max_atoms)
+server = PredictionServer(predictor, max_wait_ms=arg.max_wait_ms, max_batch_size=arg.max_batch)
+try:
+    asyncio.run(server.serve(arg.host, arg.port))
+except KeyboardInterrupt:
+    pass
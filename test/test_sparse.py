@@ -0,0 +1,71 @@
+import torch
+import numpy as np
+import rdkit.Chem as Chem
+
+from data.encode import encode_mol, num_atom_features, num_bond_features
+from net.config import ConfType
+from net.models import GeomNN
+from train.config import QM9_CONFIG
+from train.utils.cache_batch import assemble_batch
+from train.utils.kabsch import kabsch, batched_kabsch
+from train.utils.loss_functions import distance_loss, kabsch_rmsd_loss, hierarchical_adj3_loss
+from train.utils.rdkit import rdkit_mol_positions
+
+SMILES = ['CCO', 'c1ccccc1O', 'C', 'CC(=O)N', 'O=C=O']
+
+
+def small_batch(sparse: bool):
+    mols = [Chem.MolFromSmiles(s) for s in SMILES]
+    mols_info = [encode_mol(mol) for mol in mols]
+    conf = np.vstack([rdkit_mol_positions(mol) for mol in mols])
+    return assemble_batch(mols_info, list(range(len(mols))), np.zeros([len(mols), 1]),
+                          conformation=conf, rdkit_conf=conf, sparse=sparse)
+
+
+def test_dense_sparse():
+    dense, sparse = small_batch(sparse=False), small_batch(sparse=True)
+    assert not dense.mask_matrices.is_sparse and sparse.mask_matrices.is_sparse
+    assert sparse.mask_matrices.mol_vertex_w is None and sparse.mask_matrices.vertex_edge_w1 is None
+
+    torch.manual_seed(0)
+    dense_model = GeomNN(num_atom_features(), num_bond_features(),
+                         config=dict(QM9_CONFIG, CONF_TYPE=ConfType.NEWTON_RGT, SPARSE=False))
+    sparse_model = GeomNN(num_atom_features(), num_bond_features(),
+                          config=dict(QM9_CONFIG, CONF_TYPE=ConfType.NEWTON_RGT, SPARSE=True))
+    sparse_model.load_state_dict(dense_model.state_dict())
+    dense_model.eval()
+    sparse_model.eval()
+    with torch.no_grad():
+        d_fp, d_cs, *_ = dense_model(dense.atom_ftr, dense.bond_ftr, dense.massive, dense.mask_matrices,
+                                     dense.rdkit_conf)
+        s_fp, s_cs, *_ = sparse_model(sparse.atom_ftr, sparse.bond_ftr, sparse.massive, sparse.mask_matrices,
+                                      sparse.rdkit_conf)
+    assert torch.allclose(d_fp, s_fp, atol=1e-5), (d_fp - s_fp).abs().max()
+    assert torch.allclose(d_cs[-1], s_cs[-1], atol=1e-5), (d_cs[-1] - s_cs[-1]).abs().max()
+
+    for loss in [distance_loss, kabsch_rmsd_loss]:
+        d_loss = loss(d_cs[-1], dense.conformation, dense.mask_matrices)
+        s_loss = loss(s_cs[-1], sparse.conformation, sparse.mask_matrices)
+        assert torch.allclose(d_loss, s_loss, atol=1e-5), (loss.__name__, d_loss, s_loss)
+    d_loss = hierarchical_adj3_loss(d_cs, dense.conformation, dense.mask_matrices)
+    s_loss = hierarchical_adj3_loss(s_cs, sparse.conformation, sparse.mask_matrices)
+    assert torch.allclose(d_loss, s_loss, atol=1e-5), (d_loss, s_loss)
+
+
+def test_batched_kabsch():
+    batch = small_batch(sparse=True)
+    mol_index, n_mol = batch.mask_matrices.mol_index, batch.mask_matrices.n_mol
+    torch.manual_seed(0)
+    pos = batch.conformation @ torch.linalg.qr(torch.randn([3, 3]))[0] + 0.1 * torch.randn_like(batch.conformation)
+    ret_pos, ret_fit_pos = batched_kabsch(pos, batch.conformation, mol_index, n_mol)
+
+    # `kabsch` returns the molecules one after the other, which are contiguous in a batch
+    mol_node_matrix = torch.nn.functional.one_hot(mol_index, n_mol).t().type(torch.float32)
+    ref_pos, ref_fit_pos = kabsch(pos, batch.conformation, mol_node_matrix)
+    assert torch.allclose(ret_fit_pos, ref_fit_pos, atol=1e-5)
+    assert torch.allclose(ret_pos, ref_pos, atol=1e-4), (ret_pos - ref_pos).abs().max()
+
+
+if __name__ == '__main__':
+    test_dense_sparse()
+    test_batched_kabsch()
@@ -32,10 +32,25 @@ DEFAULT_CONFIG = {
     'TAU': 0.25,
     'DISSA': 1.0,
     'DROPOUT': 0.0,
+    'SPARSE': False,
 
     'EPOCH': 300,
     'BATCH': 20,
     'PACK': 1,
+    'DYNAMIC_BATCH': False,
+    'LOADER_WORKERS': 0,
+    'BATCH_BUDGET': 0,
+    'BUDGET_UNIT': 'atom',
+    'TRAIN_EVAL_EVERY': 1,
+    'TRAIN_EVAL_BATCHES': 0,
+    'CHECKPOINT_EVERY': 1,
+    'PATIENCE': 0,
+    'TIME_BUDGET': 0,
+    'TEST_ON_BEST_ONLY': False,
+    'AMP': False,
+    'AMP_DTYPE': 'bf16',
+    'TF32': False,
+    'COMPILE': False,
     'CONF_LOSS': 'H_ADJ3',
     'LAMBDA': 100,
     'LR': 2e-6,
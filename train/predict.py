@@ -0,0 +1,148 @@
+import os
+import pickle
+import torch
+import numpy as np
+import rdkit.Chem as Chem
+
+from typing import List, Dict, Tuple, Union, Iterable, Iterator, Any
+from rdkit.Chem.rdchem import Mol as Molecule
+
+from data.encode import encode_mol_cached, num_atom_features, num_bond_features
+from net.config import ConfType
+from net.models import GeomNN, MLP
+from .config import QM9_CONFIG
+from .train_qm9 import MODEL_DICT_DIR
+from .utils.cache_batch import assemble_batch, batch_cuda_copy
+from .utils.amp import amp_autocast
+from .utils.rdkit import rdkit_mol_positions
+
+Prediction = Tuple[Any, Union[Molecule, None], Union[np.ndarray, None], Union[np.ndarray, None]]
+
+
+def parse_mol(item: Union[str, Molecule]) -> Union[Molecule, None]:
+    """
+    :param item: a SMILES string, a mol block or an RDKit molecule
+    :return: the molecule, or None if it cannot be parsed
+    """
+    if not isinstance(item, (str, Molecule)):
+        # e.g. the records `Chem.ForwardSDMolSupplier` fails to parse
+        return None
+    if isinstance(item, Molecule):
+        return item
+    if '\n' in item:
+        return Chem.MolFromMolBlock(item)
+    return Chem.MolFromSmiles(item.strip())
+
+
+class Predictor:
+    def __init__(self, tag='QM9', special_config: dict = None, use_cuda=False, max_atoms=2048):
+        """
+        a trained GeomNN and its classifier, loaded once to predict properties and conformations of any number of
+        molecules, micro-batched by their number of atoms
+        :param tag: tag of the training run, whose `{tag}-model.pkl`, `{tag}-classifier.pkl`
+            and `{tag}-meta.pickle` are read from `MODEL_DICT_DIR`
+        :param special_config: config of the run, only needed for checkpoints saved without their meta file
+        :param max_atoms: maximum total number of atoms of a micro-batch
+        """
+        self.use_cuda = use_cuda
+        self.max_atoms = max_atoms
+        model_dicts = torch.load(f'{MODEL_DICT_DIR}/{tag}-model.pkl', map_location=torch.device('cpu'))
+        classifier_dicts = torch.load(f'{MODEL_DICT_DIR}/{tag}-classifier.pkl', map_location=torch.device('cpu'))
+        meta_path = f'{MODEL_DICT_DIR}/{tag}-meta.pickle'
+        if os.path.exists(meta_path):
+            with open(meta_path, 'rb') as fp:
+                meta = pickle.load(fp)
+            config = meta['config'].copy()
+            atom_dim, bond_dim = meta['atom_dim'], meta['bond_dim']
+            self.mean, self.std = meta['mean'].astype(np.float32), meta['std'].astype(np.float32)
+        else:
+            print(f'\tNo {meta_path}, predicting normalized properties')
+            config = QM9_CONFIG.copy()
+            atom_dim, bond_dim = num_atom_features(), num_bond_features()
+            self.mean, self.std = 0., 1.
+        if special_config is not None:
+            config.update(special_config)
+        assert config['CONF_TYPE'] != ConfType.REAL, 'Cannot predict with ground-truth conformations (ConfType.REAL)'
+        self.config = config
+        self.needs_rdkit_conf = config['CONF_TYPE'] in [ConfType.RDKIT, ConfType.NEWTON_RGT]
+
+        self.model = GeomNN(
+            atom_dim=atom_dim,
+            bond_dim=bond_dim,
+            config=config,
+            use_cuda=use_cuda
+        )
+        # the last linear of the classifier tells the number of properties
+        self.out_dim = [v for k, v in classifier_dicts.items() if k.endswith('weight')][-1].shape[0]
+        self.classifier = MLP(
+            in_dim=config['HM_DIM'],
+            out_dim=self.out_dim,
+            hidden_dims=config['CLASSIFIER_HIDDENS'],
+            use_cuda=use_cuda,
+            bias=True
+        )
+        self.model.load_state_dict(model_dicts)
+        self.classifier.load_state_dict(classifier_dicts)
+        self.model.eval()
+        self.classifier.eval()
+        if use_cuda:
+            self.model.cuda()
+            self.classifier.cuda()
+
+    @staticmethod
+    def rdkit_positions(mol: Molecule) -> np.ndarray:
+        # zeros for the molecules that fail to embed, as in training
+        positions = rdkit_mol_positions(mol)
+        return positions if positions is not None else np.zeros([mol.GetNumAtoms(), 3], np.float32)
+
+    @torch.no_grad()
+    def predict_batch(self, mols: List[Molecule], mols_info: List[Dict[str, np.ndarray]]
+                      ) -> Tuple[np.ndarray, List[np.ndarray]]:
+        """
+        :return: properties with shape [n_mol, out_dim], and the positions of each molecule with shape [n_atom, 3]
+        """
+        rdkit_conf = np.vstack([self.rdkit_positions(m) for m in mols]) if self.needs_rdkit_conf else None
+        batch = assemble_batch(mols_info, list(range(len(mols_info))), np.zeros([len(mols_info), 0]),
+                               rdkit_conf=rdkit_conf, need_loss_pairs=False, sparse=self.config['SPARSE'],
+                               keep_bondless=True)
+        if self.use_cuda:
+            batch = batch_cuda_copy(batch)
+        with amp_autocast(self.config, self.use_cuda):
+            fp, pred_cs, *_ = self.model.forward(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
+                                                 batch.rdkit_conf)
+        properties = self.classifier.forward(fp.float())
+        properties = properties.cpu().numpy() * self.std + self.mean
+        positions = pred_cs[-1].float().cpu().numpy()
+        n_atoms = [info['af'].shape[0] for info in mols_info]
+        return properties, np.split(positions, np.cumsum(n_atoms)[:-1])
+
+    def predict(self, items: Iterable[Union[str, Molecule]]) -> Iterator[Prediction]:
+        """
+        stream predictions of `items`, in their order, running a batch whenever `max_atoms` is reached
+        :param items: SMILES strings, mol blocks or RDKit molecules, may be a lazy iterable
+        :return: for each item, the item, its molecule, properties with shape [out_dim]
+            and positions with shape [n_atom, 3]; None for those that cannot be parsed
+        """
+        pending: List[Tuple[Any, Union[Molecule, None], Union[Dict[str, np.ndarray], None]]] = []
+        n_atom = 0
+        for item in items:
+            mol = parse_mol(item)
+            info = encode_mol_cached(mol) if mol is not None and mol.GetNumAtoms() else None
+            size = info['af'].shape[0] if info is not None else 0
+            if n_atom + size > self.max_atoms and n_atom:
+                yield from self._flush(pending)
+                pending, n_atom = [], 0
+            pending.append((item, mol, info))
+            n_atom += size
+        yield from self._flush(pending)
+
+    def _flush(self, pending: List[Tuple[Any, Union[Molecule, None], Union[Dict[str, np.ndarray], None]]]
+              ) -> Iterator[Prediction]:
+        valid = [i for i, (_, _, info) in enumerate(pending) if info is not None]
+        if len(valid):
+            properties, positions = self.predict_batch([pending[i][1] for i in valid], [pending[i][2] for i in valid])
+            results = {i: (properties[j], positions[j]) for j, i in enumerate(valid)}
+        else:
+            results = {}
+        for i, (item, mol, _) in enumerate(pending):
+            yield (item, mol) + results.get(i, (None, None))
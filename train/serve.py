@@ -0,0 +1,174 @@
+import json
+import time
+import asyncio
+import urllib.request
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Any
+
+from data.feature_cache import get_feature_cache
+from .predict import Predictor
+
+
+class PredictionServer:
+    def __init__(self, predictor: Predictor, max_wait_ms=10., max_batch_size=256):
+        """
+        local HTTP server that coalesces concurrent prediction requests into shared batches;
+        POST /predict with {"smiles": [...]} (or a single string), GET /metrics for latency and throughput
+        :param predictor: the loaded model, run in a single worker thread so that the event loop keeps accepting
+        :param max_wait_ms: how long the first queued molecule waits for others to join its batch
+        :param max_batch_size: maximum number of molecules of a batch, `predictor.max_atoms` splits it further
+        """
+        self.predictor = predictor
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue: asyncio.Queue = None
+
+        self.start_time = time.time()
+        self.n_request = 0
+        self.n_mol = 0
+        self.n_batch = 0
+        self.latencies = deque(maxlen=10000)
+        self.batch_times = deque(maxlen=10000)
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending: List[Tuple[str, asyncio.Future]] = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            t0 = time.time()
+            try:
+                results = await loop.run_in_executor(self.executor, self.run, [smiles for smiles, _ in pending])
+            except Exception as e:
+                results = [{'smiles': smiles, 'error': repr(e)} for smiles, _ in pending]
+            self.batch_times.append(time.time() - t0)
+            self.n_batch += 1
+            self.n_mol += len(pending)
+            for (_, future), result in zip(pending, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def run(self, list_smiles: List[str]) -> List[Dict[str, Any]]:
+        try:
+            return [self.result(*prediction) for prediction in self.predictor.predict(list_smiles)]
+        except Exception:
+            # run the molecules of the failed batch one by one, so that only the faulty ones fail
+            return [self.run_one(smiles) for smiles in list_smiles]
+
+    def run_one(self, smiles: str) -> Dict[str, Any]:
+        try:
+            return self.result(*next(iter(self.predictor.predict([smiles]))))
+        except Exception as e:
+            return {'smiles': smiles, 'error': repr(e)}
+
+    @staticmethod
+    def result(smiles: str, mol, properties: np.ndarray, positions: np.ndarray) -> Dict[str, Any]:
+        if properties is None:
+            return {'smiles': smiles, 'error': 'invalid molecule'}
+        return {
+            'smiles': smiles,
+            'properties': properties.tolist(),
+            'positions': positions.tolist() if positions is not None else None,
+        }
+
+    async def predict(self, list_smiles: List[str]) -> List[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        futures = []
+        for smiles in list_smiles:
+            future = loop.create_future()
+            await self.queue.put((smiles, future))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+
+    def metrics(self) -> Dict[str, Any]:
+        elapsed = time.time() - self.start_time
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'requests': self.n_request,
+            'molecules': self.n_mol,
+            'batches': self.n_batch,
+            'mean_batch_size': self.n_mol / self.n_batch if self.n_batch else 0.,
+            'mean_batch_ms': float(np.mean(self.batch_times)) * 1000 if len(self.batch_times) else 0.,
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.,
+            'latency_p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else 0.,
+            'throughput_mol_per_s': self.n_mol / elapsed if elapsed > 0 else 0.,
+            'uptime_s': elapsed,
+            'feature_cache': get_feature_cache().stats(),
+        }
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        t0 = time.time()
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1')
+                if line in ('\r\n', '\n', ''):
+                    break
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            if len(request_line) < 2:
+                status, response = 400, {'error': 'bad request'}
+            elif request_line[0] == 'GET' and request_line[1] == '/metrics':
+                status, response = 200, self.metrics()
+            elif request_line[0] == 'POST' and request_line[1] == '/predict':
+                list_smiles = json.loads(body or b'{}').get('smiles', [])
+                if isinstance(list_smiles, str):
+                    list_smiles = [list_smiles]
+                # rejected before queueing, as they would share a batch with the molecules of other requests
+                if not isinstance(list_smiles, list) or not all(isinstance(smiles, str) for smiles in list_smiles):
+                    status, response = 400, {'error': '"smiles" must be a string or a list of strings'}
+                else:
+                    self.n_request += 1
+                    results = await self.predict(list_smiles)
+                    latency = time.time() - t0
+                    self.latencies.append(latency)
+                    status, response = 200, {'results': results, 'latency_ms': latency * 1000}
+            else:
+                status, response = 404, {'error': f'no route {" ".join(request_line[:2])}'}
+        except (ValueError, AttributeError) as e:
+            status, response = 400, {'error': repr(e)}
+        payload = json.dumps(response).encode()
+        writer.write(f'HTTP/1.1 {status} {"OK" if status == 200 else "ERROR"}\r\n'
+                     f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode() + payload)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Serving on http://{host}:{port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def request_predictions(list_smiles: List[str], host='127.0.0.1', port=8000) -> Dict[str, Any]:
+    """
+    a local client of `PredictionServer`
+    """
+    request = urllib.request.Request(f'http://{host}:{port}/predict', data=json.dumps({'smiles': list_smiles}).encode(),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request) as fp:
+        return json.loads(fp.read())
+
+
+def request_metrics(host='127.0.0.1', port=8000) -> Dict[str, Any]:
+    with urllib.request.urlopen(f'http://{host}:{port}/metrics') as fp:
+        return json.loads(fp.read())
@@ -0,0 +1,142 @@
+import os
+import time
+import torch
+import numpy as np
+import pandas as pd
+import multiprocessing
+
+from contextlib import redirect_stdout
+from itertools import product
+from typing import List, Dict, Tuple, Callable, Any
+
+from .utils.cache_batch import keep_loaded_caches
+from .utils.save_log import LOG_DIR
+from .utils.seed import DEFAULT_SEEDS
+
+SWEEP_DIR = f'{LOG_DIR}/sweep'
+# config keys that change what the batch cache holds, whose values get caches of their own
+CACHE_KEYS = ['CONF_TYPE', 'DYNAMIC_BATCH', 'BATCH', 'SPARSE']
+
+# what the forked runs need, set by `run_sweep` before forking them
+_sweep: Dict[str, Any] = {}
+
+
+def expand_grid(grid: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    """
+    :param grid: candidate values of some config keys, e.g. {'LAMBDA': [1., 100.], 'TAU': [0.25, 0.5]}
+    :return: one `special_config` per combination of the values
+    """
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in product(*[grid[k] for k in keys])]
+
+
+def cache_name(data_name: str, special_config: Dict[str, Any], seed: int) -> str:
+    """
+    :return: the `data_name` of the dataset and batch caches of a run, shared by the runs of the same seed
+        and the same values of `CACHE_KEYS`
+    """
+    variant = ''.join(f'-{k}={getattr(special_config[k], "name", special_config[k])}'
+                      for k in CACHE_KEYS if k in special_config.keys())
+    return f'{data_name}{variant}@{seed}'
+
+
+def _init_run(threads_per_run: int):
+    torch.set_num_threads(threads_per_run)
+
+
+def _run(args: Tuple[int, int, Dict[str, Any], int]) -> Dict[str, Any]:
+    n, index, special_config, seed = args
+    train_fn, base_config, kwargs = _sweep['train_fn'], _sweep['base_config'], _sweep['kwargs']
+    if kwargs.get('use_cuda', False):
+        # the runs take the devices in turn, CUDA being first initialized here in the forked process
+        torch.cuda.set_device(n % torch.cuda.device_count())
+    run_tag = f'{_sweep["tag"]}-{index}@{seed}'
+    row = {k: str(v) for k, v in special_config.items()}
+    row.update({'seed': seed, 'tag': run_tag})
+    t0 = time.time()
+    try:
+        with open(f'{SWEEP_DIR}/{_sweep["tag"]}/{run_tag}.txt', 'w+') as fp, redirect_stdout(fp):
+            logs = train_fn(special_config=dict(base_config, **special_config), seed=seed, tag=run_tag,
+                            data_name=cache_name(_sweep['data_name'], special_config, seed), force_save=False,
+                            **kwargs)
+        metric = f'validate_{_sweep["metric"]}'
+        scores = np.array([log.get(metric, np.nan) for log in logs], dtype=np.float64)
+        best = int(np.nanargmax(scores) if _sweep['maximize'] else np.nanargmin(scores))
+        row.update({'best_epoch': logs[best]['epoch'], 'validate': logs[best][metric],
+                    'test': logs[best].get(f'test_{_sweep["metric"]}', np.nan)})
+    except Exception as e:
+        row.update({'error': repr(e)})
+    row['time'] = time.time() - t0
+    return row
+
+
+def run_sweep(train_fn: Callable[..., List[Dict[str, float]]], grid: Dict[str, List[Any]], data_name: str,
+              seeds: List[int] = None, base_config: dict = None, tag='sweep', n_workers: int = None,
+              threads_per_run=1, metric='p_metric', maximize=False, force_save=False, **kwargs) -> pd.DataFrame:
+    """
+    train every combination of `grid` with every seed over a pool of forked processes;
+    the dataset is loaded once, and featurized and batched once per seed in this process, then shared by the runs
+    :param train_fn: `train_qm9`, `train_single_regression` or `train_multi_classification`
+    :param grid: candidate values of some config keys, see `expand_grid`; the runs of a seed share their caches
+        unless they differ in `CACHE_KEYS`, see `cache_name`
+    :param seeds: `DEFAULT_SEEDS` if None; each seed also draws its own train/validate/test split
+    :param base_config: config shared by all the runs, under the overrides of `grid`
+    :param n_workers: number of concurrent runs, enough to fill the cores with `threads_per_run` threads each if None
+    :param metric: the log entry of the epoch with the best `validate_{metric}` is reported, with its `test_{metric}`;
+        `p_metric` is the MAE of `train_qm9` and `train_single_regression`, whose RMSE is `b_metric`,
+        and the ROC of `train_multi_classification`
+    :param maximize: whether a higher `metric` is better (ROC) instead of a lower one (MAE)
+    :param kwargs: passed to `train_fn`, e.g. `dataset`, `max_num` or `use_cuda`, with which the runs are spread
+        over all the visible devices
+    :return: one row per run, also written to `SWEEP_DIR/{tag}.csv`, the output of each run being in `SWEEP_DIR/{tag}/`
+    """
+    if seeds is None:
+        seeds = DEFAULT_SEEDS
+    if base_config is None:
+        base_config = {}
+    if n_workers is None:
+        n_workers = max(1, (os.cpu_count() or 1) // threads_per_run)
+    configs = expand_grid(grid)
+    if not os.path.exists(f'{SWEEP_DIR}/{tag}'):
+        os.makedirs(f'{SWEEP_DIR}/{tag}')
+
+    # a run of no epoch builds the caches of each seed and `CACHE_KEYS` values, kept in memory for the forked runs;
+    # it leaves CUDA alone, which cannot be re-initialized in the forked processes once initialized here
+    keep_loaded_caches()
+    prepared = set()
+    for special_config in configs:
+        for seed in seeds:
+            name = cache_name(data_name, special_config, seed)
+            if name in prepared:
+                continue
+            print(f'Preparing {name}...')
+            with open(f'{SWEEP_DIR}/{tag}/prepare-{name}.txt', 'w+') as fp, redirect_stdout(fp):
+                train_fn(special_config=dict(base_config, **special_config, EPOCH=0), seed=seed,
+                         tag=f'{tag}-prepare-{name}', data_name=name, force_save=force_save,
+                         **dict(kwargs, use_cuda=False))
+            prepared.add(name)
+
+    _sweep.update({'train_fn': train_fn, 'base_config': base_config, 'kwargs': kwargs, 'tag': tag,
+                   'data_name': data_name, 'metric': metric, 'maximize': maximize})
+    runs = [(i, special_config, seed) for i, special_config in enumerate(configs) for seed in seeds]
+    runs = [(n, *run) for n, run in enumerate(runs)]
+    print(f'Running {len(runs)} runs over {n_workers} processes of {threads_per_run} threads...')
+    rows = []
+    with multiprocessing.get_context('fork').Pool(n_workers, initializer=_init_run, initargs=(threads_per_run,),
+                                                  maxtasksperchild=1) as pool:
+        for row in pool.imap_unordered(_run, runs):
+            print(f'\t{row["tag"]}: ' + (f'test {row["test"]:.4f} at epoch {row["best_epoch"]}'
+                                         if 'error' not in row.keys() else row['error']))
+            rows.append(row)
+
+    table = pd.DataFrame(rows).sort_values(['tag']).reset_index(drop=True)
+    table.to_csv(f'{SWEEP_DIR}/{tag}.csv', index=False)
+    return table
+
+
+def summarize_sweep(table: pd.DataFrame, grid: Dict[str, List[Any]]) -> pd.DataFrame:
+    """
+    :return: mean and standard deviation over the seeds of the reported metrics, per combination of `grid`
+    """
+    keys = list(grid.keys())
+    return table.groupby(keys)[['validate', 'test']].agg(['mean', 'std', 'count'])
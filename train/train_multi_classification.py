@@ -1,3 +1,4 @@
+import os
 import time
 import torch
 import torch.nn as nn
@@ -16,10 +17,16 @@ from net.config import ConfType
 from net.models import GeomNN
 from net.components import MLP
 from .config import TOX21_CONFIG, SARS_CONFIG
-from .utils.cache_batch import Batch, BatchCache, load_batch_cache, load_encode_mols, batch_cuda_copy
+from .utils.cache_batch import Batch, load_memoized, BatchCache, load_batch_cache, load_encode_mols, batch_cuda_copy, \
+    sample_batches
 from .utils.seed import set_seed
+from .utils.distributed import init_distributed, is_main_process, barrier, shard_batches, \
+    broadcast_parameters, all_reduce_gradients, all_reduce_metrics, broadcast_flag, all_gather_array
+from .utils.amp import amp_autocast, amp_grad_scaler, set_tf32
 from .utils.loss_functions import multi_roc, hierarchical_adj3_loss, distance_loss
 from .utils.save_log import save_log
+from .utils.checkpoint import get_checkpoint_path, save_checkpoint, load_checkpoint
+from .utils.metrics import MetricAccumulator
 
 
 class MultiClassificationDataset(Enum):
@@ -29,8 +36,14 @@ class MultiClassificationDataset(Enum):
 
 def train_multi_classification(special_config: dict = None, dataset=MultiClassificationDataset.TOX21,
                                use_cuda=False, max_num=-1, data_name='TOX21', seed=0, force_save=False, tag='TOX21',
-                               use_tqdm=False):
+                               use_tqdm=False, resume=False) -> List[Dict[str, float]]:
     # set parameters and seed
+    rank, world_size = init_distributed(use_cuda)
+    force_save = force_save and is_main_process()
+    checkpoint_path = get_checkpoint_path(tag)
+    if resume and os.path.exists(checkpoint_path):
+        # carry on with the caches the checkpoint was trained on
+        force_save = False
     print(f'For {tag}:')
     if dataset == MultiClassificationDataset.TOX21:
         config = TOX21_CONFIG.copy()
@@ -44,15 +57,18 @@ def train_multi_classification(special_config: dict = None, dataset=MultiClassif
     rdkit_support = config['CONF_TYPE'] == ConfType.RDKIT or config['CONF_TYPE'] == ConfType.NEWTON_RGT
     conf_supervised = config['CONF_TYPE'] == ConfType.NEWTON_RGT
     set_seed(seed, use_cuda=use_cuda)
+    set_tf32(config['TF32'])
     np.set_printoptions(suppress=True, precision=3, linewidth=200)
 
-    # load dataset
+    # load dataset, the main process building the caches on disk before the others load them
+    if not is_main_process():
+        barrier()
     print('Loading:')
     if dataset == MultiClassificationDataset.TOX21:
-        mols, mol_properties = load_tox21(max_num, force_save=force_save)
+        mols, mol_properties = load_memoized(load_tox21, max_num, force_save=force_save)
         n_class = 2
     else:
-        mols, mol_properties = load_sars(max_num, force_save=force_save)
+        mols, mol_properties = load_memoized(load_sars, max_num, force_save=force_save)
         n_class = 4
     mols_info = load_encode_mols(mols, name=data_name, force_save=force_save)
 
@@ -80,11 +96,22 @@ def train_multi_classification(special_config: dict = None, dataset=MultiClassif
     try:
         batch_cache = load_batch_cache(data_name, mols, mols_info, mol_properties, batch_size=config['BATCH'],
                                        needs_rdkit_conf=rdkit_support, contains_ground_truth_conf=False,
-                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=force_save)
+                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=force_save,
+                                       dynamic=config['DYNAMIC_BATCH'], n_workers=config['LOADER_WORKERS'],
+                                       batch_budget=config['BATCH_BUDGET'], budget_unit=config['BUDGET_UNIT'],
+                                       sparse=config['SPARSE'])
     except EOFError:
         batch_cache = load_batch_cache(data_name, mols, mols_info, mol_properties, batch_size=config['BATCH'],
                                        needs_rdkit_conf=rdkit_support, contains_ground_truth_conf=False,
-                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=True)
+                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=True,
+                                       dynamic=config['DYNAMIC_BATCH'], n_workers=config['LOADER_WORKERS'],
+                                       batch_budget=config['BATCH_BUDGET'], budget_unit=config['BUDGET_UNIT'],
+                                       sparse=config['SPARSE'])
+    if is_main_process():
+        barrier()
+    if world_size > 1:
+        # draw the same shuffles on every process, whichever of them built the caches
+        set_seed(seed, use_cuda=use_cuda)
 
     # build model
     print('Building Models...')
@@ -110,8 +137,12 @@ def train_multi_classification(special_config: dict = None, dataset=MultiClassif
 
     # initialize optimization
     parameters = list(chain(model.parameters(), *[c.parameters() for c in classifiers]))
+    broadcast_parameters(parameters)
     optimizer = optim.Adam(params=parameters, lr=config['LR'], weight_decay=config['DECAY'])
     scheduler = optim.lr_scheduler.StepLR(optimizer=optimizer, step_size=1, gamma=config['GAMMA'])
+    scaler = amp_grad_scaler(config, use_cuda)
+    # the compiled module shares its parameters with `model`, which stays the one to save and load
+    forward_model = torch.compile(model, dynamic=True) if config['COMPILE'] else model
     print('##### Parameters #####')
 
     param_size = 0
@@ -123,6 +154,8 @@ def train_multi_classification(special_config: dict = None, dataset=MultiClassif
     # train
     epoch = 0
     logs: List[Dict[str, float]] = []
+    best_epoch = 0
+    best_metric = 0
     loss_funcs = [nn.CrossEntropyLoss(weight=weight_label_class[i]) for i in range(n_label)]
     c_loss_fuc = hierarchical_adj3_loss
 
@@ -137,15 +170,17 @@ def train_multi_classification(special_config: dict = None, dataset=MultiClassif
         for cls in classifiers:
             cls.train()
         optimizer.zero_grad()
-        losses = []
+        batches = shard_batches(batches)
         n_batch = len(batches)
         if use_tqdm:
             batches = tqdm(batches, total=n_batch)
         for i, batch in enumerate(batches):
             if use_cuda:
                 batch = batch_cuda_copy(batch)
-            fp, pred_cs, *_ = model.forward(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
-                                            batch.rdkit_conf)
+            with amp_autocast(config, use_cuda):
+                fp, pred_cs, *_ = forward_model(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
+                                                batch.rdkit_conf)
+            fp, pred_cs = fp.float(), [c.float() for c in pred_cs]
             p_losses = []
             for j, cls in enumerate(classifiers):
                 pred_p = cls.forward(fp)
@@ -159,32 +194,38 @@ def train_multi_classification(special_config: dict = None, dataset=MultiClassif
                 loss = p_loss + config['LAMBDA'] * c_loss
             else:
                 loss = p_loss
-            # loss.backward()
-            # optimizer.step()
-            losses.append(loss)
-            if len(losses) >= config['PACK'] or i == n_batch - 1:
-                (sum(losses) / len(losses)).backward()
-                optimizer.step()
-                losses.clear()
-
-    def evaluate(batches: List[Batch], batch_name: str):
+            # each batch of a pack is backpropagated at once, so that only one graph is alive at a time,
+            # and weighted as in the mean loss of its pack
+            pack_size = min(config['PACK'], n_batch - i // config['PACK'] * config['PACK'])
+            if torch.is_tensor(loss):
+                scaler.scale(loss / pack_size).backward()
+            if (i + 1) % config['PACK'] == 0 or i == n_batch - 1:
+                all_reduce_gradients(parameters)
+                scaler.step(optimizer)
+                scaler.update()
+                # a scaled step unscales the gradients in place and may leave them inf, so they cannot carry over
+                if scaler.is_enabled():
+                    optimizer.zero_grad()
+
+    def evaluate(batches: List[Batch], batch_name: str) -> float:
         model.eval()
         for cls in classifiers:
             cls.eval()
         optimizer.zero_grad()
+        batches = shard_batches(batches, even=False)
         n_batch = len(batches)
-        list_loss = []
+        metrics = MetricAccumulator()
         list_preds_p = [[] for _ in range(n_label)]
         list_properties = []
-        list_c_loss = []
-        list_rsd = []
         if use_tqdm:
             batches = tqdm(batches, total=n_batch)
         for batch in batches:
             if use_cuda:
                 batch = batch_cuda_copy(batch)
-            fp, pred_cs, *_ = model.forward(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
-                                            batch.rdkit_conf)
+            with amp_autocast(config, use_cuda):
+                fp, pred_cs, *_ = forward_model(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
+                                                batch.rdkit_conf)
+            fp, pred_cs = fp.float(), [c.float() for c in pred_cs]
             p_losses = []
             for j, cls in enumerate(classifiers):
                 pred_p = cls.forward(fp)
@@ -192,40 +233,56 @@ def train_multi_classification(special_config: dict = None, dataset=MultiClassif
                 if pred_p_.shape[0] == 0:
                     continue
                 p_losses.append(loss_funcs[j](pred_p_, properties_.type(torch.long)))
-                list_preds_p[j].append(pred_p_.cpu().detach().numpy())
+                list_preds_p[j].append(pred_p_.detach())
             p_loss = sum(p_losses)
             if conf_supervised:
                 c_loss = c_loss_fuc(pred_cs, batch.conformation, batch.mask_matrices, use_cuda=use_cuda)
                 loss = p_loss + config['LAMBDA'] * c_loss
                 rsd = distance_loss(pred_cs[-1], batch.conformation, batch.mask_matrices, root_square=True)
-                list_rsd.append(rsd.cpu().item())
-                list_c_loss.append(loss.cpu().item())
+                metrics.add('rsd', rsd)
+                metrics.add('c_loss', loss)
             else:
                 loss = p_loss
-            list_loss.append(loss.cpu().item())
+            metrics.add('loss', loss)
 
-            list_properties.append(batch.properties.cpu().numpy())
-        list_pred_p = [np.vstack(preds_p) for preds_p in list_preds_p]
-        properties = np.vstack(list_properties)
+            list_properties.append(batch.properties)
+        # predictions stay on device until the split is over
+        # and are gathered from the shards of all the processes
+        list_pred_p = [all_gather_array(torch.cat(preds_p).cpu().numpy() if len(preds_p)
+                                        else np.zeros([0, n_class], dtype=np.float32)) for preds_p in list_preds_p]
+        properties = all_gather_array(torch.cat(list_properties).cpu().numpy())
         p_total_roc, p_multi_roc = multi_roc(list_pred_p, properties)
 
-        print(f'\t\t\tLOSS: {sum(list_loss) / n_batch}')
+        means = all_reduce_metrics(metrics).means()
+        print(f'\t\t\tLOSS: {means["loss"]}')
         print(f'\t\t\tAVG-ROC: {p_total_roc}')
         print(f'\t\t\tMULTI-ROC: {p_multi_roc}')
         logs[-1].update({
-            f'{batch_name}_loss': sum(list_loss) / n_batch,
+            f'{batch_name}_loss': means['loss'],
             f'{batch_name}_p_metric': p_total_roc,
             f'{batch_name}_p_multi_metric': p_multi_roc,
         })
         if conf_supervised:
-            print(f'\t\t\tC LOSS: {sum(list_c_loss) / n_batch}')
-            print(f'\t\t\tDL-RS: {sum(list_rsd) / n_batch}')
+            print(f'\t\t\tC LOSS: {means["c_loss"]}')
+            print(f'\t\t\tDL-RS: {means["rsd"]}')
             logs[-1].update({
-                f'{batch_name}_c_loss': sum(list_c_loss) / n_batch,
-                f'{batch_name}_c_metric': sum(list_rsd) / n_batch,
+                f'{batch_name}_c_loss': means['c_loss'],
+                f'{batch_name}_c_metric': means['rsd'],
             })
+        return p_total_roc
+
+    # carry on from the last checkpoint of this tag, if any
+    modules = dict({'model': model}, **{f'classifier-{i}': c for i, c in enumerate(classifiers)})
+    state = load_checkpoint(checkpoint_path, modules, optimizer, scheduler, scaler, use_cuda) if resume else None
+    if state is not None:
+        epoch, logs, best_epoch, best_metric = state['epoch'], state['logs'], state['best_epoch'], state['best_metric']
+        print(f'Resuming after epoch {epoch}...')
 
-    for _ in range(config['EPOCH']):
+    t_start = time.time()
+    for _ in range(config['EPOCH'] - epoch):
+        if config['PATIENCE'] and epoch - best_epoch >= config['PATIENCE']:
+            print(f'\nStopping early: no better validation since epoch {best_epoch}')
+            break
         epoch += 1
         t0 = time.time()
 
@@ -235,15 +292,31 @@ def train_multi_classification(special_config: dict = None, dataset=MultiClassif
         print('\tCurrent LR: {:.3e}'.format(optimizer.state_dict()['param_groups'][0]['lr']))
         print('\t\tTraining:')
         train(batch_cache.train_batches)
-        print('\t\tEvaluating Train:')
-        evaluate(batch_cache.train_batches, 'train')
+        if epoch % config['TRAIN_EVAL_EVERY'] == 0:
+            print('\t\tEvaluating Train:')
+            evaluate(sample_batches(batch_cache.train_batches, config['TRAIN_EVAL_BATCHES']), 'train')
         print('\t\tEvaluating Validate:')
-        evaluate(batch_cache.validate_batches, 'validate')
-        print('\t\tEvaluating Test:')
-        evaluate(batch_cache.test_batches, 'test')
+        m = evaluate(batch_cache.validate_batches, 'validate')
+        is_best = m > best_metric
+        if is_best:
+            best_metric = m
+            best_epoch = epoch
+        # the test metric only matters at the epochs a model would be selected
+        if is_best or not config['TEST_ON_BEST_ONLY']:
+            print('\t\tEvaluating Test:')
+            evaluate(batch_cache.test_batches, 'test')
         scheduler.step(epoch)
 
         t1 = time.time()
         print('\tProcess Time: {}'.format(int(t1 - t0)))
-        logs[-1].update({'process_time': t1 - t0})
-        save_log(logs, directory='TOX21' if dataset == MultiClassificationDataset.TOX21 else 'sars', tag=tag)
+        logs[-1].update({'process_time': t1 - t0, 'best_epoch': best_epoch})
+        if is_main_process():
+            save_log(logs, directory='TOX21' if dataset == MultiClassificationDataset.TOX21 else 'sars', tag=tag)
+        if config['CHECKPOINT_EVERY'] and epoch % config['CHECKPOINT_EVERY'] == 0 and is_main_process():
+            save_checkpoint(checkpoint_path, modules, optimizer, scheduler, scaler, use_cuda,
+                            epoch=epoch, logs=logs, best_epoch=best_epoch, best_metric=best_metric)
+        # stop when one more epoch, as long as the last one, would overrun the time budget
+        if broadcast_flag(config['TIME_BUDGET'] and time.time() - t_start + t1 - t0 > config['TIME_BUDGET']):
+            print(f'\nStopping after epoch {epoch}: out of time budget')
+            break
+    return logs
@@ -1,5 +1,6 @@
 import os
 import time
+import pickle
 import torch
 import torch.optim as optim
 import numpy as np
@@ -17,12 +18,17 @@ from data.qm9.load_qm9 import load_qm9
 from net.config import ConfType
 from net.models import GeomNN, MLP
 from .config import QM9_CONFIG
-from .utils.cache_batch import Batch, load_batch_cache, load_encode_mols, batch_cuda_copy
+from .utils.cache_batch import Batch, load_memoized, load_batch_cache, load_encode_mols, batch_cuda_copy, sample_batches
 from .utils.seed import set_seed
+from .utils.distributed import init_distributed, is_main_process, barrier, shard_batches, \
+    broadcast_parameters, all_reduce_gradients, all_reduce_metrics, broadcast_flag
+from .utils.amp import amp_autocast, amp_grad_scaler, set_tf32
 from .utils.loss_functions import multi_mse_loss, multi_mae_loss, adj3_loss, distance_loss, \
     hierarchical_adj2_loss, hierarchical_adj3_loss, hierarchical_adj4_loss, kabsch_rmsd_loss, \
     hierarchical_mixed_kabsch_adj3_loss
 from .utils.save_log import save_log
+from .utils.checkpoint import get_checkpoint_path, save_checkpoint, load_checkpoint
+from .utils.metrics import MetricAccumulator
 
 MODEL_DICT_DIR = 'train/models'
 
@@ -35,8 +41,14 @@ class QMDataset(Enum):
 
 def train_qm9(special_config: dict = None, dataset=QMDataset.QM9,
               use_cuda=False, max_num=-1, data_name='QM9', seed=0, force_save=False, tag='QM9',
-              use_tqdm=False):
+              use_tqdm=False, resume=False) -> List[Dict[str, float]]:
     # set parameters and seed
+    rank, world_size = init_distributed(use_cuda)
+    force_save = force_save and is_main_process()
+    checkpoint_path = get_checkpoint_path(tag)
+    if resume and os.path.exists(checkpoint_path):
+        # carry on with the caches the checkpoint was trained on
+        force_save = False
     print(f'For {tag}:')
     config = QM9_CONFIG.copy()
     if special_config is not None:
@@ -49,20 +61,23 @@ def train_qm9(special_config: dict = None, dataset=QMDataset.QM9,
     rdkit_groundtruth = config['CONF_TYPE'] == ConfType.NEWTON_RGT
     conf_only = config['CONF_TYPE'] == ConfType.ONLY
     set_seed(seed, use_cuda=use_cuda)
+    set_tf32(config['TF32'])
     np.set_printoptions(suppress=True, precision=3, linewidth=200)
 
-    # load dataset
+    # load dataset, the main process building the caches on disk before the others load them
+    if not is_main_process():
+        barrier()
     print('Loading:')
     # mol_list_weight_mol, mol_properties = load_geom_qm9(max_num)
     # mols = [list_weight_mol[0][1] for list_weight_mol in mol_list_weight_mol]
     if dataset == QMDataset.QM7:
-        mols, mol_properties = load_qm7(max_num)
+        mols, mol_properties = load_memoized(load_qm7, max_num)
         mols_info = load_encode_mols(mols, name=data_name, force_save=force_save)
     elif dataset == QMDataset.QM8:
-        mols, mol_properties = load_qm8(max_num)
+        mols, mol_properties = load_memoized(load_qm8, max_num)
         mols_info = load_encode_mols(mols, name=data_name, force_save=force_save)
     else:
-        mols, mol_properties = load_qm9(max_num)
+        mols, mol_properties = load_memoized(load_qm9, max_num)
         mols_info = load_encode_mols(mols, name=data_name, force_save=force_save)
 
     # normalize properties and cache batches
@@ -83,11 +98,22 @@ def train_qm9(special_config: dict = None, dataset=QMDataset.QM9,
     try:
         batch_cache = load_batch_cache(data_name, mols, mols_info, norm_p, batch_size=config['BATCH'],
                                        needs_rdkit_conf=rdkit_support, contains_ground_truth_conf=not rdkit_groundtruth,
-                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=force_save)
+                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=force_save,
+                                       dynamic=config['DYNAMIC_BATCH'], n_workers=config['LOADER_WORKERS'],
+                                       batch_budget=config['BATCH_BUDGET'], budget_unit=config['BUDGET_UNIT'],
+                                       sparse=config['SPARSE'])
     except EOFError:
         batch_cache = load_batch_cache(data_name, mols, mols_info, norm_p, batch_size=config['BATCH'],
                                        needs_rdkit_conf=rdkit_support, contains_ground_truth_conf=not rdkit_groundtruth,
-                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=True)
+                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=True,
+                                       dynamic=config['DYNAMIC_BATCH'], n_workers=config['LOADER_WORKERS'],
+                                       batch_budget=config['BATCH_BUDGET'], budget_unit=config['BUDGET_UNIT'],
+                                       sparse=config['SPARSE'])
+    if is_main_process():
+        barrier()
+    if world_size > 1:
+        # draw the same shuffles on every process, whichever of them built the caches
+        set_seed(seed, use_cuda=use_cuda)
 
     # build model
     print('Building Models...')
@@ -112,8 +138,12 @@ def train_qm9(special_config: dict = None, dataset=QMDataset.QM9,
 
     # initialize optimization
     parameters = list(chain(model.parameters(), classifier.parameters()))
+    broadcast_parameters(parameters)
     optimizer = optim.Adam(params=parameters, lr=config['LR'], weight_decay=config['DECAY'])
     scheduler = optim.lr_scheduler.StepLR(optimizer=optimizer, step_size=1, gamma=config['GAMMA'])
+    scaler = amp_grad_scaler(config, use_cuda)
+    # the compiled module shares its parameters with `model`, which stays the one to save and load
+    forward_model = torch.compile(model, dynamic=True) if config['COMPILE'] else model
     print('##### Parameters #####')
 
     param_size = 0
@@ -148,19 +178,27 @@ def train_qm9(special_config: dict = None, dataset=QMDataset.QM9,
             os.mkdir(MODEL_DICT_DIR)
     except FileExistsError:
         pass
+    # what inference needs besides the weights, see `train.predict.Predictor`
+    if is_main_process():
+        with open(f'{MODEL_DICT_DIR}/{tag}-meta.pickle', 'wb+') as fp:
+            pickle.dump({'config': config, 'atom_dim': atom_dim, 'bond_dim': bond_dim,
+                         'mean': mean_p, 'std': stddev_p}, fp)
 
     def train(batches: List[Batch]):
         model.train()
         classifier.train()
         optimizer.zero_grad()
+        batches = shard_batches(batches)
         n_batch = len(batches)
         if use_tqdm:
             batches = tqdm(batches, total=n_batch)
         for batch in batches:
             if use_cuda:
                 batch = batch_cuda_copy(batch)
-            fp, pred_cs, *_ = model.forward(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
-                                            batch.rdkit_conf if not real_support else batch.conformation)
+            with amp_autocast(config, use_cuda):
+                fp, pred_cs, *_ = forward_model(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
+                                                batch.rdkit_conf if not real_support else batch.conformation)
+            fp, pred_cs = fp.float(), [c.float() for c in pred_cs]
             pred_p = classifier.forward(fp)
             if dataset == QMDataset.QM7:
                 p_loss = multi_mae_loss(pred_p, batch.properties)
@@ -177,28 +215,30 @@ def train_qm9(special_config: dict = None, dataset=QMDataset.QM9,
                 loss = config['LAMBDA'] * c_loss
             else:
                 loss = p_loss + config['LAMBDA'] * c_loss
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            all_reduce_gradients(parameters)
+            scaler.step(optimizer)
+            scaler.update()
+            # a scaled step unscales the gradients in place and may leave them inf, so they cannot carry over
+            if scaler.is_enabled():
+                optimizer.zero_grad()
 
     def evaluate(batches: List[Batch], batch_name: str) -> float:
         model.eval()
         classifier.eval()
         optimizer.zero_grad()
+        batches = shard_batches(batches, even=False)
         n_batch = len(batches)
-        list_p_loss = []
-        list_c_loss = []
-        list_loss = []
-        list_p_multi_mae = []
-        list_p_total_mae = []
-        list_rsd = []
-        list_kabsch = []
+        metrics = MetricAccumulator()
         if use_tqdm:
             batches = tqdm(batches, total=n_batch)
         for batch in batches:
             if use_cuda:
                 batch = batch_cuda_copy(batch)
-            fp, pred_cs, *_ = model.forward(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
-                                            batch.rdkit_conf if not real_support else batch.conformation)
+            with amp_autocast(config, use_cuda):
+                fp, pred_cs, *_ = forward_model(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
+                                                batch.rdkit_conf if not real_support else batch.conformation)
+            fp, pred_cs = fp.float(), [c.float() for c in pred_cs]
             pred_p = classifier.forward(fp)
             if dataset == QMDataset.QM7:
                 p_loss = multi_mae_loss(pred_p, batch.properties)
@@ -215,46 +255,59 @@ def train_qm9(special_config: dict = None, dataset=QMDataset.QM9,
                 loss = config['LAMBDA'] * c_loss
             else:
                 loss = p_loss + config['LAMBDA'] * c_loss
-            list_p_loss.append(p_loss.cpu().item())
-            list_c_loss.append(c_loss.cpu().item())
-            list_loss.append(loss.cpu().item())
+            metrics.add('p_loss', p_loss)
+            metrics.add('c_loss', c_loss)
+            metrics.add('loss', loss)
 
             p_multi_mae = multi_mae_loss(pred_p, batch.properties, explicit=True)
             p_total_mae = p_multi_mae.sum()
             rsd = distance_loss(pred_cs[-1], batch.conformation, batch.mask_matrices, root_square=True)
-            list_p_multi_mae.append(p_multi_mae.cpu().detach().numpy())
-            list_p_total_mae.append(p_total_mae.cpu().item())
-            list_rsd.append(rsd.cpu().item())
+            metrics.add('p_multi_mae', p_multi_mae)
+            metrics.add('p_total_mae', p_total_mae)
+            metrics.add('rsd', rsd)
             if config['CONF_LOSS'] in ['H_mixed', 'Kabsch']:
                 kabsch = kabsch_rmsd_loss(pred_cs[-1], batch.conformation, batch.mask_matrices, use_cuda=use_cuda)
-                list_kabsch.append(kabsch.cpu().item())
+                metrics.add('kabsch', kabsch)
 
-        print(f'\t\t\tP LOSS: {sum(list_p_loss) / n_batch}')
-        print(f'\t\t\tC LOSS: {sum(list_c_loss) / n_batch}')
-        print(f'\t\t\tTOTAL LOSS: {sum(list_loss) / n_batch}')
-        print(f'\t\t\tPROPERTIES MULTI-MAE: {sum(list_p_multi_mae) * stddev_p / n_batch}')
+        means = all_reduce_metrics(metrics).means()
+        p_multi_mae = means['p_multi_mae'] * stddev_p
+        print(f'\t\t\tP LOSS: {means["p_loss"]}')
+        print(f'\t\t\tC LOSS: {means["c_loss"]}')
+        print(f'\t\t\tTOTAL LOSS: {means["loss"]}')
+        print(f'\t\t\tPROPERTIES MULTI-MAE: {p_multi_mae}')
         if dataset == QMDataset.QM8:
-            total_mae = np.sum(sum(list_p_multi_mae) * stddev_p / n_batch)
+            total_mae = np.sum(p_multi_mae)
         else:
-            total_mae = sum(list_p_total_mae) / n_batch
+            total_mae = means['p_total_mae']
         print(f'\t\t\tPROPERTIES TOTAL MAE: {total_mae}')
-        print(f'\t\t\tCONFORMATION RS-DL: {sum(list_rsd) / n_batch}')
+        print(f'\t\t\tCONFORMATION RS-DL: {means["rsd"]}')
         if config['CONF_LOSS'] in ['H_mixed', 'Kabsch']:
-            print(f'\t\t\tKABSCH RMSD: {sum(list_kabsch) / n_batch}')
+            print(f'\t\t\tKABSCH RMSD: {means["kabsch"]}')
             logs[-1].update({
-                f'{batch_name}_kabsch': sum(list_kabsch) / n_batch,
+                f'{batch_name}_kabsch': means['kabsch'],
             })
         logs[-1].update({
-            f'{batch_name}_p_loss': sum(list_p_loss) / n_batch,
-            f'{batch_name}_c_loss': sum(list_c_loss) / n_batch,
-            f'{batch_name}_loss': sum(list_loss) / n_batch,
+            f'{batch_name}_p_loss': means['p_loss'],
+            f'{batch_name}_c_loss': means['c_loss'],
+            f'{batch_name}_loss': means['loss'],
             f'{batch_name}_p_metric': total_mae,
-            f'{batch_name}_multi_p_metric': list(sum(list_p_multi_mae) * stddev_p / n_batch),
-            f'{batch_name}_c_metric': sum(list_rsd) / n_batch,
+            f'{batch_name}_multi_p_metric': list(p_multi_mae),
+            f'{batch_name}_c_metric': means['rsd'],
         })
-        return sum(list_p_total_mae) / n_batch
+        return means['p_total_mae']
 
-    for _ in range(config['EPOCH']):
+    # carry on from the last checkpoint of this tag, if any
+    modules = {'model': model, 'classifier': classifier}
+    state = load_checkpoint(checkpoint_path, modules, optimizer, scheduler, scaler, use_cuda) if resume else None
+    if state is not None:
+        epoch, logs, best_epoch, best_metric = state['epoch'], state['logs'], state['best_epoch'], state['best_metric']
+        print(f'Resuming after epoch {epoch}...')
+
+    t_start = time.time()
+    for _ in range(config['EPOCH'] - epoch):
+        if config['PATIENCE'] and epoch - best_epoch >= config['PATIENCE']:
+            print(f'\nStopping early: no better validation since epoch {best_epoch}')
+            break
         epoch += 1
         t0 = time.time()
 
@@ -264,27 +317,42 @@ def train_qm9(special_config: dict = None, dataset=QMDataset.QM9,
         print('\tCurrent LR: {:.3e}'.format(optimizer.state_dict()['param_groups'][0]['lr']))
         print('\t\tTraining:')
         train(batch_cache.train_batches)
-        print('\t\tEvaluating Train:')
-        evaluate(batch_cache.train_batches, 'train')
+        if epoch % config['TRAIN_EVAL_EVERY'] == 0:
+            print('\t\tEvaluating Train:')
+            evaluate(sample_batches(batch_cache.train_batches, config['TRAIN_EVAL_BATCHES']), 'train')
         print('\t\tEvaluating Validate:')
         m = evaluate(batch_cache.validate_batches, 'validate')
-        print('\t\tEvaluating Test:')
-        evaluate(batch_cache.test_batches, 'test')
+        is_best = m < best_metric
+        if is_best:
+            best_metric = m
+            best_epoch = epoch
+        # the test metric only matters at the epochs a model would be selected
+        if is_best or not config['TEST_ON_BEST_ONLY']:
+            print('\t\tEvaluating Test:')
+            evaluate(batch_cache.test_batches, 'test')
         scheduler.step()
 
         t1 = time.time()
         print('\tProcess Time: {}'.format(int(t1 - t0)))
         logs[-1].update({'process_time': t1 - t0})
 
-        if m < best_metric:
-            best_metric = m
-            best_epoch = epoch
+        if is_best:
             print(f'\tSaving Model...')
-            torch.save(model.state_dict(), f'{MODEL_DICT_DIR}/{tag}-model.pkl')
-            torch.save(classifier.state_dict(), f'{MODEL_DICT_DIR}/{tag}-classifier.pkl')
+            if is_main_process():
+                torch.save(model.state_dict(), f'{MODEL_DICT_DIR}/{tag}-model.pkl')
+                torch.save(classifier.state_dict(), f'{MODEL_DICT_DIR}/{tag}-classifier.pkl')
         logs[-1].update({'best_epoch': best_epoch})
-        save_log(logs,
-                 directory='QM7' if dataset == QMDataset.QM7
-                 else 'QM8' if dataset == QMDataset.QM8
-                 else 'QM9',
-                 tag=tag)
+        if is_main_process():
+            save_log(logs,
+                     directory='QM7' if dataset == QMDataset.QM7
+                     else 'QM8' if dataset == QMDataset.QM8
+                     else 'QM9',
+                     tag=tag)
+        if config['CHECKPOINT_EVERY'] and epoch % config['CHECKPOINT_EVERY'] == 0 and is_main_process():
+            save_checkpoint(checkpoint_path, modules, optimizer, scheduler, scaler, use_cuda,
+                            epoch=epoch, logs=logs, best_epoch=best_epoch, best_metric=best_metric)
+        # stop when one more epoch, as long as the last one, would overrun the time budget
+        if broadcast_flag(config['TIME_BUDGET'] and time.time() - t_start + t1 - t0 > config['TIME_BUDGET']):
+            print(f'\nStopping after epoch {epoch}: out of time budget')
+            break
+    return logs
@@ -1,4 +1,5 @@
 import gc
+import os
 import time
 import torch
 import torch.optim as optim
@@ -17,10 +18,16 @@ from net.config import ConfType
 from net.models import GeomNN
 from net.components import MLP
 from .config import LIPOP_CONFIG, ESOL_CONFIG, FREESOLV_CONFIG
-from .utils.cache_batch import Batch, BatchCache, load_batch_cache, load_encode_mols, batch_cuda_copy
+from .utils.cache_batch import Batch, load_memoized, BatchCache, load_batch_cache, load_encode_mols, batch_cuda_copy, \
+    sample_batches
 from .utils.seed import set_seed
+from .utils.distributed import init_distributed, is_main_process, barrier, shard_batches, \
+    broadcast_parameters, all_reduce_gradients, all_reduce_metrics, broadcast_flag
+from .utils.amp import amp_autocast, amp_grad_scaler, set_tf32
 from .utils.loss_functions import mae_loss, mse_loss, rmse_loss, hierarchical_adj3_loss, distance_loss
 from .utils.save_log import save_log
+from .utils.checkpoint import get_checkpoint_path, save_checkpoint, load_checkpoint
+from .utils.metrics import MetricAccumulator
 
 
 class SingleRegressionDataset(Enum):
@@ -33,8 +40,14 @@ def train_single_regression(
         dataset, data_name, tag,
         special_config: dict = None,
         use_cuda=False, max_num=-1, seed=0, force_save=False,
-        use_tqdm=False):
+        use_tqdm=False, resume=False) -> List[Dict[str, float]]:
     # set parameters and seed
+    rank, world_size = init_distributed(use_cuda)
+    force_save = force_save and is_main_process()
+    checkpoint_path = get_checkpoint_path(tag)
+    if resume and os.path.exists(checkpoint_path):
+        # carry on with the caches the checkpoint was trained on
+        force_save = False
     print(f'For {tag}:')
     if dataset == SingleRegressionDataset.LIPOP:
         config = LIPOP_CONFIG.copy()
@@ -52,16 +65,19 @@ def train_single_regression(
     rdkit_support = config['CONF_TYPE'] == ConfType.RDKIT or config['CONF_TYPE'] == ConfType.NEWTON_RGT
     conf_supervised = config['CONF_TYPE'] == ConfType.NEWTON_RGT
     set_seed(seed, use_cuda=use_cuda)
+    set_tf32(config['TF32'])
     np.set_printoptions(suppress=True, precision=3, linewidth=200)
 
-    # load dataset
+    # load dataset, the main process building the caches on disk before the others load them
+    if not is_main_process():
+        barrier()
     print('Loading:')
     if dataset == SingleRegressionDataset.LIPOP:
-        mols, mol_properties = load_lipop(max_num)
+        mols, mol_properties = load_memoized(load_lipop, max_num)
     elif dataset == SingleRegressionDataset.ESOL:
-        mols, mol_properties = load_esol(max_num)
+        mols, mol_properties = load_memoized(load_esol, max_num)
     elif dataset == SingleRegressionDataset.FREESOLV:
-        mols, mol_properties = load_freesolv(max_num)
+        mols, mol_properties = load_memoized(load_freesolv, max_num)
     else:
         assert False
     mols_info = load_encode_mols(mols, name=data_name, force_save=force_save)
@@ -76,11 +92,22 @@ def train_single_regression(
     try:
         batch_cache = load_batch_cache(data_name, mols, mols_info, norm_p, batch_size=config['BATCH'],
                                        needs_rdkit_conf=rdkit_support, contains_ground_truth_conf=False,
-                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=force_save)
+                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=force_save,
+                                       dynamic=config['DYNAMIC_BATCH'], n_workers=config['LOADER_WORKERS'],
+                                       batch_budget=config['BATCH_BUDGET'], budget_unit=config['BUDGET_UNIT'],
+                                       sparse=config['SPARSE'])
     except EOFError:
         batch_cache = load_batch_cache(data_name, mols, mols_info, norm_p, batch_size=config['BATCH'],
                                        needs_rdkit_conf=rdkit_support, contains_ground_truth_conf=False,
-                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=True)
+                                       use_cuda=use_cuda, use_tqdm=use_tqdm, force_save=True,
+                                       dynamic=config['DYNAMIC_BATCH'], n_workers=config['LOADER_WORKERS'],
+                                       batch_budget=config['BATCH_BUDGET'], budget_unit=config['BUDGET_UNIT'],
+                                       sparse=config['SPARSE'])
+    if is_main_process():
+        barrier()
+    if world_size > 1:
+        # draw the same shuffles on every process, whichever of them built the caches
+        set_seed(seed, use_cuda=use_cuda)
 
     # build model
     print('Building Models...')
@@ -105,8 +132,12 @@ def train_single_regression(
 
     # initialize optimization
     parameters = list(chain(model.parameters(), classifier.parameters()))
+    broadcast_parameters(parameters)
     optimizer = optim.Adam(params=parameters, lr=config['LR'], weight_decay=config['DECAY'])
     scheduler = optim.lr_scheduler.StepLR(optimizer=optimizer, step_size=1, gamma=config['GAMMA'])
+    scaler = amp_grad_scaler(config, use_cuda)
+    # the compiled module shares its parameters with `model`, which stays the one to save and load
+    forward_model = torch.compile(model, dynamic=True) if config['COMPILE'] else model
     print('##### Parameters #####')
 
     param_size = 0
@@ -118,6 +149,8 @@ def train_single_regression(
     # train
     epoch = 0
     logs: List[Dict[str, float]] = []
+    best_epoch = 0
+    best_metric = 999
     p_loss_fuc = mse_loss if dataset == SingleRegressionDataset.FREESOLV else rmse_loss
     c_loss_fuc = hierarchical_adj3_loss
 
@@ -125,15 +158,17 @@ def train_single_regression(
         model.train()
         classifier.train()
         optimizer.zero_grad()
+        batches = shard_batches(batches)
         n_batch = len(batches)
-        losses = []
         if use_tqdm:
             batches = tqdm(batches, total=n_batch)
         for i, batch in enumerate(batches):
             if use_cuda:
                 batch = batch_cuda_copy(batch)
-            fp, pred_cs, *_ = model.forward(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
-                                            batch.rdkit_conf)
+            with amp_autocast(config, use_cuda):
+                fp, pred_cs, *_ = forward_model(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
+                                                batch.rdkit_conf)
+            fp, pred_cs = fp.float(), [c.float() for c in pred_cs]
             pred_p = classifier.forward(fp)
             p_loss = mae_loss(pred_p, batch.properties)
             if conf_supervised:
@@ -141,66 +176,84 @@ def train_single_regression(
                 loss = p_loss + config['LAMBDA'] * c_loss
             else:
                 loss = p_loss
-            # loss.backward()
-            # optimizer.step()
-            losses.append(loss)
-            if len(losses) >= config['PACK'] or i == n_batch - 1:
-                (sum(losses) / len(losses)).backward()
-                optimizer.step()
-                losses.clear()
-                # gc.collect()
-
-    def evaluate(batches: List[Batch], batch_name: str):
+            # each batch of a pack is backpropagated at once, so that only one graph is alive at a time,
+            # and weighted as in the mean loss of its pack
+            pack_size = min(config['PACK'], n_batch - i // config['PACK'] * config['PACK'])
+            scaler.scale(loss / pack_size).backward()
+            if (i + 1) % config['PACK'] == 0 or i == n_batch - 1:
+                all_reduce_gradients(parameters)
+                scaler.step(optimizer)
+                scaler.update()
+                # a scaled step unscales the gradients in place and may leave them inf, so they cannot carry over
+                if scaler.is_enabled():
+                    optimizer.zero_grad()
+
+    def evaluate(batches: List[Batch], batch_name: str) -> float:
         model.eval()
         classifier.eval()
         optimizer.zero_grad()
+        batches = shard_batches(batches, even=False)
         n_batch = len(batches)
-        list_loss = []
-        list_p_mse = []
-        list_p_rmse = []
-        list_c_loss = []
-        list_rsd = []
+        metrics = MetricAccumulator()
         if use_tqdm:
             batches = tqdm(batches, total=n_batch)
         for batch in batches:
             if use_cuda:
                 batch = batch_cuda_copy(batch)
-            fp, pred_cs, *_ = model.forward(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
-                                            batch.rdkit_conf)
+            with amp_autocast(config, use_cuda):
+                fp, pred_cs, *_ = forward_model(batch.atom_ftr, batch.bond_ftr, batch.massive, batch.mask_matrices,
+                                                batch.rdkit_conf)
+            fp, pred_cs = fp.float(), [c.float() for c in pred_cs]
             pred_p = classifier.forward(fp)
             p_loss = mae_loss(pred_p, batch.properties)
             if conf_supervised:
                 c_loss = c_loss_fuc(pred_cs, batch.conformation, batch.mask_matrices, use_cuda=use_cuda)
                 loss = p_loss + config['LAMBDA'] * c_loss
                 rsd = distance_loss(pred_cs[-1], batch.conformation, batch.mask_matrices, root_square=True)
-                list_rsd.append(rsd.cpu().item())
-                list_c_loss.append(loss.cpu().item())
+                metrics.add('rsd', rsd)
+                metrics.add('c_loss', loss)
             else:
                 loss = p_loss
-            list_loss.append(loss.cpu().item())
+            metrics.add('loss', loss)
 
             p_mse = mse_loss(pred_p, batch.properties)
             p_rmse = mae_loss(pred_p, batch.properties)
-            list_p_mse.append(p_mse.item() * stddev_p[0] * stddev_p[0])
-            list_p_rmse.append(p_rmse.item() * stddev_p[0])
+            metrics.add('p_mse', p_mse)
+            metrics.add('p_rmse', p_rmse)
 
-        print(f'\t\t\tLOSS: {sum(list_loss) / n_batch}')
-        print(f'\t\t\tMSE: {sum(list_p_mse) / n_batch}')
-        print(f'\t\t\tRMSE: {sum(list_p_rmse) / n_batch}')
+        means = all_reduce_metrics(metrics).means()
+        p_mse = means['p_mse'] * stddev_p[0] * stddev_p[0]
+        p_rmse = means['p_rmse'] * stddev_p[0]
+        print(f'\t\t\tLOSS: {means["loss"]}')
+        print(f'\t\t\tMSE: {p_mse}')
+        print(f'\t\t\tRMSE: {p_rmse}')
         logs[-1].update({
-            f'{batch_name}_loss': sum(list_loss) / n_batch,
-            f'{batch_name}_b_metric': (sum(list_p_mse) / n_batch) ** 0.5,
-            f'{batch_name}_p_metric': sum(list_p_rmse) / n_batch,
+            f'{batch_name}_loss': means['loss'],
+            f'{batch_name}_b_metric': p_mse ** 0.5,
+            f'{batch_name}_p_metric': p_rmse,
         })
         if conf_supervised:
-            print(f'\t\t\tC LOSS: {sum(list_c_loss) / n_batch}')
-            print(f'\t\t\tDL-RS: {sum(list_rsd) / n_batch}')
+            print(f'\t\t\tC LOSS: {means["c_loss"]}')
+            print(f'\t\t\tDL-RS: {means["rsd"]}')
             logs[-1].update({
-                f'{batch_name}_c_loss': sum(list_c_loss) / n_batch,
-                f'{batch_name}_c_metric': sum(list_rsd) / n_batch,
+                f'{batch_name}_c_loss': means['c_loss'],
+                f'{batch_name}_c_metric': means['rsd'],
             })
+        # the best epoch is the one of the lowest RMSE (`b_metric`), `p_rmse` being in fact the MAE
+        return p_mse ** 0.5
+
+    # carry on from the last checkpoint of this tag, if any
+    modules = {'model': model, 'classifier': classifier}
+    state = load_checkpoint(checkpoint_path, modules, optimizer, scheduler, scaler, use_cuda) if resume else None
+    if state is not None:
+        epoch, logs, best_epoch, best_metric = state['epoch'], state['logs'], state['best_epoch'], state['best_metric']
+        print(f'Resuming after epoch {epoch}...')
 
-    for _ in range(config['EPOCH']):
+    t_start = time.time()
+    for _ in range(config['EPOCH'] - epoch):
+        if config['PATIENCE'] and epoch - best_epoch >= config['PATIENCE']:
+            print(f'\nStopping early: no better validation since epoch {best_epoch}')
+            break
         epoch += 1
         t0 = time.time()
 
@@ -210,19 +263,35 @@ def train_single_regression(
         print('\tCurrent LR: {:.3e}'.format(optimizer.state_dict()['param_groups'][0]['lr']))
         print('\t\tTraining:')
         train(batch_cache.train_batches)
-        print('\t\tEvaluating Train:')
-        evaluate(batch_cache.train_batches, 'train')
+        if epoch % config['TRAIN_EVAL_EVERY'] == 0:
+            print('\t\tEvaluating Train:')
+            evaluate(sample_batches(batch_cache.train_batches, config['TRAIN_EVAL_BATCHES']), 'train')
         print('\t\tEvaluating Validate:')
-        evaluate(batch_cache.validate_batches, 'validate')
-        print('\t\tEvaluating Test:')
-        evaluate(batch_cache.test_batches, 'test')
+        m = evaluate(batch_cache.validate_batches, 'validate')
+        is_best = m < best_metric
+        if is_best:
+            best_metric = m
+            best_epoch = epoch
+        # the test metric only matters at the epochs a model would be selected
+        if is_best or not config['TEST_ON_BEST_ONLY']:
+            print('\t\tEvaluating Test:')
+            evaluate(batch_cache.test_batches, 'test')
         scheduler.step(epoch)
 
         t1 = time.time()
         print('\tProcess Time: {}'.format(int(t1 - t0)))
-        logs[-1].update({'process_time': t1 - t0})
-        save_log(logs,
-                 directory='Lipop' if dataset == SingleRegressionDataset.LIPOP
-                 else 'ESOL' if dataset == SingleRegressionDataset.ESOL
-                 else 'FreeSolv',
-                 tag=tag)
+        logs[-1].update({'process_time': t1 - t0, 'best_epoch': best_epoch})
+        if is_main_process():
+            save_log(logs,
+                     directory='Lipop' if dataset == SingleRegressionDataset.LIPOP
+                     else 'ESOL' if dataset == SingleRegressionDataset.ESOL
+                     else 'FreeSolv',
+                     tag=tag)
+        if config['CHECKPOINT_EVERY'] and epoch % config['CHECKPOINT_EVERY'] == 0 and is_main_process():
+            save_checkpoint(checkpoint_path, modules, optimizer, scheduler, scaler, use_cuda,
+                            epoch=epoch, logs=logs, best_epoch=best_epoch, best_metric=best_metric)
+        # stop when one more epoch, as long as the last one, would overrun the time budget
+        if broadcast_flag(config['TIME_BUDGET'] and time.time() - t_start + t1 - t0 > config['TIME_BUDGET']):
+            print(f'\nStopping after epoch {epoch}: out of time budget')
+            break
+    return logs
@@ -0,0 +1,27 @@
+import torch
+
+AMP_DTYPES = {
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def set_tf32(enabled: bool):
+    torch.backends.cuda.matmul.allow_tf32 = enabled
+    torch.backends.cudnn.allow_tf32 = enabled
+
+
+def amp_autocast(config: dict, use_cuda=False) -> torch.autocast:
+    """
+    autocast region for the forward pass when `config['AMP']` is set, in `config['AMP_DTYPE']`;
+    the dynamics and the Kabsch alignment opt out of it and stay in float32
+    """
+    return torch.autocast(device_type='cuda' if use_cuda else 'cpu', dtype=AMP_DTYPES[config['AMP_DTYPE']],
+                          enabled=config['AMP'])
+
+
+def amp_grad_scaler(config: dict, use_cuda=False) -> torch.amp.GradScaler:
+    """
+    loss scaling is only needed (and only enabled) for float16 on CUDA, a no-op otherwise
+    """
+    return torch.amp.GradScaler('cuda', enabled=config['AMP'] and use_cuda and config['AMP_DTYPE'] == 'fp16')
@@ -3,15 +3,47 @@ import pickle
 import torch
 import numpy as np
 
-from typing import List, Dict, Tuple, Any, Union
+from typing import List, Dict, Tuple, Any, Union, Callable
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from data.encode import get_massive_from_atom_features, encode_mols
+from data.encode import get_massive_from_atom_features, encode_mols, encode_mols_parallel
+from data.feature_store import FeatureStore, write_feature_store
+from data.feature_cache import FeatureCache, get_feature_cache, set_feature_cache
 from net.utils.MaskMatrices import MaskMatrices, cuda_copy
-from train.utils.rdkit import rdkit_mol_positions
+from train.utils.rdkit import ConformerStore, rdkit_positions_parallel
+from train.utils.loss_functions import ADJ_MODES, get_adj_pairs
 
 CACHE_DIR = 'train/utils/cache'
 MOLS_DIR = 'train/utils/mols'
+FEATURE_CACHE_PATH = f'{MOLS_DIR}/features.sqlite'
+CONFORMER_STORE_PATH = f'{MOLS_DIR}/conformers.sqlite'
+
+# datasets, features and batch caches loaded in this process, if `keep_loaded_caches` was called
+_loaded_caches: Union[Dict[Any, Any], None] = None
+
+
+def keep_loaded_caches():
+    """
+    keep every dataset (see `load_memoized`), encoding and batch cache loaded from now on in memory, so that
+    loading them again returns them without reading them from disk; processes forked afterwards
+    (e.g. the runs of a sweep) share them copy-on-write
+    """
+    global _loaded_caches
+    if _loaded_caches is None:
+        _loaded_caches = {}
+
+
+def load_memoized(load: Callable, *args, **kwargs) -> Any:
+    """
+    `load(*args, **kwargs)`, called once per arguments after `keep_loaded_caches`
+    """
+    if _loaded_caches is None:
+        return load(*args, **kwargs)
+    key = (load.__module__, load.__qualname__, args, tuple(sorted(kwargs.items())))
+    if key not in _loaded_caches.keys():
+        _loaded_caches[key] = load(*args, **kwargs)
+    return _loaded_caches[key]
 
 
 def get_mol_positions(mol) -> np.ndarray:
@@ -25,7 +57,7 @@ class Batch:
                  rdkit_conf: torch.Tensor = None):
         self.n_atom = atom_ftr.shape[0]
         self.n_bond = bond_ftr.shape[0]
-        self.n_mol = mask_matrices.mol_vertex_w.shape[0]
+        self.n_mol = mask_matrices.n_mol
 
         self.atom_ftr = atom_ftr
         self.bond_ftr = bond_ftr
@@ -51,8 +83,8 @@ def batch_cuda_copy(batch: Batch) -> Batch:
 class BatchCache:
     def __init__(self, mols: List[Any], mols_info: List[Dict[str, np.ndarray]], mol_properties: np.ndarray,
                  needs_rdkit_conf=False, contains_ground_truth_conf=True, need_mask_matrices=True,
-                 use_cuda=False, batch_size=32,
-                 use_tqdm=False):
+                 use_cuda=False, batch_size=32, batch_budget=0, budget_unit='atom',
+                 use_tqdm=False, conformer_store: ConformerStore = None, sparse=False):
         assert len(mols_info) == mol_properties.shape[0]
         self.atom_dim = mols_info[0]['af'].shape[1]
         self.bond_dim = mols_info[0]['bf'].shape[1]
@@ -64,6 +96,7 @@ class BatchCache:
         self.needs_rdkit_conf = needs_rdkit_conf
         self.contains_ground_truth_conf = contains_ground_truth_conf
         self.need_mask_matrices = need_mask_matrices
+        self.sparse = sparse
         self.use_cuda = use_cuda
         self.use_tqdm = use_tqdm
 
@@ -77,110 +110,362 @@ class BatchCache:
         validate_mask = mask[train_num: -test_num]
         test_mask = mask[-test_num:]
 
-        train_sep = int(train_num / batch_size) + 1
-        validate_sep = int(validate_num / batch_size) + 1
-        test_sep = int(test_num / batch_size) + 1
-        self.train_masks: List[List[int]] = [train_mask[i::train_sep] for i in range(train_sep) if i < len(train_mask)]
-        self.validate_masks: List[List[int]] = [validate_mask[i::validate_sep] for i in range(validate_sep)
-                                                if i < len(validate_mask)]
-        self.test_masks: List[List[int]] = [test_mask[i::test_sep] for i in range(test_sep) if i < len(test_mask)]
-
+        if batch_budget > 0:
+            sizes = mol_sizes(mols_info, budget_unit)
+            n_bonds = mol_sizes(mols_info, 'bond')
+            self.train_masks: List[List[int]] = budget_masks(train_mask, sizes, batch_budget, shuffle=True,
+                                                             n_bonds=n_bonds)
+            self.validate_masks: List[List[int]] = budget_masks(validate_mask, sizes, batch_budget, n_bonds=n_bonds)
+            self.test_masks: List[List[int]] = budget_masks(test_mask, sizes, batch_budget, n_bonds=n_bonds)
+        else:
+            train_sep = int(train_num / batch_size) + 1
+            validate_sep = int(validate_num / batch_size) + 1
+            test_sep = int(test_num / batch_size) + 1
+            self.train_masks: List[List[int]] = [train_mask[i::train_sep] for i in range(train_sep)
+                                                 if i < len(train_mask)]
+            self.validate_masks: List[List[int]] = [validate_mask[i::validate_sep] for i in range(validate_sep)
+                                                    if i < len(validate_mask)]
+            self.test_masks: List[List[int]] = [test_mask[i::test_sep] for i in range(test_sep)
+                                                if i < len(test_mask)]
+
+        rdkit_positions = rdkit_positions_parallel(mols, conformer_store) if needs_rdkit_conf else None
         print('\t\tProducing Train Batches:')
-        self.train_batches: List[Batch] = self.produce_batches(self.train_masks)
+        self.train_batches: List[Batch] = self.produce_batches(self.train_masks, rdkit_positions)
         print('\t\tProducing Validate Batches:')
-        self.validate_batches: List[Batch] = self.produce_batches(self.validate_masks)
+        self.validate_batches: List[Batch] = self.produce_batches(self.validate_masks, rdkit_positions)
         print('\t\tProducing Test Batches:')
-        self.test_batches: List[Batch] = self.produce_batches(self.test_masks)
+        self.test_batches: List[Batch] = self.produce_batches(self.test_masks, rdkit_positions)
 
-    def produce_batches(self, masks: List[List[int]]) -> List[Batch]:
+    def produce_batches(self, masks: List[List[int]], rdkit_positions: List[np.ndarray] = None) -> List[Batch]:
         batches = []
         if self.use_tqdm:
             masks = tqdm(masks, total=len(masks))
         for mask in masks:
-            atom_ftr = np.vstack([self.mols_info[m]['af'] for m in mask])
-            bond_ftr = np.vstack([self.mols_info[m]['bf'] for m in mask])
-            massive = get_massive_from_atom_features(atom_ftr)
-            n_atoms = [self.mols_info[m]['af'].shape[0] for m in mask]
-            n_bonds = [self.mols_info[m]['bf'].shape[0] for m in mask]
-            if sum(n_bonds) == 0:
-                continue
-            ms = []
-            us = []
-            vs = []
-            for i, m in enumerate(mask):
-                ms.extend([i] * n_atoms[i])
-                prev_bonds = sum(n_atoms[:i])
-                us.extend(self.mols_info[m]['us'] + prev_bonds)
-                vs.extend(self.mols_info[m]['vs'] + prev_bonds)
-
-            properties = self.mol_properties[mask, :].astype(np.float32)
-            atom_ftr = torch.from_numpy(atom_ftr).type(torch.float32)
-            bond_ftr = torch.from_numpy(bond_ftr).type(torch.float32)
-            massive = torch.from_numpy(massive).type(torch.float32)
-            properties = torch.from_numpy(properties).type(torch.float32)
-
             if self.contains_ground_truth_conf:
                 conformation = np.vstack([get_mol_positions(self.mols[m]) for m in mask])
-                assert conformation.shape[0] == sum(n_atoms)
-                conformation = torch.from_numpy(conformation).type(torch.float32)
             else:
                 conformation = None
             if self.needs_rdkit_conf:
-                rdkit_conf = np.vstack([rdkit_mol_positions(self.mols[m]) for m in mask])
-                assert rdkit_conf.shape[0] == sum(n_atoms)
-                rdkit_conf = torch.from_numpy(rdkit_conf).type(torch.float32)
+                rdkit_conf = np.vstack([rdkit_positions[m] for m in mask])
                 if not self.contains_ground_truth_conf:
                     conformation = rdkit_conf
             else:
                 rdkit_conf = None
 
-            if self.need_mask_matrices:
-                mol_vertex_w, mol_vertex_b = self.produce_mask_matrix(len(mask), ms)
-                vertex_edge_w1, vertex_edge_b1 = self.produce_mask_matrix(sum(n_atoms), us)
-                vertex_edge_w2, vertex_edge_b2 = self.produce_mask_matrix(sum(n_atoms), vs)
-                mol_vertex_w = torch.from_numpy(mol_vertex_w).type(torch.float32)
-                mol_vertex_b = torch.from_numpy(mol_vertex_b).type(torch.float32)
-                vertex_edge_w1 = torch.from_numpy(vertex_edge_w1).type(torch.float32)
-                vertex_edge_b1 = torch.from_numpy(vertex_edge_b1).type(torch.float32)
-                vertex_edge_w2 = torch.from_numpy(vertex_edge_w2).type(torch.float32)
-                vertex_edge_b2 = torch.from_numpy(vertex_edge_b2).type(torch.float32)
-                mask_matrices = MaskMatrices(mol_vertex_w, mol_vertex_b,
-                                             vertex_edge_w1, vertex_edge_w2,
-                                             vertex_edge_b1, vertex_edge_b2)
-            else:
-                mask_matrices = None
-
-            batch = Batch(atom_ftr, bond_ftr, massive, mask_matrices, properties, conformation, rdkit_conf)
-            batches.append(batch)
+            batch = assemble_batch(self.mols_info, mask, self.mol_properties, conformation, rdkit_conf,
+                                   need_mask_matrices=self.need_mask_matrices, sparse=self.sparse)
+            if batch is not None:
+                batches.append(batch)
 
         return batches
 
     @staticmethod
     def produce_mask_matrix(n: int, s: list) -> Tuple[np.ndarray, np.ndarray]:
-        s = np.array(s)
+        s = np.array(s, dtype=np.int64)
         mat = np.full([n, s.shape[0]], 0., dtype=np.int32)
         mask = np.full([n, s.shape[0]], -1e6, dtype=np.int32)
-        for i in range(n):
-            node_edge = s == i
-            mat[i, node_edge] = 1
-            mask[i, node_edge] = 0
+        edges = np.arange(s.shape[0])
+        mat[s, edges] = 1
+        mask[s, edges] = 0
         return mat, mask
 
 
+def assemble_batch(mols_info: List[Dict[str, np.ndarray]], mask: List[int], mol_properties: np.ndarray,
+                   conformation: np.ndarray = None, rdkit_conf: np.ndarray = None, need_mask_matrices=True,
+                   need_loss_pairs=True, sparse=False, keep_bondless=False) -> Union[Batch, None]:
+    """
+    collate the molecules `mask` of `mols_info` into one `Batch`
+    :param conformation: stacked positions of the molecules, if any
+    :param rdkit_conf: stacked RDKit positions of the molecules, if any
+    :param need_loss_pairs: also enumerate the hop-mask pairs of the conformation losses, not needed for inference
+    :param sparse: build the index vectors of the masks only, without the dense matrices (`SPARSE` models)
+    :param keep_bondless: also assemble a batch whose molecules have no bond at all, which the model handles
+        as in any other batch, e.g. to predict every molecule whatever it is batched with
+    :return: the batch, or None if the molecules have no bond at all and not `keep_bondless`
+    """
+    atom_ftr = np.vstack([mols_info[m]['af'] for m in mask])
+    bond_ftr = np.vstack([mols_info[m]['bf'] for m in mask])
+    massive = get_massive_from_atom_features(atom_ftr)
+    n_atoms = [mols_info[m]['af'].shape[0] for m in mask]
+    n_bonds = [mols_info[m]['bf'].shape[0] for m in mask]
+    if sum(n_bonds) == 0 and not keep_bondless:
+        return None
+    prev_atoms = np.cumsum(n_atoms) - n_atoms
+    ms = np.repeat(np.arange(len(mask)), n_atoms)
+    us = np.concatenate([mols_info[m]['us'] + prev_atoms[i] for i, m in enumerate(mask)]).astype(np.int64)
+    vs = np.concatenate([mols_info[m]['vs'] + prev_atoms[i] for i, m in enumerate(mask)]).astype(np.int64)
+
+    properties = mol_properties[mask, :].astype(np.float32)
+    atom_ftr = torch.from_numpy(atom_ftr).type(torch.float32)
+    bond_ftr = torch.from_numpy(bond_ftr).type(torch.float32)
+    massive = torch.from_numpy(massive).type(torch.float32)
+    properties = torch.from_numpy(properties).type(torch.float32)
+    if conformation is not None:
+        assert conformation.shape[0] == sum(n_atoms)
+        conformation = torch.from_numpy(conformation).type(torch.float32)
+    if rdkit_conf is not None:
+        assert rdkit_conf.shape[0] == sum(n_atoms)
+        rdkit_conf = torch.from_numpy(rdkit_conf).type(torch.float32)
+
+    if need_mask_matrices and sparse:
+        mask_matrices = MaskMatrices(mol_index=torch.from_numpy(ms).type(torch.long),
+                                     us=torch.from_numpy(us),
+                                     vs=torch.from_numpy(vs),
+                                     n_mol=len(mask))
+    elif need_mask_matrices:
+        mol_vertex_w, mol_vertex_b = BatchCache.produce_mask_matrix(len(mask), ms)
+        vertex_edge_w1, vertex_edge_b1 = BatchCache.produce_mask_matrix(sum(n_atoms), us)
+        vertex_edge_w2, vertex_edge_b2 = BatchCache.produce_mask_matrix(sum(n_atoms), vs)
+        mol_vertex_w = torch.from_numpy(mol_vertex_w).type(torch.float32)
+        mol_vertex_b = torch.from_numpy(mol_vertex_b).type(torch.float32)
+        vertex_edge_w1 = torch.from_numpy(vertex_edge_w1).type(torch.float32)
+        vertex_edge_b1 = torch.from_numpy(vertex_edge_b1).type(torch.float32)
+        vertex_edge_w2 = torch.from_numpy(vertex_edge_w2).type(torch.float32)
+        vertex_edge_b2 = torch.from_numpy(vertex_edge_b2).type(torch.float32)
+        mask_matrices = MaskMatrices(mol_vertex_w, mol_vertex_b,
+                                     vertex_edge_w1, vertex_edge_w2,
+                                     vertex_edge_b1, vertex_edge_b2,
+                                     mol_index=torch.from_numpy(ms).type(torch.long),
+                                     us=torch.from_numpy(us),
+                                     vs=torch.from_numpy(vs),
+                                     n_mol=len(mask))
+    else:
+        mask_matrices = None
+    if mask_matrices is not None:
+        mask_matrices.triplet_edges()
+        mask_matrices.mol_vertex_pairs()
+        if need_loss_pairs:
+            for mode in ADJ_MODES:
+                get_adj_pairs(mask_matrices, mode)
+
+    return Batch(atom_ftr, bond_ftr, massive, mask_matrices, properties, conformation, rdkit_conf)
+
+
+def split_masks(mask: np.ndarray, batch_size: int) -> List[np.ndarray]:
+    sep = int(len(mask) / batch_size) + 1
+    return [mask[i::sep] for i in range(sep) if i < len(mask)]
+
+
+def mol_sizes(mols_info: List[Dict[str, np.ndarray]], budget_unit='atom') -> np.ndarray:
+    if budget_unit == 'atom':
+        return np.array([info['af'].shape[0] for info in mols_info], dtype=np.int64)
+    elif budget_unit == 'bond':
+        return np.array([info['bf'].shape[0] for info in mols_info], dtype=np.int64)
+    else:
+        assert False, f'Unknown budget unit: {budget_unit}'
+
+
+def budget_masks(mask: np.ndarray, sizes: np.ndarray, budget: int, shuffle=False, n_bonds: np.ndarray = None
+                  ) -> List[np.ndarray]:
+    """
+    group molecules of similar size into batches whose total size stays within `budget`
+    (a molecule larger than `budget` makes a batch of its own)
+    :param mask: indices of the molecules
+    :param sizes: number of atoms (or bonds) of every molecule, see `mol_sizes`
+    :param budget: maximum total size of a batch
+    :param shuffle: draw a different grouping of equally sized molecules and shuffle the order of the batches
+    :param n_bonds: number of bonds of every molecule, if given the molecules without bonds are spread over
+        the other batches, slightly beyond `budget`, since a batch of them only would be dropped by `assemble_batch`
+    """
+    if shuffle:
+        mask = np.random.permutation(mask)
+    bondless = mask[:0]
+    if n_bonds is not None and np.any(n_bonds[mask] > 0):
+        bondless = mask[n_bonds[mask] == 0]
+        mask = mask[n_bonds[mask] > 0]
+    mask = mask[np.argsort(sizes[mask], kind='stable')]
+    masks = []
+    start, total = 0, 0
+    for i, m in enumerate(mask):
+        if total + sizes[m] > budget and i > start:
+            masks.append(mask[start: i])
+            start, total = i, 0
+        total += sizes[m]
+    if start < len(mask):
+        masks.append(mask[start:])
+    for i in range(min(len(masks), len(bondless))):
+        masks[i] = np.concatenate([masks[i], bondless[i::len(masks)]])
+    if shuffle:
+        masks = [masks[i] for i in np.random.permutation(len(masks))]
+    return masks
+
+
+class BatchLoader:
+    def __init__(self, dataset, masks: List[np.ndarray], n_workers=0, prefetch=2):
+        """
+        batches of a `PackedDataset`, collated when iterated, in `n_workers` DataLoader processes if positive
+        """
+        self.dataset = dataset
+        self.masks = masks
+        self.n_workers = n_workers
+        self.prefetch = prefetch
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    def __iter__(self):
+        if self.n_workers > 0:
+            batches = DataLoader(self.masks, batch_size=None, collate_fn=self.dataset.collate,
+                                 num_workers=self.n_workers, prefetch_factor=self.prefetch)
+        else:
+            batches = map(self.dataset.collate, self.masks)
+        for batch in batches:
+            if batch is not None:
+                yield batch
+
+
+def sample_batches(batches: Union[List[Batch], BatchLoader], n_batch: int) -> Union[List[Batch], BatchLoader]:
+    """
+    a random subset of `n_batch` batches, or all of them if `n_batch` is not positive
+    """
+    if n_batch <= 0 or n_batch >= len(batches):
+        return batches
+    index = np.random.choice(len(batches), n_batch, replace=False)
+    if isinstance(batches, BatchLoader):
+        return BatchLoader(batches.dataset, [batches.masks[i] for i in index],
+                           n_workers=batches.n_workers, prefetch=batches.prefetch)
+    return [batches[i] for i in index]
+
+
+class PackedDataset:
+    def __init__(self, mols: List[Any], mols_info: List[Dict[str, np.ndarray]], mol_properties: np.ndarray,
+                 needs_rdkit_conf=False, contains_ground_truth_conf=True, need_mask_matrices=True,
+                 batch_size=32, batch_budget=0, budget_unit='atom', n_workers=0, use_tqdm=False,
+                 conformer_store: ConformerStore = None, sparse=False):
+        """
+        per-molecule arrays stored once, from which batches are assembled on the fly;
+        the train batches are drawn from a new shuffle on every access of `train_batches`,
+        and `batch_size` can be changed without rebuilding;
+        with a positive `batch_budget`, batches are capped by total atoms (or bonds) instead, see `budget_masks`;
+        with `sparse`, batches carry the index vectors of their masks only, see `assemble_batch`;
+        RDKit positions are embedded over a process pool and looked up in `conformer_store` if any
+        """
+        assert len(mols_info) == mol_properties.shape[0]
+        self.atom_dim = mols_info[0]['af'].shape[1]
+        self.bond_dim = mols_info[0]['bf'].shape[1]
+        self.n_mol = len(mols)
+
+        self.mols_info = mols_info
+        self.mol_properties = mol_properties
+        self.need_mask_matrices = need_mask_matrices
+        self.sparse = sparse
+        self.batch_size = batch_size
+        self.batch_budget = batch_budget
+        self.budget_unit = budget_unit
+        self.n_workers = n_workers
+
+        n_mol = len(mols_info)
+        train_num = int(n_mol * 0.8)
+        validate_num = int(n_mol * 0.1)
+        test_num = n_mol - train_num - validate_num
+
+        mask = np.random.permutation(n_mol)
+        self.train_mask = mask[:train_num]
+        self.validate_mask = mask[train_num: -test_num]
+        self.test_mask = mask[-test_num:]
+
+        self.n_atoms = mol_sizes(mols_info, 'atom')
+        self.n_bonds = mol_sizes(mols_info, 'bond')
+        self.atom_offsets = np.concatenate([[0], np.cumsum(self.n_atoms)]).astype(np.int64)
+        rdkit_conf = rdkit_positions_parallel(mols, conformer_store) if needs_rdkit_conf else None
+        if use_tqdm:
+            mols = tqdm(mols, total=len(mols))
+        conformation = [get_mol_positions(mol) for mol in mols] if contains_ground_truth_conf else None
+        self.rdkit_conf = np.vstack(rdkit_conf).astype(np.float32) if needs_rdkit_conf else None
+        self.conformation = np.vstack(conformation).astype(np.float32) if contains_ground_truth_conf \
+            else self.rdkit_conf
+
+    def gather_positions(self, positions: np.ndarray, mask: List[int]) -> Union[np.ndarray, None]:
+        if positions is None:
+            return None
+        return np.vstack([positions[self.atom_offsets[m]: self.atom_offsets[m + 1]] for m in mask])
+
+    def collate(self, mask: List[int]) -> Union[Batch, None]:
+        conformation = self.gather_positions(self.conformation, mask)
+        rdkit_conf = self.gather_positions(self.rdkit_conf, mask)
+        return assemble_batch(self.mols_info, mask, self.mol_properties, conformation, rdkit_conf,
+                              need_mask_matrices=self.need_mask_matrices, sparse=self.sparse)
+
+    def batches(self, mask: np.ndarray, shuffle=False) -> BatchLoader:
+        if self.batch_budget > 0:
+            sizes = self.n_atoms if self.budget_unit == 'atom' else self.n_bonds
+            return BatchLoader(self, budget_masks(mask, sizes, self.batch_budget, shuffle=shuffle,
+                                                  n_bonds=self.n_bonds), n_workers=self.n_workers)
+        if shuffle:
+            mask = np.random.permutation(mask)
+        return BatchLoader(self, split_masks(mask, self.batch_size), n_workers=self.n_workers)
+
+    @property
+    def train_batches(self) -> BatchLoader:
+        return self.batches(self.train_mask, shuffle=True)
+
+    @property
+    def validate_batches(self) -> BatchLoader:
+        return self.batches(self.validate_mask)
+
+    @property
+    def test_batches(self) -> BatchLoader:
+        return self.batches(self.test_mask)
+
+
 def load_batch_cache(name: str, mols: List[Any], mols_info: List[Dict[str, np.ndarray]], mol_properties: np.ndarray,
                      needs_rdkit_conf=False, contains_ground_truth_conf=True, need_mask_matrices=True,
                      use_cuda=False, batch_size=32,
-                     force_save=False, use_tqdm=False) -> BatchCache:
+                     force_save=False, use_tqdm=False, dynamic=False, n_workers=0,
+                     batch_budget=0, budget_unit='atom', sparse=False) -> Union[BatchCache, PackedDataset]:
+    """
+    :param batch_budget: if positive, cap each batch by this many atoms (or bonds, see `budget_unit`)
+        and group molecules of similar size, instead of a fixed number of molecules per batch
+    :param dynamic: keep a `PackedDataset` assembling batches on the fly instead of frozen batches,
+        in which case the cache does not depend on `batch_size`
+    :param n_workers: number of DataLoader processes collating batches if `dynamic`
+    :param sparse: batches without the dense mask matrices, for `SPARSE` models; frozen batches are cached apart
+    """
     if not os.path.exists(CACHE_DIR):
         os.mkdir(CACHE_DIR)
-    pickle_path = f'{CACHE_DIR}/{name}.pickle'
-    if not os.path.exists(pickle_path) or force_save:
+    if not os.path.exists(MOLS_DIR):
+        os.mkdir(MOLS_DIR)
+    conformer_store = ConformerStore(CONFORMER_STORE_PATH) if needs_rdkit_conf else None
+    if dynamic:
+        pickle_path = f'{CACHE_DIR}/{name}-packed.pickle'
+        if _loaded_caches is not None and pickle_path in _loaded_caches.keys() and not force_save:
+            dataset = _loaded_caches[pickle_path]
+        elif not os.path.exists(pickle_path) or force_save:
+            print('\tProducing New Packed Dataset...')
+            dataset = PackedDataset(mols, mols_info, mol_properties,
+                                    needs_rdkit_conf=needs_rdkit_conf,
+                                    contains_ground_truth_conf=contains_ground_truth_conf,
+                                    need_mask_matrices=need_mask_matrices, use_tqdm=use_tqdm,
+                                    conformer_store=conformer_store, sparse=sparse)
+            with open(pickle_path, 'wb+') as fp:
+                pickle.dump(dataset, fp)
+        else:
+            print('\tUse Cached Packed Dataset')
+            with open(pickle_path, 'rb') as fp:
+                dataset = pickle.load(fp)
+        if _loaded_caches is not None:
+            _loaded_caches[pickle_path] = dataset
+        dataset.batch_size = batch_size
+        dataset.batch_budget = batch_budget
+        dataset.budget_unit = budget_unit
+        dataset.n_workers = n_workers
+        dataset.sparse = sparse
+        return dataset
+
+    pickle_path = f'{CACHE_DIR}/{name}-sparse.pickle' if sparse else f'{CACHE_DIR}/{name}.pickle'
+    # unlike packed datasets, whose batches are drawn every epoch, cached batches are frozen at their size
+    memo_key = (pickle_path, batch_size)
+    if _loaded_caches is not None and memo_key in _loaded_caches.keys() and not force_save:
+        batch_cache = _loaded_caches[memo_key]
+    elif not os.path.exists(pickle_path) or force_save:
         print('\tProducing New Batches...')
         batch_cache = BatchCache(mols, mols_info, mol_properties,
                                  needs_rdkit_conf=needs_rdkit_conf,
                                  contains_ground_truth_conf=contains_ground_truth_conf,
                                  need_mask_matrices=need_mask_matrices,
-                                 use_cuda=use_cuda, batch_size=batch_size, use_tqdm=use_tqdm)
+                                 use_cuda=use_cuda, batch_size=batch_size, batch_budget=batch_budget,
+                                 budget_unit=budget_unit, use_tqdm=use_tqdm, conformer_store=conformer_store,
+                                 sparse=sparse)
         with open(pickle_path, 'wb+') as fp:
             pickle.dump(batch_cache, fp)
     else:
@@ -188,27 +473,54 @@ def load_batch_cache(name: str, mols: List[Any], mols_info: List[Dict[str, np.nd
         with open(pickle_path, 'rb') as fp:
             batch_cache = pickle.load(fp)
 
+    if _loaded_caches is not None:
+        _loaded_caches[memo_key] = batch_cache
     return batch_cache
 
 
-def load_encode_mols(mols, name: str = None, force_save=False, return_mask=False
+def load_encode_mols(mols, name: str = None, force_save=False, return_mask=False, n_workers: int = None
                      ) -> Union[List[Dict[str, np.ndarray]], Tuple[List[Dict[str, np.ndarray]], List[int]]]:
+    """
+    encode molecules over `n_workers` processes (all cores if None); with a `name`, the features are kept
+    in a memory-mapped `FeatureStore` under `MOLS_DIR` so that later runs map them instead of encoding again,
+    and the molecules are looked up in the `FeatureCache` at `FEATURE_CACHE_PATH` shared by all the datasets
+    """
     if not os.path.exists(MOLS_DIR):
         os.mkdir(MOLS_DIR)
     if name is None:
-        return encode_mols(mols, return_mask=return_mask)
+        return encode_mols_parallel(mols, n_workers=n_workers, return_mask=return_mask)
+    memo_key = (f'{MOLS_DIR}/{name}', return_mask)
+    if _loaded_caches is not None and memo_key in _loaded_caches.keys() and not force_save:
+        return _loaded_caches[memo_key]
+    ret = _load_encode_mols(mols, name, force_save, return_mask, n_workers)
+    if _loaded_caches is not None:
+        _loaded_caches[memo_key] = ret
+    return ret
 
+
+def _load_encode_mols(mols, name: str, force_save: bool, return_mask: bool, n_workers: Union[int, None]
+                      ) -> Union[List[Dict[str, np.ndarray]], Tuple[List[Dict[str, np.ndarray]], List[int]]]:
+    store_path = f'{MOLS_DIR}/{name}'
     pickle_path = f'{MOLS_DIR}/{name}.pickle'
-    if not os.path.exists(pickle_path) or force_save:
-        ret = encode_mols(mols, return_mask=return_mask)
-        with open(pickle_path, 'wb+') as fp:
-            pickle.dump(ret, fp)
-    else:
+    if os.path.exists(store_path) and not force_save:
+        print('\tUse Cached Mols')
+        store = FeatureStore(store_path)
+    elif os.path.exists(pickle_path) and not force_save:
         print('\tUse Cached Mols')
         with open(pickle_path, 'rb') as fp:
-            ret = pickle.load(fp)
+            return pickle.load(fp)
+    else:
+        if get_feature_cache().path is None:
+            set_feature_cache(FeatureCache(FEATURE_CACHE_PATH))
+        mols_info, mask = encode_mols_parallel(mols, n_workers=n_workers, return_mask=True)
+        print(f'\tFeature cache: {get_feature_cache().stats()}')
+        if not return_mask:
+            assert len(mols_info) == len(mols), 'Invalid molecules found, encode with `return_mask=True`'
+        store = write_feature_store(store_path, mols_info, mask)
 
-    return ret
+    if return_mask:
+        return store, store.mask
+    return store
 
 
 def produce_batches_from_mols(mols: List[Any]) -> List[Batch]:
@@ -233,7 +545,15 @@ def produce_batches_from_mols(mols: List[Any]) -> List[Batch]:
 
         mask_matrices = MaskMatrices(mol_vertex_w, mol_vertex_b,
                                      vertex_edge_w1, vertex_edge_w2,
-                                     vertex_edge_b1, vertex_edge_b2)
+                                     vertex_edge_b1, vertex_edge_b2,
+                                     mol_index=torch.zeros(af.shape[0], dtype=torch.long),
+                                     us=torch.from_numpy(us).type(torch.long),
+                                     vs=torch.from_numpy(vs).type(torch.long),
+                                     n_mol=1)
+        mask_matrices.triplet_edges()
+        mask_matrices.mol_vertex_pairs()
+        for mode in ADJ_MODES:
+            get_adj_pairs(mask_matrices, mode)
 
         batches.append(Batch(
             atom_ftr=atom_ftr,
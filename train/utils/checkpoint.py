@@ -0,0 +1,71 @@
+import os
+import torch
+import numpy as np
+
+from typing import Dict, Any, Union
+
+from torch import nn, optim
+
+CHECKPOINT_DIR = 'train/checkpoints'
+
+
+def get_checkpoint_path(tag: str) -> str:
+    return f'{CHECKPOINT_DIR}/{tag}.pkl'
+
+
+def get_rng_state(use_cuda=False) -> Dict[str, Any]:
+    return {
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if use_cuda else None,
+    }
+
+
+def set_rng_state(state: Dict[str, Any], use_cuda=False):
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if use_cuda and state['cuda'] is not None:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(path: str, modules: Dict[str, nn.Module], optimizer: optim.Optimizer,
+                    scheduler: optim.lr_scheduler.LRScheduler, scaler: torch.amp.GradScaler, use_cuda=False,
+                    **state):
+    """
+    everything needed to carry on training after the current epoch, written to a temporary file then renamed,
+    so that a job killed while saving leaves the previous checkpoint intact
+    :param modules: the modules to save by name, e.g. {'model': model, 'classifier': classifier}
+    :param state: the progress of the trainer, e.g. `epoch`, `best_metric` and `logs`
+    """
+    checkpoint = {
+        'modules': {name: module.state_dict() for name, module in modules.items()},
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'scaler': scaler.state_dict(),
+        'rng': get_rng_state(use_cuda),
+        'state': state,
+    }
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: str, modules: Dict[str, nn.Module], optimizer: optim.Optimizer,
+                    scheduler: optim.lr_scheduler.LRScheduler, scaler: torch.amp.GradScaler, use_cuda=False
+                    ) -> Union[Dict[str, Any], None]:
+    """
+    restore in place what `save_checkpoint` saved, random number generators included
+    :return: the progress of the trainer, None if there is no checkpoint at `path`
+    """
+    if not os.path.exists(path):
+        return None
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    for name, module in modules.items():
+        module.load_state_dict(checkpoint['modules'][name])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    scheduler.load_state_dict(checkpoint['scheduler'])
+    scaler.load_state_dict(checkpoint['scaler'])
+    set_rng_state(checkpoint['rng'], use_cuda)
+    return checkpoint['state']
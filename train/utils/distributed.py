@@ -0,0 +1,129 @@
+import os
+import sys
+import torch
+import torch.distributed as dist
+import numpy as np
+
+from typing import List, Tuple, Union, Iterable
+
+from .cache_batch import Batch, BatchLoader
+from .metrics import MetricAccumulator
+
+
+def init_distributed(use_cuda=False) -> Tuple[int, int]:
+    """
+    join the process group described by the environment of `torchrun` (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR...),
+    with NCCL on GPUs and gloo on CPUs; only the main process keeps printing
+    :return: rank of this process and number of processes, (0, 1) when not launched distributed
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1
+    if not dist.is_initialized():
+        if use_cuda:
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+        dist.init_process_group('nccl' if use_cuda else 'gloo')
+    rank = dist.get_rank()
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+    return rank, world_size
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def is_main_process() -> bool:
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def shard_batches(batches: Union[List[Batch], BatchLoader], even=True) -> Union[List[Batch], BatchLoader]:
+    """
+    every `world_size`-th batch, starting from the rank of this process
+    :param even: keep as many batches on every process, dropping the last few, as gradient steps must stay in lockstep
+    """
+    if not is_distributed():
+        return batches
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    n_batch = len(batches) // world_size * world_size if even else len(batches)
+    index = list(range(rank, n_batch, world_size))
+    if isinstance(batches, BatchLoader):
+        return BatchLoader(batches.dataset, [batches.masks[i] for i in index],
+                           n_workers=batches.n_workers, prefetch=batches.prefetch)
+    return [batches[i] for i in index]
+
+
+def broadcast_parameters(parameters: Iterable[torch.nn.Parameter]):
+    """
+    start every process from the parameters of the main one
+    """
+    if not is_distributed():
+        return
+    for param in parameters:
+        dist.broadcast(param.data, src=0)
+
+
+def all_reduce_gradients(parameters: List[torch.nn.Parameter]):
+    """
+    average the gradients over the processes, in a single flattened all-reduce;
+    parameters left unused by a process count as zero gradients, and by all of them keep no gradient
+    """
+    if not is_distributed():
+        return
+    grads = [param.grad if param.grad is not None else torch.zeros_like(param) for param in parameters]
+    used = torch.tensor([param.grad is not None for param in parameters],
+                        dtype=grads[0].dtype, device=grads[0].device)
+    flat = torch.cat([grad.reshape([-1]) for grad in grads] + [used])
+    dist.all_reduce(flat)
+    used = (flat[-len(parameters):] > 0).tolist()
+    flat = flat[:-len(parameters)] / dist.get_world_size()
+    start = 0
+    for i, (param, grad) in enumerate(zip(parameters, grads)):
+        size = grad.numel()
+        param.grad = flat[start: start + size].view_as(param) if used[i] else None
+        start += size
+
+
+def all_reduce_metrics(metrics: MetricAccumulator) -> MetricAccumulator:
+    """
+    merge the running sums and counts of the processes, each of which evaluated its own shard
+    """
+    if not is_distributed():
+        return metrics
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, {name: (value.cpu().numpy(), metrics.counts[name])
+                                      for name, value in metrics.sums.items()})
+    merged = MetricAccumulator()
+    for part in gathered:
+        for name, (value, count) in part.items():
+            value = torch.from_numpy(np.asarray(value))
+            merged.sums[name] = merged.sums[name] + value if name in merged.sums.keys() else value
+            merged.counts[name] = merged.counts.get(name, 0) + count
+    return merged
+
+
+def all_gather_array(array: np.ndarray) -> np.ndarray:
+    """
+    :return: the arrays of all the processes concatenated along the first axis, in the order of their ranks
+    """
+    if not is_distributed():
+        return array
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, array)
+    return np.concatenate(gathered)
+
+
+def broadcast_flag(flag: bool) -> bool:
+    """
+    the `flag` of the main process, so that all the processes take the same branch, e.g. when stopping on a clock
+    """
+    if not is_distributed():
+        return flag
+    flags = [flag]
+    dist.broadcast_object_list(flags, src=0)
+    return flags[0]
@@ -3,6 +3,8 @@ import numpy as np
 import numpy.linalg as npl
 from typing import Tuple
 
+from net.utils.model_utils import segment_sum, segment_mean
+
 
 def kabsch_np(pos: np.ndarray, fit_pos: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
     p0 = pos
@@ -76,6 +78,53 @@ def kabsch(pos: torch.Tensor, fit_pos: torch.Tensor, mol_node_matrix: torch.Tens
     return ret_pos, ret_fit_pos
 
 
+def batched_kabsch(pos: torch.Tensor, fit_pos: torch.Tensor, mol_index: torch.Tensor = None, n_mol: int = None
+                   ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    `kabsch` for every molecule of a batch at once, with one batched SVD over [n_mol, 3, 3]
+    :param pos: positions with shape [n_vertex, 3]
+    :param fit_pos: positions to fit with shape [n_vertex, 3]
+    :param mol_index: molecule index of each vertex with shape [n_vertex], a single molecule if None
+    :param n_mol: number of molecules
+    :return: aligned `pos` and centered `fit_pos`, in the vertex order of the input
+    """
+    if mol_index is None:
+        mol_index = torch.zeros(pos.shape[0], dtype=torch.long, device=pos.device)
+        n_mol = 1
+    elif n_mol is None:
+        n_mol = int(mol_index.max()) + 1
+    with torch.autocast(device_type=pos.device.type, enabled=False):
+        return _batched_kabsch(pos.float(), fit_pos.float(), mol_index, n_mol)
+
+
+def _batched_kabsch(pos: torch.Tensor, fit_pos: torch.Tensor, mol_index: torch.Tensor, n_mol: int
+                    ) -> Tuple[torch.Tensor, torch.Tensor]:
+    p = pos - segment_mean(pos, mol_index, n_mol)[mol_index]
+    q = fit_pos - segment_mean(fit_pos, mol_index, n_mol)[mol_index]
+    c = segment_sum(p.unsqueeze(2) * q.unsqueeze(1), mol_index, n_mol)  # shape [n_mol, 3, 3]
+    det = torch.linalg.det(c)
+    # molecules without a clearly signed det(c), e.g. of a single atom, take the detached branch below;
+    # their covariance is detached here too, as the SVD backward of a degenerate matrix is 0/0
+    degenerate = (det.abs() <= 1e-5).reshape([-1, 1, 1])
+    v, s, w_t = torch.linalg.svd(torch.where(degenerate, c.detach(), c))
+    w = w_t.transpose(1, 2)
+    v_t = v.transpose(1, 2)
+    rd2 = torch.tensor([1, 1, -1], dtype=pos.dtype, device=pos.device).reshape([1, 3, 1])
+    r1 = w @ v_t
+    r2 = w @ (rd2 * v_t)
+    p1 = (p.unsqueeze(1) @ r1[mol_index]).squeeze(1)
+    p2 = (p.unsqueeze(1) @ r2[mol_index]).squeeze(1)
+    nd1 = segment_sum(torch.sum((p1 - q) ** 2, dim=1), mol_index, n_mol)
+    nd2 = segment_sum(torch.sum((p2 - q) ** 2, dim=1), mol_index, n_mol)
+
+    # reflection fix: proper rotation when det(c) is clearly signed, otherwise the closer one without gradient
+    use_p1 = (det > 1e-5)[mol_index].unsqueeze(1)
+    use_p2 = (det < -1e-5)[mol_index].unsqueeze(1)
+    closer = torch.where((nd1 < nd2)[mol_index].unsqueeze(1), p1, p2).detach()
+    ret_pos = torch.where(use_p1, p1, torch.where(use_p2, p2, closer))
+    return ret_pos, q
+
+
 def rmsd(src: torch.Tensor, tgt: torch.Tensor, mass: torch.Tensor) -> torch.Tensor:
     md2 = mass * torch.pow(src - tgt, 2).sum(dim=1, keepdim=True)
     loss = torch.sqrt(md2.sum() / mass.sum())
@@ -115,3 +164,11 @@ if __name__ == '__main__':
     print(fit_pos.numpy())
     r = rmsd(pos, fit_pos, torch.tensor([[1], [1], [1], [1], [1], [1], [1], [1]], dtype=torch.float32))
     print(r)
+
+    # single-atom molecules get zero gradients, not NaN
+    pos = torch.randn([9, 3], requires_grad=True)
+    mol_index = torch.tensor([0, 1, 1, 2, 2, 2, 2, 3, 3])
+    ret_pos, fit_pos = batched_kabsch(pos, torch.randn([9, 3]), mol_index)
+    torch.sum((ret_pos - fit_pos) ** 2).backward()
+    assert torch.isfinite(pos.grad).all(), pos.grad
+    assert torch.all(pos.grad[0] == 0), pos.grad[0]
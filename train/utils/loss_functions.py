@@ -5,9 +5,11 @@ import torch.nn.functional as F
 from typing import Tuple, List
 from sklearn.metrics import roc_auc_score
 
-from net.utils.MaskMatrices import MaskMatrices
+from net.utils.MaskMatrices import MaskMatrices, produce_mol_pairs
 from net.utils.model_utils import normalize_adj_rc, nonzero
-from .kabsch import kabsch
+from .kabsch import batched_kabsch
+
+ADJ_MODES = ['adj2', 'adj3', 'adj4', 'norm_adj3', 'distance']
 
 
 def multi_roc(source: List[np.ndarray], target: np.ndarray) -> Tuple[float, List[float]]:
@@ -124,95 +126,134 @@ def generate_adj(mask_matrices: MaskMatrices, mode, use_cuda=False) -> torch.Ten
         assert False, f'{mode}'
 
 
+def pair_distance(positions: torch.Tensor, pairs: torch.Tensor) -> torch.Tensor:
+    """
+    distances of vertex pairs only, the sparse counterpart of `distance_among`
+    :param positions: positions with shape [..., n_vertex, 3]
+    :param pairs: vertex pairs with shape [2, n_pair]
+    :return: distances with shape [..., n_pair]
+    """
+    return torch.norm(positions[..., pairs[0], :] - positions[..., pairs[1], :], dim=-1)
+
+
+def generate_adj_pairs(mask_matrices: MaskMatrices, mode) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    sparse counterpart of `generate_adj`: the off-diagonal non-zero entries of the hop-mask as vertex pairs
+    and their weights, which only ever join vertices of the same molecule (the diagonal weighs zero distances)
+    :return: vertex pairs with shape [2, n_pair] and weights with shape [n_pair]
+    """
+    n_vertex = mask_matrices.n_vertex
+    if mode == 'distance':
+        mol_index = mask_matrices.mol_vertex_index()
+        n_mol = mask_matrices.n_mol
+        pairs = produce_mol_pairs(mol_index, n_mol)
+        n_mol_vertex = torch.bincount(mol_index, minlength=n_mol).type(torch.float32)
+        weight = 1 / ((n_mol_vertex[mol_index[pairs[1]]] ** 2) * n_mol)
+        return pairs, weight
+
+    u2, v2 = mask_matrices.directed_edges()
+    loop = torch.arange(n_vertex, device=u2.device)
+    adj_index = torch.stack([torch.cat([u2, loop]), torch.cat([v2, loop])])
+    adj = torch.sparse_coo_tensor(adj_index, torch.ones(adj_index.shape[1], device=u2.device),
+                                  (n_vertex, n_vertex), check_invariants=False).coalesce()
+
+    def normalize_rc(a: torch.Tensor) -> torch.Tensor:
+        index, value = a.indices(), a.values()
+        d_12 = torch.pow(torch.zeros(n_vertex, device=value.device).index_add(0, index[0], value) + 1e-5, -1 / 2)
+        return torch.sparse_coo_tensor(index, d_12[index[0]] * value * d_12[index[1]], a.shape,
+                                       check_invariants=False).coalesce()
+
+    def nonzero_of(a: torch.Tensor) -> torch.Tensor:
+        return torch.sparse_coo_tensor(a.indices(), torch.ones_like(a.values()), a.shape,
+                                       check_invariants=False).coalesce()
+
+    if mode == 'adj2':
+        mean_adj = normalize_rc(nonzero_of(torch.sparse.mm(adj, adj)))
+    elif mode == 'adj3':
+        mean_adj = normalize_rc(nonzero_of(torch.sparse.mm(torch.sparse.mm(adj, adj), adj)))
+    elif mode == 'adj4':
+        adj_2 = torch.sparse.mm(adj, adj)
+        mean_adj = normalize_rc(nonzero_of(torch.sparse.mm(adj_2, adj_2)))
+    elif mode == 'norm_adj3':
+        norm_adj = normalize_rc(adj)
+        norm_adj_2 = torch.sparse.mm(norm_adj, norm_adj)
+        norm_adj_3 = torch.sparse.mm(norm_adj_2, norm_adj)
+        mean_adj = ((norm_adj + norm_adj_2 + norm_adj_3) / 3).coalesce()
+    else:
+        assert False, f'{mode}'
+
+    pairs, weight = mean_adj.indices(), mean_adj.values()
+    off_diagonal = pairs[0] != pairs[1]
+    return pairs[:, off_diagonal], weight[off_diagonal]
+
+
+def get_adj_pairs(mask_matrices: MaskMatrices, mode) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    hop-mask pairs cached on `mask_matrices` (filled at `BatchCache` time), generated on first use otherwise
+    """
+    if mask_matrices.adj_pairs is None:
+        mask_matrices.adj_pairs = {}
+    if mode not in mask_matrices.adj_pairs.keys():
+        mask_matrices.adj_pairs[mode] = generate_adj_pairs(mask_matrices, mode)
+    return mask_matrices.adj_pairs[mode]
+
+
 def adj3_loss(source: torch.Tensor, target: torch.Tensor, mask_matrices: MaskMatrices,
               use_cuda=False) -> torch.Tensor:
-    n_atom = mask_matrices.mol_vertex_w.shape[1]
-    mean_adj_3 = generate_adj(mask_matrices, mode='adj3', use_cuda=use_cuda)
+    n_atom = mask_matrices.n_vertex
+    pairs, mean_adj_3 = get_adj_pairs(mask_matrices, mode='adj3')
 
-    ds = distance_among(source)
-    dt = distance_among(target)
+    ds = pair_distance(source, pairs)
+    dt = pair_distance(target, pairs)
     distance_2 = (ds - dt) ** 2
     loss = torch.sum(distance_2 * mean_adj_3) / n_atom
     return loss
 
 
-def hierarchical_adj2_loss(sources: List[torch.Tensor], target: torch.Tensor, mask_matrices: MaskMatrices, weight=1.6,
-                           use_cuda=False) -> torch.Tensor:
+def hierarchical_pair_loss(sources: List[torch.Tensor], target: torch.Tensor, mask_matrices: MaskMatrices, mode,
+                           weight=1.6) -> torch.Tensor:
+    """
+    weighted sum of `adj3_loss`-like terms over a list of conformations, later ones weighted higher;
+    all conformations are measured in one pass over the pairs of `mode`, and the target distances only once
+    """
     n_s = len(sources)
-    n_atom = mask_matrices.mol_vertex_w.shape[1]
-    mean_adj_2 = generate_adj(mask_matrices, mode='adj2', use_cuda=use_cuda)
+    n_atom = mask_matrices.n_vertex
+    pairs, mean_adj = get_adj_pairs(mask_matrices, mode=mode)
 
     w, t = [], 1
     for i in range(n_s):
         w.append(t)
         t *= weight
     tw = sum(w)
-    w = [j / tw for j in w]
-
-    losses = []
-    for i in range(n_s):
-        ds = distance_among(sources[i])
-        dt = distance_among(target)
-        distance_2 = (ds - dt) ** 2
-        loss = torch.sum(distance_2 * mean_adj_2) * w[i] / n_atom
-        losses.append(loss)
+    w = torch.tensor([j / tw for j in w], dtype=target.dtype, device=target.device)
 
-    return sum(losses)
+    ds = pair_distance(torch.stack(sources), pairs)  # shape [n_s, n_pair]
+    dt = pair_distance(target, pairs)
+    distance_2 = (ds - dt) ** 2
+    loss = torch.sum((distance_2 @ mean_adj) * w) / n_atom
+    return loss
 
 
-def hierarchical_adj3_loss(sources: List[torch.Tensor], target: torch.Tensor, mask_matrices: MaskMatrices, weight=1.6,
+def hierarchical_adj2_loss(sources: List[torch.Tensor], target: torch.Tensor, mask_matrices: MaskMatrices, weight=1.6,
                            use_cuda=False) -> torch.Tensor:
-    n_s = len(sources)
-    n_atom = mask_matrices.mol_vertex_w.shape[1]
-    mean_adj_3 = generate_adj(mask_matrices, mode='adj3', use_cuda=use_cuda)
-
-    w, t = [], 1
-    for i in range(n_s):
-        w.append(t)
-        t *= weight
-    tw = sum(w)
-    w = [j / tw for j in w]
+    return hierarchical_pair_loss(sources, target, mask_matrices, mode='adj2', weight=weight)
 
-    losses = []
-    for i in range(n_s):
-        ds = distance_among(sources[i])
-        dt = distance_among(target)
-        distance_2 = (ds - dt) ** 2
-        loss = torch.sum(distance_2 * mean_adj_3) * w[i] / n_atom
-        losses.append(loss)
 
-    return sum(losses)
+def hierarchical_adj3_loss(sources: List[torch.Tensor], target: torch.Tensor, mask_matrices: MaskMatrices, weight=1.6,
+                           use_cuda=False) -> torch.Tensor:
+    return hierarchical_pair_loss(sources, target, mask_matrices, mode='adj3', weight=weight)
 
 
 def hierarchical_adj4_loss(sources: List[torch.Tensor], target: torch.Tensor, mask_matrices: MaskMatrices, weight=1.6,
                            use_cuda=False) -> torch.Tensor:
-    n_s = len(sources)
-    n_atom = mask_matrices.mol_vertex_w.shape[1]
-    mean_adj_4 = generate_adj(mask_matrices, mode='adj4', use_cuda=use_cuda)
-
-    w, t = [], 1
-    for i in range(n_s):
-        w.append(t)
-        t *= weight
-    tw = sum(w)
-    w = [j / tw for j in w]
-
-    losses = []
-    for i in range(n_s):
-        ds = distance_among(sources[i])
-        dt = distance_among(target)
-        distance_2 = (ds - dt) ** 2
-        loss = torch.sum(distance_2 * mean_adj_4) * w[i] / n_atom
-        losses.append(loss)
-
-    return sum(losses)
+    return hierarchical_pair_loss(sources, target, mask_matrices, mode='adj4', weight=weight)
 
 
 def distance_loss(source: torch.Tensor, target: torch.Tensor, mask_matrices: MaskMatrices,
                   use_cuda=False, root_square=True) -> torch.Tensor:
-    norm_vv = generate_adj(mask_matrices, mode='distance', use_cuda=use_cuda)
-    ds = distance_among(source)
-    dt = distance_among(target)
+    pairs, norm_vv = get_adj_pairs(mask_matrices, mode='distance')
+    ds = pair_distance(source, pairs)
+    dt = pair_distance(target, pairs)
     if root_square:
         return torch.sqrt(torch.sum(((ds - dt) ** 2) * norm_vv))
     else:
@@ -221,7 +262,7 @@ def distance_loss(source: torch.Tensor, target: torch.Tensor, mask_matrices: Mas
 
 def kabsch_rmsd_loss(source: torch.Tensor, target: torch.Tensor, mask_matrices: MaskMatrices,
                      use_cuda=False) -> torch.Tensor:
-    pos, fit_pos = kabsch(source, target, mask_matrices.mol_vertex_w, use_cuda=use_cuda)
+    pos, fit_pos = batched_kabsch(source, target, mask_matrices.mol_vertex_index(), mask_matrices.n_mol)
     return rmse_loss(pos, fit_pos)
 
 
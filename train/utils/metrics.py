@@ -0,0 +1,39 @@
+import numpy as np
+import torch
+from typing import Dict, Union
+
+
+class MetricAccumulator:
+    def __init__(self):
+        """
+        running sums of per-batch metrics kept on the device they are computed on,
+        so that evaluating a split costs one device-to-host transfer instead of one per metric per batch
+        """
+        self.sums: Dict[str, torch.Tensor] = {}
+        self.counts: Dict[str, int] = {}
+
+    def add(self, name: str, value: torch.Tensor):
+        value = value.detach()
+        if name in self.sums.keys():
+            self.sums[name] = self.sums[name] + value
+            self.counts[name] += 1
+        else:
+            self.sums[name] = value
+            self.counts[name] = 1
+
+    def means(self) -> Dict[str, Union[float, np.ndarray]]:
+        """
+        :return: the mean over the added batches of every metric, as a float if it is a scalar
+        """
+        if len(self.sums) == 0:
+            return {}
+        names = list(self.sums.keys())
+        flat = torch.cat([self.sums[name].reshape([-1]).type(torch.float32) for name in names]).cpu().numpy()
+        ret = {}
+        start = 0
+        for name in names:
+            size = self.sums[name].numel()
+            mean = flat[start: start + size].reshape(self.sums[name].shape) / self.counts[name]
+            ret[name] = mean.item() if mean.ndim == 0 else mean
+            start += size
+        return ret
@@ -1,19 +1,120 @@
+import os
+import sqlite3
 import numpy as np
 import rdkit
 import rdkit.Chem as Chem
+from multiprocessing import Pool
+from typing import List, Tuple, Union, Any
 from rdkit.Chem import AllChem
 from rdkit.Chem.rdchem import Mol as Molecule
 
+from data.feature_cache import canonical_order
 
-def rdkit_mol_positions(mol: Molecule):
-    position = np.zeros([len(mol.GetAtoms()), 3], np.float32)
+EMBED_SEED = 0
+EMBED_TIMEOUT = 60
+
+
+def rdkit_mol_positions(mol: Molecule, seed=EMBED_SEED, timeout=EMBED_TIMEOUT) -> Union[np.ndarray, None]:
+    """
+    embed a copy of `mol` with ETKDG, leaving the molecule and its conformers untouched
+    :param seed: random seed of the embedding, -1 for a random one
+    :param timeout: seconds allowed to the embedding, where the installed RDKit supports it
+    :return: positions with shape [n_atom, 3], None if the embedding fails or times out
+    """
+    mol = Chem.Mol(mol)
+    params = AllChem.ETKDGv3()
+    params.randomSeed = seed
+    if hasattr(params, 'timeout'):
+        params.timeout = timeout
     try:
-        AllChem.EmbedMolecule(mol)
+        AllChem.EmbedMolecule(mol, params)
         conf = mol.GetConformer()
-        position = conf.GetPositions()
     except ValueError:
-        pass
-    return position
+        return None
+    return conf.GetPositions().astype(np.float32)
+
+
+class ConformerStore:
+    def __init__(self, path: str):
+        """
+        RDKit positions kept in an SQLite file, keyed by canonical SMILES and embedding seed
+        and stored in canonical atom order, so that every dataset, run and training seed reuses the embeddings
+        """
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=60)
+            self._db.execute('CREATE TABLE IF NOT EXISTS conformers (key TEXT PRIMARY KEY, positions BLOB)')
+        return self._db
+
+    def get(self, key: str, atom_order: np.ndarray) -> Union[np.ndarray, None]:
+        row = self.db.execute('SELECT positions FROM conformers WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        atom_rank = np.empty_like(atom_order)
+        atom_rank[atom_order] = np.arange(atom_order.shape[0])
+        return np.frombuffer(row[0], dtype=np.float32).reshape([-1, 3])[atom_rank]
+
+    def put_many(self, items: List[Tuple[str, np.ndarray, np.ndarray]]):
+        """
+        :param items: keys, atom orders and positions in the order of each molecule
+        """
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO conformers VALUES (?, ?)',
+                                [(key, np.ascontiguousarray(positions[atom_order], dtype=np.float32).tobytes())
+                                 for key, atom_order, positions in items])
+
+    def __getstate__(self):
+        return {'path': self.path, '_db': None}
+
+
+def _embed_chunk(args: Tuple[List[bytes], int, float]) -> List[Union[np.ndarray, None]]:
+    chunk, seed, timeout = args
+    return [rdkit_mol_positions(Chem.Mol(item), seed, timeout) for item in chunk]
+
+
+def rdkit_positions_parallel(mols: List[Molecule], store: ConformerStore = None, seed=EMBED_SEED,
+                             timeout=EMBED_TIMEOUT, n_workers: int = None, chunk_size=64) -> List[np.ndarray]:
+    """
+    `rdkit_mol_positions` of every molecule over a process pool, keeping the order of `mols`
+    :param store: where the positions are looked up first and saved after, if any
+    :return: positions of each molecule, zeros for those that fail to embed, which are not saved to `store`
+        so that they are tried again
+    :param n_workers: number of processes, `os.cpu_count()` if None
+    :param chunk_size: number of molecules sent to a process at a time
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    ret: List[Any] = [None] * len(mols)
+    keys = []
+    if store is not None:
+        for i, mol in enumerate(mols):
+            smiles, atom_order, _ = canonical_order(mol)
+            keys.append((f'{smiles}|{seed}', atom_order))
+            ret[i] = store.get(*keys[i])
+    missed = [i for i, positions in enumerate(ret) if positions is None]
+    print(f'\tEmbedding {len(missed)} molecules, {len(mols) - len(missed)} found in the conformer store')
+    items = [mols[i].ToBinary() for i in missed]
+    chunks = [(items[i: i + chunk_size], seed, timeout) for i in range(0, len(items), chunk_size)]
+    if n_workers <= 1 or len(chunks) <= 1:
+        missed_ret = [positions for chunk in chunks for positions in _embed_chunk(chunk)]
+    else:
+        missed_ret = []
+        with Pool(n_workers) as pool:
+            for chunk_ret in pool.imap(_embed_chunk, chunks):
+                missed_ret.extend(chunk_ret)
+    for i, positions in zip(missed, missed_ret):
+        ret[i] = positions
+    embedded = [i for i in missed if ret[i] is not None]
+    if len(embedded) < len(missed):
+        print(f'\tFailed to embed {len(missed) - len(embedded)} molecules, given zero positions')
+    if store is not None and len(embedded):
+        store.put_many([keys[i] + (ret[i],) for i in embedded])
+    return [positions if positions is not None else np.zeros([mol.GetNumAtoms(), 3], np.float32)
+            for mol, positions in zip(mols, ret)]
 
 
 if __name__ == '__main__':
@@ -60,6 +60,8 @@ def eval_rmsd_with_mols(list_mols: List[Molecule], tag: str, special_config: dic
 
             # rdkit
             rdkit_conf = rdkit_mol_positions(list_mols[idx])
+            if rdkit_conf is None:
+                rdkit_conf = np.zeros([list_mols[idx].GetNumAtoms(), 3])
             rdkit_l = compare_conf(smiles, rdkit_conf, real_conf)
 
             # CVGAE
@@ -18,6 +18,8 @@ def rebuild_qm9(atom_dim, bond_dim, tag='QM9', special_config: dict = None, use_
     for k, v in config.items():
         print(f'\t\t{k}: {v}')
 
+    model_dicts = torch.load(f'train/models/{tag}-model.pkl', map_location=torch.device('cpu'))
+    classifier_dicts = torch.load(f'train/models/{tag}-classifier.pkl', map_location=torch.device('cpu'))
     model = GeomNN(
         atom_dim=atom_dim,
         bond_dim=bond_dim,
@@ -26,13 +28,11 @@ def rebuild_qm9(atom_dim, bond_dim, tag='QM9', special_config: dict = None, use_
     )
     classifier = MLP(
         in_dim=config['HM_DIM'],
-        out_dim=12,
+        out_dim=[v for k, v in classifier_dicts.items() if k.endswith('weight')][-1].shape[0],
         hidden_dims=config['CLASSIFIER_HIDDENS'],
         use_cuda=use_cuda,
         bias=True
     )
-    model_dicts = torch.load(f'train/models/{tag}-model.pkl', map_location=torch.device('cpu'))
-    classifier_dicts = torch.load(f'train/models/{tag}-classifier.pkl', map_location=torch.device('cpu'))
     model.load_state_dict(model_dicts)
     classifier.load_state_dict(classifier_dicts)
     model.eval()
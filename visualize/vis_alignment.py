@@ -61,6 +61,8 @@ def vis_alignment(list_smiles: List[str], tag: str, special_config: dict, use_cu
     for idx, mol_info in enumerate(mols_info):
         conf, local_alignments, global_alignment = generate_alignments(model, mol_info)
         conf = rdkit_mol_positions(Chem.MolFromSmiles(list_smiles[idx]))
+        if conf is None:
+            conf = np.zeros([Chem.MolFromSmiles(list_smiles[idx]).GetNumAtoms(), 3])
         for i in range(len(local_alignments)):
             for j in range(len(local_alignments[i])):
                 print(f'local: {i}, {j}')
@@ -33,7 +33,7 @@ def generate_bond_energy(model: GeomNN, mol_info: Dict[str, np.ndarray]) -> List
     mask_matrices = MaskMatrices(mol_vertex_w, mol_vertex_b,
                                  vertex_edge_w1, vertex_edge_w2,
                                  vertex_edge_b1, vertex_edge_b2)
-    _, _, _, _, list_he_ftr, *_ = model.forward(atom_ftr, bond_ftr, massive, mask_matrices)
+    _, _, _, _, list_he_ftr, *_ = model.forward(atom_ftr, bond_ftr, massive, mask_matrices, return_he_ftr=True)
     return [np.sqrt(np.sum(he_ftr ** 2, axis=1)) for he_ftr in list_he_ftr]
 
 
@@ -67,6 +67,8 @@ def vis_derive_with_smiles(list_smiles: List[str], tag: str, special_config: dic
         print(f'### Generating SMILES {list_smiles[idx]} ###')
         # rdkit
         conf = rdkit_mol_positions(list_mols[idx])
+        if conf is None:
+            conf = np.zeros([list_mols[idx].GetNumAtoms(), 3])
         log_pos_json(conf, None, list_mols[idx], list_smiles[idx], f'm{idx}_rdkit', d='visualize/derive/json_smiles')
         plt_derive(conf, None, list_mols[idx], f'm{idx}_rdkit', d='visualize/derive/graph_smiles')
 
@@ -104,6 +106,8 @@ def vis_derive_with_mols(list_mols: List[Molecule], tag: str, special_config: di
 
         # rdkit
         conf = rdkit_mol_positions(list_mols[idx])
+        if conf is None:
+            conf = np.zeros([list_mols[idx].GetNumAtoms(), 3])
         log_pos_json(conf, None, list_mols[idx], list_smiles[idx], f'm{idx}_rdkit')
         plt_derive(conf, None, list_mols[idx], f'm{idx}_rdkit')
 